@@ -3,6 +3,8 @@
 from __future__ import division, print_function
 from brainstorm.handlers.numpy_handler import NumpyHandler
 from brainstorm.handlers.debug_handler import DebugHandler
+from brainstorm.handlers.profiling_handler import ProfilingHandler
+from brainstorm.handlers.autotuner import Autotuner
 from brainstorm.optional import has_pycuda, pycuda_mock
 import numpy as np
 
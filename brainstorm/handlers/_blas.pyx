@@ -0,0 +1,63 @@
+# coding=utf-8
+"""
+Direct bindings to the BLAS gemm routines that ship with scipy.
+
+Unlike :func:`numpy.dot` these work in place on strided views, and they
+support the usual alpha/beta scaling, so products can be accumulated into
+an existing array without a temporary.
+"""
+from __future__ import division, print_function
+
+cimport numpy as np
+from scipy.linalg.cython_blas cimport dgemm, sgemm
+
+import numpy as np
+
+np.import_array()
+
+
+def gemm(bint transa, bint transb, int m, int n, int k, double alpha,
+         np.ndarray a not None, int lda, np.ndarray b not None, int ldb,
+         double beta, np.ndarray c not None, int ldc):
+    """
+    Compute c = alpha * op(a) . op(b) + beta * c for row-major matrices.
+
+    The operands are described by their first element and their leading
+    dimension (the row stride in elements), so rows need not be contiguous
+    with each other. All of them must have the same dtype, which has to be
+    float32 or float64.
+
+    Args:
+        transa (bool): whether op(a) is the transpose of a
+        transb (bool): whether op(b) is the transpose of b
+        m (int): number of rows of op(a) and c
+        n (int): number of columns of op(b) and c
+        k (int): number of columns of op(a) and rows of op(b)
+        alpha (float): scaling factor of the product
+        a (numpy.ndarray): first operand
+        lda (int): leading dimension of a
+        b (numpy.ndarray): second operand
+        ldb (int): leading dimension of b
+        beta (float): scaling factor of c
+        c (numpy.ndarray): output
+        ldc (int): leading dimension of c
+    """
+    # BLAS is column-major, so compute c.T = op(b).T . op(a).T instead
+    cdef char ta = c'T' if transb else c'N'
+    cdef char tb = c'T' if transa else c'N'
+    cdef float falpha = alpha
+    cdef float fbeta = beta
+    if c.dtype == np.float64:
+        with nogil:
+            dgemm(&ta, &tb, &n, &m, &k, &alpha,
+                  <double*>np.PyArray_DATA(b), &ldb,
+                  <double*>np.PyArray_DATA(a), &lda, &beta,
+                  <double*>np.PyArray_DATA(c), &ldc)
+    elif c.dtype == np.float32:
+        with nogil:
+            sgemm(&ta, &tb, &n, &m, &k, &falpha,
+                  <float*>np.PyArray_DATA(b), &ldb,
+                  <float*>np.PyArray_DATA(a), &lda, &fbeta,
+                  <float*>np.PyArray_DATA(c), &ldc)
+    else:
+        raise TypeError('Unsupported dtype {}'.format(c.dtype))
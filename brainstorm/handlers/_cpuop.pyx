@@ -2,8 +2,10 @@
 from __future__ import division, print_function
 
 cimport numpy as np
+from cython.parallel cimport prange
 from cython.view cimport array as cvarray
 from libc.float cimport FLT_MAX, DBL_MAX
+from libc.math cimport NAN, exp, log, tanh
 
 import cython
 import numpy as np
@@ -19,8 +21,55 @@ cdef inline DTYPE_t dtype_t_max(DTYPE_t a, DTYPE_t b) nogil:
 cdef inline int int_max(int a, int b) nogil: return a if a >= b else b
 cdef inline int int_min(int a, int b) nogil: return a if a <= b else b
 
+
 # ------------------------- Cudarray-based routines ------------------------- #
 # Please see Third Party License file for license information
+#
+# All batch routines process the images of a batch independently. The work
+# for a single image is done by a cdef helper, and the batch loop is a prange
+# that is distributed over `num_threads` OpenMP threads. With num_threads=1
+# (or when compiled without OpenMP) this is exactly the serial loop.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _maxpool_forward_image(DTYPE_t[:, :, :, ::1] inputs,
+                                 DTYPE_t[:, :, :, ::1] outputs,
+                                 DTYPE_t[:, :, :, ::1] argmax,
+                                 int i, int pool_h, int pool_w,
+                                 int stride_y, int stride_x, int padding,
+                                 DTYPE_t min_value) noexcept nogil:
+    cdef int n_channels = inputs.shape[3]
+    cdef int in_h = inputs.shape[1]
+    cdef int in_w = inputs.shape[2]
+    cdef int out_h = outputs.shape[1]
+    cdef int out_w = outputs.shape[2]
+    cdef int c, y, x, y_out, x_out
+    cdef int y_min, y_max, x_min, x_max
+    cdef int in_y, in_x
+    cdef int max_idx = -1
+    cdef DTYPE_t value, new_value
+    for c in range(n_channels):
+        for y_out in range(out_h):
+            y = y_out * stride_y - padding
+            y_min = int_max(y, 0)
+            y_max = int_min(y + pool_h, in_h)
+            for x_out in range(out_w):
+                x = x_out * stride_x - padding
+                x_min = int_max(x, 0)
+                x_max = int_min(x + pool_w, in_w)
+                value = min_value
+                max_idx = -1
+                for in_y in range(y_min, y_max):
+                    for in_x in range(x_min, x_max):
+                        new_value = inputs[i, in_y, in_x, c]
+                        if new_value > value:
+                            value = new_value
+                            max_idx = (in_y * in_w + in_x) * n_channels + c
+                outputs[i, y_out, x_out, c] = value
+                argmax[i, y_out, x_out, c] = <DTYPE_t>max_idx
+                if max_idx == -1:
+                    outputs[i, y_out, x_out, c] = 0
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -29,22 +78,14 @@ def maxpool_forward(DTYPE_t[:, :, :, ::1] inputs not None,
             DTYPE_t[:, :, :, ::1] outputs not None,
             int padding,
             tuple strides not None,
-            DTYPE_t[:, :, :, ::1] argmax not None):
+            DTYPE_t[:, :, :, ::1] argmax not None,
+            int num_threads=1):
     cdef int pool_h = kernel[0]
     cdef int pool_w = kernel[1]
     cdef int stride_x = strides[1]
     cdef int stride_y = strides[0]
     cdef int n_inputs = inputs.shape[0]
-    cdef int n_channels = inputs.shape[3]
-    cdef int in_h = inputs.shape[1]
-    cdef int in_w = inputs.shape[2]
-    cdef int out_h = outputs.shape[1]
-    cdef int out_w = outputs.shape[2]
-    cdef int i, c, y, x, y_out, x_out
-    cdef int y_min, y_max, x_min, x_max
-    cdef int in_y, in_x
-    cdef int max_idx = -1
-    cdef DTYPE_t value, new_value
+    cdef int i
     cdef DTYPE_t min_value
 
     # for output compatibility with cudnn, we must
@@ -55,29 +96,35 @@ def maxpool_forward(DTYPE_t[:, :, :, ::1] inputs not None,
         min_value = -DBL_MAX
 
     with nogil:
-        for i in range(n_inputs):
-            for c in range(n_channels):
-                for y_out in range(out_h):
-                    y = y_out * stride_y - padding
-                    y_min = int_max(y, 0)
-                    y_max = int_min(y + pool_h, in_h)
-                    for x_out in range(out_w):
-                        x = x_out * stride_x - padding
-                        x_min = int_max(x, 0)
-                        x_max = int_min(x + pool_w, in_w)
-                        value = min_value
-                        max_idx = -1
-                        for in_y in range(y_min, y_max):
-                            for in_x in range(x_min, x_max):
-                                new_value = inputs[i, in_y, in_x, c]
-                                if new_value > value:
-                                    value = new_value
-                                    max_idx = (in_y * in_w + in_x) * \
-                                              n_channels + c
-                        outputs[i, y_out, x_out, c] = value
-                        argmax[i, y_out, x_out, c] = <DTYPE_t>max_idx
-                        if max_idx == -1:
-                            outputs[i, y_out, x_out, c] = 0
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _maxpool_forward_image(inputs, outputs, argmax, i, pool_h, pool_w,
+                                   stride_y, stride_x, padding, min_value)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _maxpool_backward_image(DTYPE_t[:, :, :, ::1] inputs,
+                                  DTYPE_t[:, :, :, ::1] outputs,
+                                  DTYPE_t[:, :, :, ::1] argmax,
+                                  DTYPE_t[:, :, :, ::1] in_deltas,
+                                  DTYPE_t[:, :, :, ::1] out_deltas,
+                                  int i) noexcept nogil:
+    cdef int n_channels = inputs.shape[3]
+    cdef int in_w = inputs.shape[2]
+    cdef int out_h = outputs.shape[1]
+    cdef int out_w = outputs.shape[2]
+    cdef int c, y, x, in_y, in_x, map_loc, max_idx
+    for c in range(n_channels):
+        for y in range(out_h):
+            for x in range(out_w):
+                max_idx = <int>(argmax[i, y, x, c])
+                if max_idx != -1:
+                    map_loc = max_idx // n_channels
+                    in_y = map_loc // in_w
+                    in_x = map_loc % in_w
+                    if in_y >= 0 and in_x >= 0:
+                        in_deltas[i, in_y, in_x, c] += out_deltas[i, y, x, c]
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -88,31 +135,49 @@ def maxpool_backward(DTYPE_t[:, :, :, ::1] inputs not None,
                      tuple strides not None,
                      DTYPE_t[:, :, :, ::1] argmax not None,
                      DTYPE_t[:, :, :, ::1] in_deltas not None,
-                     DTYPE_t[:, :, :, ::1] out_deltas not None):
-    cdef int pool_h = kernel[0]
-    cdef int pool_w = kernel[1]
-    cdef int stride_x = strides[1]
-    cdef int stride_y = strides[0]
+                     DTYPE_t[:, :, :, ::1] out_deltas not None,
+                     int num_threads=1):
     cdef int n_inputs = inputs.shape[0]
+    cdef int i
+    with nogil:
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _maxpool_backward_image(inputs, outputs, argmax, in_deltas,
+                                    out_deltas, i)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _avgpool_forward_image(DTYPE_t[:, :, :, ::1] inputs,
+                                 DTYPE_t[:, :, :, ::1] outputs,
+                                 int i, int pool_h, int pool_w,
+                                 int stride_y, int stride_x,
+                                 int padding) noexcept nogil:
+    # NOTE: Modified to count only non-padding pixels
     cdef int n_channels = inputs.shape[3]
     cdef int in_h = inputs.shape[1]
     cdef int in_w = inputs.shape[2]
     cdef int out_h = outputs.shape[1]
     cdef int out_w = outputs.shape[2]
-    cdef int i, c, y, x, in_y, in_x, map_loc, max_idx
-    with nogil:
-        for i in range(n_inputs):
-            for c in range(n_channels):
-                for y in range(out_h):
-                    for x in range(out_w):
-                        max_idx = <int>(argmax[i, y, x, c])
-                        if max_idx != -1:
-                            map_loc = max_idx // n_channels
-                            in_y = map_loc // in_w
-                            in_x = map_loc % in_w
-                            if in_y >= 0 and in_x >= 0:
-                                in_deltas[i, in_y, in_x, c] += \
-                                    out_deltas[i, y, x, c]
+    cdef int c, y, x, y_out, x_out
+    cdef int y_min, y_max, x_min, x_max
+    cdef int in_y, in_x
+    cdef DTYPE_t value
+    cdef int pool_size = 0
+    for c in range(n_channels):
+        for y_out in range(out_h):
+            y = y_out * stride_y - padding
+            y_min = int_max(y, 0)
+            y_max = int_min(y + pool_h, in_h)
+            for x_out in range(out_w):
+                x = x_out * stride_x - padding
+                x_min = int_max(x, 0)
+                x_max = int_min(x + pool_w, in_w)
+                value = 0
+                for in_y in range(y_min, y_max):
+                    for in_x in range(x_min, x_max):
+                        value += inputs[i, in_y, in_x, c]
+                pool_size = int_max((y_max - y_min) * (x_max - x_min), 1)
+                outputs[i, y_out, x_out, c] = value / pool_size
 
 
 @cython.boundscheck(False)
@@ -121,45 +186,51 @@ def avgpool_forward(DTYPE_t[:, :, :, ::1] inputs not None,
             tuple kernel not None,
             DTYPE_t[:, :, :, ::1] outputs not None,
             int padding,
-            tuple strides not None):
-    # NOTE: Modified to count only non-padding pixels
+            tuple strides not None,
+            int num_threads=1):
     cdef int pool_h = kernel[0]
     cdef int pool_w = kernel[1]
     cdef int stride_x = strides[1]
     cdef int stride_y = strides[0]
     cdef int n_inputs = inputs.shape[0]
+    cdef int i
+    with nogil:
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _avgpool_forward_image(inputs, outputs, i, pool_h, pool_w,
+                                   stride_y, stride_x, padding)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _avgpool_backward_image(DTYPE_t[:, :, :, ::1] inputs,
+                                  DTYPE_t[:, :, :, ::1] outputs,
+                                  DTYPE_t[:, :, :, ::1] in_deltas,
+                                  DTYPE_t[:, :, :, ::1] out_deltas,
+                                  int i, int pool_h, int pool_w,
+                                  int stride_y, int stride_x,
+                                  int padding) noexcept nogil:
+    # NOTE: No modification need to count only non-padding pixels
     cdef int n_channels = inputs.shape[3]
     cdef int in_h = inputs.shape[1]
     cdef int in_w = inputs.shape[2]
     cdef int out_h = outputs.shape[1]
     cdef int out_w = outputs.shape[2]
-    cdef int i, c, y, x, y_out, x_out
-    cdef int y_min, y_max, x_min, x_max
-    cdef int in_y, in_x,
-    cdef int in_y_max = 0
-    cdef int in_x_max = 0
-    cdef DTYPE_t value, new_value
+    cdef int c, y, x, x_min, x_max, y_min, y_max, x_out, y_out, yy, xx
     cdef int pool_size = 0
-    with nogil:
-        for i in range(n_inputs):
-            for c in range(n_channels):
-                for y_out in range(out_h):
-                    y = y_out * stride_y - padding
-                    y_min = int_max(y, 0)
-                    y_max = int_min(y + pool_h, in_h)
-                    for x_out in range(out_w):
-                        x = x_out * stride_x - padding
-                        x_min = int_max(x, 0)
-                        x_max = int_min(x + pool_w, in_w)
-                        value = 0
-                        in_y_max = -1
-                        in_x_max = -1
-                        for in_y in range(y_min, y_max):
-                            for in_x in range(x_min, x_max):
-                                value += inputs[i, in_y, in_x, c]
-                        pool_size = int_max((y_max - y_min) * (x_max - x_min),
-                                            1)
-                        outputs[i, y_out, x_out, c] = value / pool_size
+    for c in range(n_channels):
+        for y_out in range(out_h):
+            y = y_out * stride_y - padding
+            y_min = int_max(y, 0)
+            y_max = int_min(y + pool_h, in_h)
+            for x_out in range(out_w):
+                x = x_out * stride_x - padding
+                x_min = int_max(x, 0)
+                x_max = int_min(x + pool_w, in_w)
+                pool_size = (y_max - y_min) * (x_max - x_min)
+                for yy in range(y_min, y_max):
+                    for xx in range(x_min, x_max):
+                        in_deltas[i, yy, xx, c] += \
+                            out_deltas[i, y_out, x_out, c] / pool_size
 
 
 @cython.boundscheck(False)
@@ -170,36 +241,36 @@ def avgpool_backward(DTYPE_t[:, :, :, ::1] inputs not None,
                      const int padding,
                      tuple strides not None,
                      DTYPE_t[:, :, :, ::1] in_deltas not None,
-                     DTYPE_t[:, :, :, ::1] out_deltas not None):
-    # NOTE: No modification need to count only non-padding pixels
+                     DTYPE_t[:, :, :, ::1] out_deltas not None,
+                     int num_threads=1):
     cdef int pool_h = kernel[0]
     cdef int pool_w = kernel[1]
     cdef int stride_x = strides[1]
     cdef int stride_y = strides[0]
     cdef int n_inputs = inputs.shape[0]
-    cdef int n_channels = inputs.shape[3]
-    cdef int in_h = inputs.shape[1]
-    cdef int in_w = inputs.shape[2]
-    cdef int out_h = outputs.shape[1]
-    cdef int out_w = outputs.shape[2]
-    cdef int i, c, y, x, x_min, x_max, y_min, y_max, x_out, y_out
-    cdef int pool_size = 0
+    cdef int i
     with nogil:
-        for i in range(n_inputs):
-            for c in range(n_channels):
-                for y_out in range(out_h):
-                    y = y_out * stride_y - padding
-                    y_min = int_max(y, 0)
-                    y_max = int_min(y + pool_h, in_h)
-                    for x_out in range(out_w):
-                        x = x_out * stride_x-padding
-                        x_min = int_max(x, 0)
-                        x_max = int_min(x + pool_w, in_w)
-                        pool_size = (y_max - y_min) * (x_max - x_min)
-                        for yy in range(y_min, y_max):
-                            for xx in range(x_min, x_max):
-                                 in_deltas[i, yy, xx, c] += \
-                                     out_deltas[i, y_out, x_out, c] / pool_size
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _avgpool_backward_image(inputs, outputs, in_deltas, out_deltas, i,
+                                    pool_h, pool_w, stride_y, stride_x,
+                                    padding)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _crop_image(DTYPE_t[:, :, :, :, ::1] inputs,
+                      DTYPE_t[:, :, :, :, ::1] outputs,
+                      int i, int start_row, int start_col,
+                      int height, int width) noexcept nogil:
+    cdef int time_steps = inputs.shape[0]
+    cdef int num_channels = inputs.shape[4]
+    cdef int t, k, l, c
+    for t in range(time_steps):
+        for k in range(height):
+            for l in range(width):
+                for c in range(num_channels):
+                    outputs[t, i, k, l, c] = inputs[t, i, k + start_row,
+                                                    l + start_col, c]
 
 
 @cython.boundscheck(False)
@@ -209,7 +280,8 @@ def _crop_images(DTYPE_t[:, :, :, :, ::1] inputs not None,
                 int width,
                 np.int_t[:] row_indices,
                 np.int_t[:] col_indices,
-                DTYPE_t[:, :, :, :, ::1] outputs not None):
+                DTYPE_t[:, :, :, :, ::1] outputs not None,
+                int num_threads=1):
     """
     Args:
         inputs (numpy.ndarray[ndim=5]):
@@ -226,22 +298,16 @@ def _crop_images(DTYPE_t[:, :, :, :, ::1] inputs not None,
             with inputs.shape[1] elements (one for each item in batch)
         outputs (numpy.ndarray[ndim=5]):
             5 dimensional Numpy array
+        num_threads (int):
+            number of threads to distribute the batch over
     """
     cdef int batch_size = row_indices.shape[0]
-    cdef int time_steps = inputs.shape[0]
-    cdef int num_channels = inputs.shape[4]
-    cdef int start_row, start_col, i, j, k, l, t
+    cdef int i
     with nogil:
-        for i in range(batch_size):
-            start_row = row_indices[i]
-            start_col = col_indices[i]
-            for t in range(0, time_steps):
-                for k in range(0, height):
-                    for l in range(0, width):
-                        for c in range(0, num_channels):
-                            outputs[t, i, k, l, c] = inputs[t, i,
-                                                            k + start_row,
-                                                            l + start_col, c]
+        for i in prange(batch_size, num_threads=num_threads,
+                        schedule='static'):
+            _crop_image(inputs, outputs, i, <int>row_indices[i],
+                        <int>col_indices[i], height, width)
 
 # -------------------------- Caffe2-based routines -------------------------- #
 # Please see Third Party License file for license information
@@ -307,3 +373,602 @@ def col2im(DTYPE_t[::1] flat_col not None,
                     im_patch_idx += channels * (width - kernel_w)
                 w_pad += stride_w
             h_pad += stride_h
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _im2col_image(DTYPE_t[:, :, :, ::1] inputs, int i,
+                        int kernel_h, int kernel_w, int pad_t, int pad_l,
+                        int stride_h, int stride_w, int height_col,
+                        int width_col,
+                        DTYPE_t[:, :, ::1] col) noexcept nogil:
+    cdef int height = inputs.shape[1]
+    cdef int width = inputs.shape[2]
+    cdef int channels = inputs.shape[3]
+    cdef int h, w, ih, iw, c, row, col_idx
+    for h in range(height_col):
+        for w in range(width_col):
+            row = h * width_col + w
+            col_idx = 0
+            for ih in range(h * stride_h - pad_t,
+                            h * stride_h - pad_t + kernel_h):
+                for iw in range(w * stride_w - pad_l,
+                                w * stride_w - pad_l + kernel_w):
+                    if 0 <= ih < height and 0 <= iw < width:
+                        for c in range(channels):
+                            col[i, row, col_idx + c] = inputs[i, ih, iw, c]
+                    else:
+                        for c in range(channels):
+                            col[i, row, col_idx + c] = 0
+                    col_idx = col_idx + channels
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def im2col_batch(DTYPE_t[:, :, :, ::1] inputs not None,
+                 const int kernel_h, const int kernel_w,
+                 const int pad_t, const int pad_l,
+                 const int pad_b, const int pad_r,
+                 const int stride_h, const int stride_w,
+                 DTYPE_t[:, :, ::1] col not None,
+                 int num_threads=1):
+    """
+    Lower a whole batch of NHWC images into column matrices.
+
+    Args:
+        inputs (numpy.ndarray[ndim=4]):
+            Batch of images with shape (N, H, W, C).
+        col (numpy.ndarray[ndim=3]):
+            Output of shape (N, output pixels, kernel_h * kernel_w * C).
+        num_threads (int):
+            number of threads to distribute the images over
+    """
+    cdef int height = inputs.shape[1]
+    cdef int width = inputs.shape[2]
+    cdef int height_col = (height + pad_t + pad_b - kernel_h) // stride_h + 1
+    cdef int width_col = (width + pad_l + pad_r - kernel_w) // stride_w + 1
+    cdef int n_inputs = inputs.shape[0]
+    cdef int i
+    with nogil:
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _im2col_image(inputs, i, kernel_h, kernel_w, pad_t, pad_l,
+                          stride_h, stride_w, height_col, width_col, col)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _col2im_image(DTYPE_t[:, :, ::1] col, int i,
+                        int kernel_h, int kernel_w, int pad_t, int pad_l,
+                        int stride_h, int stride_w, int height_col,
+                        int width_col,
+                        DTYPE_t[:, :, :, ::1] in_deltas) noexcept nogil:
+    cdef int height = in_deltas.shape[1]
+    cdef int width = in_deltas.shape[2]
+    cdef int channels = in_deltas.shape[3]
+    cdef int h, w, ih, iw, c, row, col_idx
+    for h in range(height_col):
+        for w in range(width_col):
+            row = h * width_col + w
+            col_idx = 0
+            for ih in range(h * stride_h - pad_t,
+                            h * stride_h - pad_t + kernel_h):
+                for iw in range(w * stride_w - pad_l,
+                                w * stride_w - pad_l + kernel_w):
+                    if 0 <= ih < height and 0 <= iw < width:
+                        for c in range(channels):
+                            in_deltas[i, ih, iw, c] += col[i, row, col_idx + c]
+                    col_idx = col_idx + channels
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def col2im_batch(DTYPE_t[:, :, ::1] col not None,
+                 const int kernel_h, const int kernel_w,
+                 const int pad_t, const int pad_l,
+                 const int pad_b, const int pad_r,
+                 const int stride_h, const int stride_w,
+                 DTYPE_t[:, :, :, ::1] in_deltas not None,
+                 int num_threads=1):
+    """
+    Accumulate a batch of column matrices back into NHWC images.
+
+    This is the adjoint of :func:`im2col_batch`: the columns are *added* to
+    `in_deltas`.
+
+    Args:
+        col (numpy.ndarray[ndim=3]):
+            Columns with shape (N, output pixels, kernel_h * kernel_w * C).
+        in_deltas (numpy.ndarray[ndim=4]):
+            Batch of images with shape (N, H, W, C) to add the result to.
+        num_threads (int):
+            number of threads to distribute the images over
+    """
+    cdef int height = in_deltas.shape[1]
+    cdef int width = in_deltas.shape[2]
+    cdef int height_col = (height + pad_t + pad_b - kernel_h) // stride_h + 1
+    cdef int width_col = (width + pad_l + pad_r - kernel_w) // stride_w + 1
+    cdef int n_inputs = in_deltas.shape[0]
+    cdef int i
+    with nogil:
+        for i in prange(n_inputs, num_threads=num_threads, schedule='static'):
+            _col2im_image(col, i, kernel_h, kernel_w, pad_t, pad_l,
+                          stride_h, stride_w, height_col, width_col,
+                          in_deltas)
+
+
+# ------------------------------ LSTM routines ------------------------------ #
+# The gate pre-activations of an LSTM are stacked along the feature axis in
+# the order (block input z, input gate i, forget gate f, output gate o), so
+# each row of `gates` has 4 * size entries. The peepholes are stacked as
+# (p_i, p_f, p_o). The activation function is encoded as an int:
+# 0: linear, 1: sigmoid, 2: tanh, 3: rel.
+
+cdef inline DTYPE_t _sigmoid(DTYPE_t x) noexcept nogil:
+    cdef DTYPE_t e
+    if x >= 0:
+        return 1. / (1. + exp(-x))
+    e = exp(x)
+    return e / (1. + e)
+
+
+cdef inline DTYPE_t _activation(DTYPE_t x, int act) noexcept nogil:
+    if act == 1:
+        return _sigmoid(x)
+    elif act == 2:
+        return tanh(x)
+    elif act == 3:
+        return x if x > 0 else 0
+    return x
+
+
+cdef inline DTYPE_t _activation_deriv(DTYPE_t y, int act) noexcept nogil:
+    """Derivative of the activation function given its output y."""
+    if act == 1:
+        return y * (1 - y)
+    elif act == 2:
+        return 1 - y * y
+    elif act == 3:
+        return 1 if y > 0 else 0
+    return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _lstm_forward_row(DTYPE_t[:, ::1] gates,
+                            DTYPE_t[:, ::1] act_gates,
+                            const DTYPE_t[:, ::1] peepholes,
+                            const DTYPE_t[:, ::1] cell_prev,
+                            DTYPE_t[:, ::1] cell,
+                            DTYPE_t[:, ::1] act_cell,
+                            DTYPE_t[:, ::1] out,
+                            int b, int act) noexcept nogil:
+    cdef int n = cell.shape[1]
+    cdef int j
+    cdef DTYPE_t c
+    for j in range(n):
+        gates[b, n + j] += peepholes[0, j] * cell_prev[b, j]
+        gates[b, 2 * n + j] += peepholes[1, j] * cell_prev[b, j]
+        act_gates[b, j] = _activation(gates[b, j], act)
+        act_gates[b, n + j] = _sigmoid(gates[b, n + j])
+        act_gates[b, 2 * n + j] = _sigmoid(gates[b, 2 * n + j])
+
+        c = (act_gates[b, n + j] * act_gates[b, j] +
+             act_gates[b, 2 * n + j] * cell_prev[b, j])
+        cell[b, j] = c
+
+        gates[b, 3 * n + j] += peepholes[2, j] * c
+        act_gates[b, 3 * n + j] = _sigmoid(gates[b, 3 * n + j])
+        act_cell[b, j] = _activation(c, act)
+        out[b, j] = act_gates[b, 3 * n + j] * act_cell[b, j]
+
+
+def lstm_forward_step(DTYPE_t[:, ::1] gates not None,
+                      DTYPE_t[:, ::1] act_gates not None,
+                      const DTYPE_t[:, ::1] peepholes not None,
+                      const DTYPE_t[:, ::1] cell_prev not None,
+                      DTYPE_t[:, ::1] cell not None,
+                      DTYPE_t[:, ::1] act_cell not None,
+                      DTYPE_t[:, ::1] out not None,
+                      int act, int num_threads=1):
+    """
+    Fused LSTM cell update for one time step.
+
+    Adds the peephole contributions to the stacked pre-activations in
+    `gates`, applies the gate nonlinearities, and computes the new cell
+    state and the block output.
+
+    Args:
+        gates (numpy.ndarray[ndim=2]):
+            Stacked pre-activations (batch, 4 * size) that already contain
+            the input and recurrent projections and the biases.
+        act_gates (numpy.ndarray[ndim=2]):
+            Output: stacked gate activations (batch, 4 * size).
+        peepholes (numpy.ndarray[ndim=2]):
+            Stacked peephole weights (3, size).
+        cell_prev (numpy.ndarray[ndim=2]):
+            Cell state of the previous time step (batch, size).
+        cell (numpy.ndarray[ndim=2]):
+            Output: cell state (batch, size).
+        act_cell (numpy.ndarray[ndim=2]):
+            Output: activated cell state (batch, size).
+        out (numpy.ndarray[ndim=2]):
+            Output: block output (batch, size).
+        act (int):
+            code of the activation function
+        num_threads (int):
+            number of threads to distribute the batch over
+    """
+    cdef int batch_size = cell.shape[0]
+    cdef int b
+    with nogil:
+        for b in prange(batch_size, num_threads=num_threads,
+                        schedule='static'):
+            _lstm_forward_row(gates, act_gates, peepholes, cell_prev, cell,
+                              act_cell, out, b, act)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _lstm_backward_row(const DTYPE_t[:, ::1] act_gates,
+                             const DTYPE_t[:, ::1] peepholes,
+                             const DTYPE_t[:, ::1] cell_prev,
+                             const DTYPE_t[:, ::1] act_cell,
+                             const DTYPE_t[:, ::1] out_deltas,
+                             const DTYPE_t[:, ::1] next_gate_deltas,
+                             const DTYPE_t[:, ::1] next_act_gates,
+                             const DTYPE_t[:, ::1] next_cell_deltas,
+                             DTYPE_t[:, ::1] gate_deltas,
+                             DTYPE_t[:, ::1] cell_deltas,
+                             int b, int act) noexcept nogil:
+    cdef int n = act_cell.shape[1]
+    cdef int j
+    cdef DTYPE_t z, i, f, o, do, dc
+    for j in range(n):
+        z = act_gates[b, j]
+        i = act_gates[b, n + j]
+        f = act_gates[b, 2 * n + j]
+        o = act_gates[b, 3 * n + j]
+
+        do = out_deltas[b, j] * act_cell[b, j] * o * (1 - o)
+        dc = (out_deltas[b, j] * o * _activation_deriv(act_cell[b, j], act) +
+              next_cell_deltas[b, j] * next_act_gates[b, 2 * n + j] +
+              next_gate_deltas[b, n + j] * peepholes[0, j] +
+              next_gate_deltas[b, 2 * n + j] * peepholes[1, j] +
+              do * peepholes[2, j])
+        cell_deltas[b, j] = dc
+
+        gate_deltas[b, j] = dc * i * _activation_deriv(z, act)
+        gate_deltas[b, n + j] = dc * z * i * (1 - i)
+        gate_deltas[b, 2 * n + j] = dc * cell_prev[b, j] * f * (1 - f)
+        gate_deltas[b, 3 * n + j] = do
+
+
+def lstm_backward_step(const DTYPE_t[:, ::1] act_gates not None,
+                       const DTYPE_t[:, ::1] peepholes not None,
+                       const DTYPE_t[:, ::1] cell_prev not None,
+                       const DTYPE_t[:, ::1] act_cell not None,
+                       const DTYPE_t[:, ::1] out_deltas not None,
+                       const DTYPE_t[:, ::1] next_gate_deltas not None,
+                       const DTYPE_t[:, ::1] next_act_gates not None,
+                       const DTYPE_t[:, ::1] next_cell_deltas not None,
+                       DTYPE_t[:, ::1] gate_deltas not None,
+                       DTYPE_t[:, ::1] cell_deltas not None,
+                       int act, int num_threads=1):
+    """
+    Fused LSTM cell backward pass for one time step.
+
+    Computes the deltas of the cell state and of the stacked gate
+    pre-activations from the deltas of the block output and the deltas
+    flowing back from the next time step.
+
+    Args:
+        act_gates (numpy.ndarray[ndim=2]):
+            Stacked gate activations (batch, 4 * size).
+        peepholes (numpy.ndarray[ndim=2]):
+            Stacked peephole weights (3, size).
+        cell_prev (numpy.ndarray[ndim=2]):
+            Cell state of the previous time step (batch, size).
+        act_cell (numpy.ndarray[ndim=2]):
+            Activated cell state (batch, size).
+        out_deltas (numpy.ndarray[ndim=2]):
+            Total deltas of the block output (batch, size).
+        next_gate_deltas (numpy.ndarray[ndim=2]):
+            Stacked gate deltas of the next time step (batch, 4 * size).
+        next_act_gates (numpy.ndarray[ndim=2]):
+            Stacked gate activations of the next time step (batch, 4 * size).
+        next_cell_deltas (numpy.ndarray[ndim=2]):
+            Cell deltas of the next time step (batch, size).
+        gate_deltas (numpy.ndarray[ndim=2]):
+            Output: stacked gate deltas (batch, 4 * size).
+        cell_deltas (numpy.ndarray[ndim=2]):
+            Output: cell deltas (batch, size).
+        act (int):
+            code of the activation function
+        num_threads (int):
+            number of threads to distribute the batch over
+    """
+    cdef int batch_size = act_cell.shape[0]
+    cdef int b
+    with nogil:
+        for b in prange(batch_size, num_threads=num_threads,
+                        schedule='static'):
+            _lstm_backward_row(act_gates, peepholes, cell_prev, act_cell,
+                               out_deltas, next_gate_deltas, next_act_gates,
+                               next_cell_deltas, gate_deltas, cell_deltas,
+                               b, act)
+
+
+# ------------------------------ Loss routines ------------------------------ #
+# Fused cross entropy losses on (possibly strided) 2D views with one row per
+# sample. Rows are independent and distributed over the threads. Class
+# indices that are out of range result in a NaN loss.
+
+cdef inline DTYPE_t _clipped_log(DTYPE_t x) noexcept nogil:
+    if x < 1e-6:
+        x = 1e-6
+    elif x > 1.:
+        x = 1.
+    return log(x)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _softmax_ce_forward_row(const DTYPE_t[:, :] m,
+                                  const DTYPE_t[:, :] targets,
+                                  DTYPE_t[:, :] probabilities,
+                                  DTYPE_t[:, :] loss,
+                                  Py_ssize_t i) noexcept nogil:
+    cdef Py_ssize_t j, n = m.shape[1]
+    cdef Py_ssize_t t = <Py_ssize_t>targets[i, 0]
+    cdef DTYPE_t max_value
+    cdef DTYPE_t total = 0.
+    if not 0 <= t < n:
+        loss[i, 0] = NAN
+    if n == 0:
+        return
+    max_value = m[i, 0]
+    for j in range(1, n):
+        if m[i, j] > max_value:
+            max_value = m[i, j]
+    for j in range(n):
+        probabilities[i, j] = exp(m[i, j] - max_value)
+        total += probabilities[i, j]
+    for j in range(n):
+        probabilities[i, j] /= total
+    if 0 <= t < n:
+        loss[i, 0] = -_clipped_log(probabilities[i, t])
+
+
+def softmax_ce_forward(const DTYPE_t[:, :] m not None,
+                       const DTYPE_t[:, :] targets not None,
+                       DTYPE_t[:, :] probabilities not None,
+                       DTYPE_t[:, :] loss not None,
+                       int num_threads=1):
+    """Compute the softmax of each row of m and its multinomial cross
+    entropy loss = -ln(clip(probabilities[i, targets[i, 0]]))."""
+    cdef Py_ssize_t i
+    with nogil:
+        for i in prange(probabilities.shape[0], num_threads=num_threads,
+                        schedule='static'):
+            _softmax_ce_forward_row(m, targets, probabilities, loss, i)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def softmax_ce_backward(const DTYPE_t[:, :] probabilities not None,
+                        const DTYPE_t[:, :] targets not None,
+                        const DTYPE_t[:, :] loss_deltas not None,
+                        DTYPE_t[:, :] in_deltas not None,
+                        int num_threads=1):
+    """Compute in_deltas += loss_deltas * (probabilities - one_hot(targets))."""
+    cdef Py_ssize_t i, j, t
+    with nogil:
+        for i in prange(in_deltas.shape[0], num_threads=num_threads,
+                        schedule='static'):
+            t = <Py_ssize_t>targets[i, 0]
+            for j in range(in_deltas.shape[1]):
+                in_deltas[i, j] += loss_deltas[i, 0] * (
+                    probabilities[i, j] - (1. if j == t else 0.))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def binomial_ce_forward(const DTYPE_t[:, :] y not None,
+                        const DTYPE_t[:, :] t not None,
+                        DTYPE_t[:, :] loss not None,
+                        int num_threads=1):
+    """Compute loss = -sum(t * ln(clip(y)) + (1 - t) * ln(clip(1 - y)))
+    over each row."""
+    cdef Py_ssize_t i, j
+    cdef DTYPE_t total
+    with nogil:
+        for i in prange(y.shape[0], num_threads=num_threads,
+                        schedule='static'):
+            total = 0.
+            for j in range(y.shape[1]):
+                total = total + t[i, j] * _clipped_log(y[i, j]) + \
+                    (1. - t[i, j]) * _clipped_log(1. - y[i, j])
+            loss[i, 0] = -total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def binomial_ce_backward(const DTYPE_t[:, :] y not None,
+                         const DTYPE_t[:, :] t not None,
+                         const DTYPE_t[:, :] loss_deltas not None,
+                         DTYPE_t[:, :] in_deltas not None,
+                         int num_threads=1):
+    """Compute in_deltas += loss_deltas * (y - t) / clip(y - y * y)."""
+    cdef Py_ssize_t i, j
+    cdef DTYPE_t d
+    with nogil:
+        for i in prange(y.shape[0], num_threads=num_threads,
+                        schedule='static'):
+            for j in range(y.shape[1]):
+                d = y[i, j] - y[i, j] * y[i, j]
+                if d < 1e-6:
+                    d = 1e-6
+                elif d > 1.:
+                    d = 1.
+                in_deltas[i, j] += loss_deltas[i, 0] * (y[i, j] - t[i, j]) / d
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigmoid_ce_backward(const DTYPE_t[:, :] y not None,
+                        const DTYPE_t[:, :] t not None,
+                        const DTYPE_t[:, :] loss_deltas not None,
+                        DTYPE_t[:, :] in_deltas not None,
+                        int num_threads=1):
+    """Compute in_deltas += loss_deltas * (y - t)."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in prange(y.shape[0], num_threads=num_threads,
+                        schedule='static'):
+            for j in range(y.shape[1]):
+                in_deltas[i, j] += loss_deltas[i, 0] * (y[i, j] - t[i, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def index_m_by_v(const DTYPE_t[:, :] m not None,
+                 const DTYPE_t[:, :] v not None,
+                 DTYPE_t[:, :] out not None):
+    """Set out[i, 0] = m[i, v[i, 0]] (NaN for indices out of range)."""
+    cdef Py_ssize_t i, k
+    with nogil:
+        for i in range(m.shape[0]):
+            k = <Py_ssize_t>v[i, 0]
+            out[i, 0] = m[i, k] if 0 <= k < m.shape[1] else NAN
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def binarize_v(const DTYPE_t[:, :] v not None, DTYPE_t[:, :] out not None):
+    """Set out[i, j] = 1 if j == v[i, 0] else 0."""
+    cdef Py_ssize_t i, j, k
+    with nogil:
+        for i in range(out.shape[0]):
+            k = <Py_ssize_t>v[i, 0]
+            for j in range(out.shape[1]):
+                out[i, j] = 1. if j == k else 0.
+
+
+# --------------------------- Elementwise routines -------------------------- #
+# Fused elementwise operations that would otherwise need a temporary array
+# in numpy. All of them work on (possibly strided) 2D views. Every element of
+# the inputs is read before the corresponding element of the output is
+# written, so the output may alias any of the inputs.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def mult_add(const DTYPE_t[:, :] a not None, const DTYPE_t[:, :] b not None,
+             DTYPE_t[:, :] out not None):
+    """Compute out += a * b."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] += a[i, j] * b[i, j]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def scale_add(double s, const DTYPE_t[:, :] a not None,
+              DTYPE_t[:, :] out not None):
+    """Compute out += s * a."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] += <DTYPE_t>(s * a[i, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def add_if(const DTYPE_t[:, :] a not None, const DTYPE_t[:, :] cond not None,
+           DTYPE_t[:, :] out not None):
+    """Compute out += a wherever cond != 0."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                if cond[i, j] != 0:
+                    out[i, j] += a[i, j]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def copy_if(const DTYPE_t[:, :] src not None,
+            const DTYPE_t[:, :] cond not None,
+            DTYPE_t[:, :] dest not None):
+    """Set dest = src wherever cond != 0."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(dest.shape[0]):
+            for j in range(dest.shape[1]):
+                if cond[i, j] != 0:
+                    dest[i, j] = src[i, j]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fill_if(double val, const DTYPE_t[:, :] cond not None,
+            DTYPE_t[:, :] mem not None):
+    """Set mem = val wherever cond != 0."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(mem.shape[0]):
+            for j in range(mem.shape[1]):
+                if cond[i, j] != 0:
+                    mem[i, j] = <DTYPE_t>val
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigmoid(const DTYPE_t[:, :] x not None, DTYPE_t[:, :] y not None):
+    """Compute the numerically stable logistic sigmoid y = 1 / (1 + e^-x)."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(y.shape[0]):
+            for j in range(y.shape[1]):
+                y[i, j] = _sigmoid(x[i, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigmoid_deriv(const DTYPE_t[:, :] y not None,
+                  const DTYPE_t[:, :] dy not None,
+                  DTYPE_t[:, :] dx not None):
+    """Compute dx = dy * y * (1 - y)."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(dx.shape[0]):
+            for j in range(dx.shape[1]):
+                dx[i, j] = dy[i, j] * y[i, j] * (1 - y[i, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tanh_deriv(const DTYPE_t[:, :] y not None,
+               const DTYPE_t[:, :] dy not None,
+               DTYPE_t[:, :] dx not None):
+    """Compute dx = dy * (1 - y * y)."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(dx.shape[0]):
+            for j in range(dx.shape[1]):
+                dx[i, j] = dy[i, j] * (1 - y[i, j] * y[i, j])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rel_deriv(const DTYPE_t[:, :] y not None,
+              const DTYPE_t[:, :] dy not None,
+              DTYPE_t[:, :] dx not None):
+    """Compute dx = dy * (y > 0)."""
+    cdef Py_ssize_t i, j
+    with nogil:
+        for i in range(dx.shape[0]):
+            for j in range(dx.shape[1]):
+                dx[i, j] = dy[i, j] if y[i, j] > 0 else 0
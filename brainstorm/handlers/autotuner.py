@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import division, print_function, unicode_literals
+
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import warnings
+from timeit import default_timer
+
+from brainstorm.utils import get_cache_dir
+
+
+class Autotuner(object):
+    """Picks the fastest of several implementations of an operation.
+
+    The first time a choice is requested for a key, every candidate is
+    benchmarked and the fastest one is remembered. Choices are kept in memory
+    and in a JSON file, where they are stored per host, so that the same
+    architecture is only tuned once per machine.
+
+    Args:
+        filename (Optional[str]):
+            The JSON file for storing the choices. Defaults to
+            ``autotune.json`` in :func:`brainstorm.utils.get_cache_dir`.
+            Pass False to only keep the choices in memory.
+        repetitions (Optional[int]):
+            How often each candidate is timed. The fastest run counts.
+            Defaults to 3.
+    """
+
+    def __init__(self, filename=None, repetitions=3):
+        if filename is None:
+            filename = os.path.join(get_cache_dir(), 'autotune.json')
+        self.filename = filename
+        self.repetitions = repetitions
+        self.host = get_host_key()
+        self.choices = self._load().get(self.host, {})
+        self._lock = threading.Lock()
+
+    def choose(self, key, candidates, run):
+        """Return the fastest of the candidates for the given key.
+
+        Args:
+            key (str):
+                Describes the operation and everything its speed depends on,
+                e.g. the array shapes.
+            candidates (list[dict]):
+                The settings to choose from. They have to be JSON
+                serializable.
+            run (callable):
+                Executes the operation once with the candidate settings
+                passed as keyword arguments.
+
+        Returns:
+            dict: The fastest candidate.
+        """
+        if key not in self.choices:
+            # benchmarks of concurrently running layers would disturb
+            # each other, so only one candidate is timed at a time
+            with self._lock:
+                if key not in self.choices:
+                    self.choices[key] = min(
+                        candidates, key=lambda c: self._measure(run, c))
+                    self._save(key)
+        return self.choices[key]
+
+    def _measure(self, run, candidate):
+        run(**candidate)  # warm up, e.g. allocate workspaces
+        times = []
+        for _ in range(self.repetitions):
+            start = default_timer()
+            run(**candidate)
+            times.append(default_timer() - start)
+        return min(times)
+
+    def _load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            warnings.warn('Ignoring the unreadable autotuning cache {}: {}'
+                          .format(self.filename, e))
+            return {}
+
+    def _save(self, key):
+        if not self.filename:
+            return
+        # merge with the file to keep choices made by other processes
+        cache = self._load()
+        cache.setdefault(self.host, {})[key] = self.choices[key]
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # write to a temporary file first, so readers never see a
+            # partially written cache
+            fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.rename(tmp_name, self.filename)
+        except (IOError, OSError) as e:
+            warnings.warn('Could not write the autotuning cache {}: {}'
+                          .format(self.filename, e))
+
+
+def get_host_key():
+    """Identify the machine for which a tuning choice was made."""
+    return '{}/{}/{}cpu'.format(platform.node(), platform.machine(),
+                                multiprocessing.cpu_count())
+
+
+def get_thread_counts(num_threads):
+    """Return the thread counts worth trying on this machine: powers of two
+    up to the number of CPUs and the given default."""
+    counts = {num_threads}
+    count = 1
+    while count <= multiprocessing.cpu_count():
+        counts.add(count)
+        count *= 2
+    return sorted(counts)
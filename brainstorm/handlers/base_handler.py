@@ -3,6 +3,8 @@
 from __future__ import division, print_function, unicode_literals
 
 import abc
+import threading
+from collections import OrderedDict
 
 import six
 
@@ -33,12 +35,24 @@ class Handler(Describable):
       EMPTY: An empty array matching this handler's type.
       rnd: A random state maintained by this handler.
       array_type: The type of array object that this handler works with.
+      max_scratch_size: Maximum number of elements that the scratch pool
+        keeps around for reuse (see :meth:`allocate_scratch`).
     """
 
     __undescribed__ = {'inplace_act_func', 'inplace_act_func_deriv',
-                       'act_func', 'act_func_deriv'}
+                       'act_func', 'act_func_deriv', 'max_scratch_size',
+                       '_scratch_in_use', '_scratch_free',
+                       '_scratch_free_size', '_scratch_lock'}
 
     def __init__(self):
+        self.max_scratch_size = 2 ** 26
+        # scratch memory is handed out per thread, so that layers running
+        # concurrently only release their own scratch memory
+        self._scratch_lock = threading.Lock()
+        self._scratch_in_use = {}
+        self._scratch_free = OrderedDict()
+        self._scratch_free_size = 0
+
         self.inplace_act_func = {
             'sigmoid': lambda x: self.sigmoid(x, x),
             'rel': lambda x: self.rel(x, x),
@@ -105,6 +119,75 @@ class Handler(Describable):
             object: New array with given shape filled with zeros.
         """
 
+    def allocate_activations(self, shape):
+        """Allocate memory for activations, internals and deltas.
+
+        By default this is the same as :meth:`allocate`, but mixed-precision
+        handlers store these in a smaller dtype than the parameters and
+        gradients.
+
+        Args:
+            shape (tuple[int]): Shape of the array.
+
+        Returns:
+            object: New array with given shape.
+        """
+        return self.allocate(shape)
+
+    def allocate_scratch(self, shape):
+        """Get temporary memory with given shape and arbitrary content.
+
+        Scratch memory is taken from a pool that is keyed by shape, so that
+        temporaries of the same shape are reused instead of being allocated
+        anew for every pass. All scratch memory handed out is only valid
+        until the next call to :meth:`release_scratch` from the same
+        thread, which the network does after every forward and backward pass
+        of a layer.
+
+        Args:
+            shape (tuple[int]): Shape of the array.
+
+        Returns:
+            object: An array with given shape.
+        """
+        shape = tuple(shape)
+        with self._scratch_lock:
+            free = self._scratch_free.get(shape)
+            mem = free.pop() if free else None
+            if mem is not None:
+                self._scratch_free_size -= mem.size
+                if not free:
+                    del self._scratch_free[shape]
+        if mem is None:
+            mem = self.allocate(shape)
+        thread = threading.current_thread().ident
+        self._scratch_in_use.setdefault(thread, []).append(mem)
+        return mem
+
+    def release_scratch(self):
+        """Return all scratch memory of the calling thread to the pool.
+
+        Afterwards the pool is trimmed to at most :attr:`max_scratch_size`
+        elements by evicting the least recently used shapes.
+        """
+        in_use = self._scratch_in_use.pop(threading.current_thread().ident,
+                                          [])
+        with self._scratch_lock:
+            for mem in in_use:
+                shape = tuple(mem.shape)
+                # re-insert to mark this shape as the most recently used one
+                free = self._scratch_free.pop(shape, [])
+                free.append(mem)
+                self._scratch_free[shape] = free
+                self._scratch_free_size += mem.size
+
+            while self._scratch_free_size > self.max_scratch_size:
+                shape, free = next(iter(self._scratch_free.items()))
+                mem = free.pop()
+                self._scratch_free_size -= mem.size
+                if not free:
+                    del self._scratch_free[shape]
+
     # ---------------------------- Copy and Fill ---------------------------- #
 
     @abc.abstractmethod
@@ -387,7 +470,7 @@ class Handler(Describable):
     @abc.abstractmethod
     def conv2d_backward_batch(self, inputs, weights, padding, stride,
                               in_deltas, out_deltas, weight_deltas,
-                              bias_deltas):
+                              bias_deltas, algorithm='im2col'):
         """Computes the gradients for a 2D convolution on a batch of images.
 
         Args:
@@ -395,17 +478,25 @@ class Handler(Describable):
             weights (array_type):
             padding (int):
             stride (tuple[int]):
-            in_deltas (array_type):
+            in_deltas (array_type | None):
+                The deltas of the inputs are added to this array. If None,
+                they are not computed.
             out_deltas (array_type):
-            weight_deltas (array_type):
-            bias_deltas (array_type):
+            weight_deltas (array_type | None):
+                Is overwritten with the gradients of the weights. If None,
+                they are not computed.
+            bias_deltas (array_type | None):
+                Is overwritten with the gradients of the bias. If None,
+                they are not computed.
+            algorithm (Optional[str]):
+                See :meth:`conv2d_forward_batch`.
         Returns:
             None
         """
 
     @abc.abstractmethod
     def conv2d_forward_batch(self, inputs, weights, bias, outputs,
-                             padding, stride):
+                             padding, stride, algorithm='im2col'):
         """Performs a 2D convolution on a batch of images.
 
         Args:
@@ -415,6 +506,11 @@ class Handler(Describable):
             outputs (array_type):
             padding (int):
             stride (tuple[int]):
+            algorithm (Optional[str]):
+                The convolution algorithm: 'im2col' (the default), 'winograd'
+                (only for 3x3 kernels with stride 1), 'fft' or 'auto', which
+                lets the handler pick the fastest one. Handlers fall back to
+                their default for algorithms they don't implement.
         Returns:
             None
         """
@@ -552,6 +648,69 @@ class Handler(Describable):
             None
         """
 
+    @abc.abstractmethod
+    def lstm_backward_step(self, act_gates, peepholes, cell_prev, act_cell,
+                           out_deltas, next_gate_deltas, next_act_gates,
+                           next_cell_deltas, gate_deltas, cell_deltas,
+                           activation):
+        """Backward pass of a fused LSTM cell update for one time step.
+
+        This is the adjoint of :meth:`lstm_forward_step`. The gates are
+        stacked in the order (block input, input gate, forget gate,
+        output gate) along the last axis.
+
+        Args:
+            act_gates (array_type): Stacked gate activations with shape
+                                    (batch_size, 4 * size).
+            peepholes (array_type): Stacked peephole weights with shape
+                                    (3, size).
+            cell_prev (array_type): Cell state of the previous time step.
+            act_cell (array_type): Activated cell state.
+            out_deltas (array_type): Total deltas of the block output.
+            next_gate_deltas (array_type): Stacked gate deltas of the next
+                                           time step.
+            next_act_gates (array_type): Stacked gate activations of the
+                                         next time step.
+            next_cell_deltas (array_type): Cell deltas of the next time step.
+            gate_deltas (array_type): Array into which the stacked gate
+                                      deltas are placed.
+            cell_deltas (array_type): Array into which the cell deltas are
+                                      placed.
+            activation (str): Name of the block input and output activation
+                              function.
+        Returns:
+            None
+        """
+
+    @abc.abstractmethod
+    def lstm_forward_step(self, gates, act_gates, peepholes, cell_prev, cell,
+                          act_cell, out, activation):
+        """Fused LSTM cell update for one time step.
+
+        The gates are stacked in the order (block input, input gate,
+        forget gate, output gate) along the last axis. The peephole
+        contributions are added to the pre-activations in place.
+
+        Args:
+            gates (array_type): Stacked gate pre-activations with shape
+                                (batch_size, 4 * size). Must already
+                                contain the input and recurrent projections
+                                and the biases.
+            act_gates (array_type): Array into which the stacked gate
+                                    activations are placed.
+            peepholes (array_type): Stacked peephole weights with shape
+                                    (3, size).
+            cell_prev (array_type): Cell state of the previous time step.
+            cell (array_type): Array into which the cell state is placed.
+            act_cell (array_type): Array into which the activated cell state
+                                   is placed.
+            out (array_type): Array into which the block output is placed.
+            activation (str): Name of the block input and output activation
+                              function.
+        Returns:
+            None
+        """
+
     @abc.abstractmethod
     def merge_tt(self, a, b, out):
         """Merge arrays a and b along their last axis.
@@ -872,3 +1031,126 @@ class Handler(Describable):
         Returns:
             None
         """
+
+    # --------------------------- Loss functions ---------------------------- #
+    # These fused operations have default implementations in terms of the
+    # operations above, which handlers can override with faster kernels.
+
+    def binomial_ce_backward(self, y, t, loss_deltas, in_deltas):
+        """Backpropagate through the binomial cross entropy.
+
+        Adds `loss_deltas[i, 0] * (y - t) / clip(y - y², 1e-6, 1)` to the
+        deltas of the inputs.
+
+        Args:
+            y (array_type): Matrix of predicted probabilities.
+            t (array_type): Matrix of binary targets with the same shape.
+            loss_deltas (array_type): Column vector of deltas with respect to
+                                      the loss of each row.
+            in_deltas (array_type): Matrix to which the deltas with respect
+                                    to :attr:`y` are added.
+        Returns:
+            None
+        """
+        deltas = self.allocate_scratch(y.shape)
+        tmp = self.allocate_scratch(y.shape)
+        self.mult_tt(y, y, deltas)
+        self.subtract_tt(y, deltas, deltas)
+        self.clip_t(deltas, 1e-6, 1.0, deltas)
+        self.subtract_tt(y, t, tmp)
+        self.divide_tt(tmp, deltas, deltas)
+        self.mult_add_mv(deltas, loss_deltas, in_deltas)
+
+    def binomial_ce_forward(self, y, t, loss):
+        """Compute the binomial cross entropy of each row.
+
+        `loss[i, 0] = -sum_j(t * ln(y) + (1 - t) * ln(1 - y))`, where the
+        arguments of the logarithms are clipped to [1e-6, 1].
+
+        Args:
+            y (array_type): Matrix of predicted probabilities.
+            t (array_type): Matrix of binary targets with the same shape.
+            loss (array_type): Column vector into which the loss of each row
+                               is placed.
+        Returns:
+            None
+        """
+        cee = self.allocate_scratch(y.shape)
+        tmp = self.allocate_scratch(y.shape)
+        self.fill(tmp, 1.0)
+        self.subtract_tt(tmp, y, cee)  # cee = 1-y
+        self.subtract_tt(tmp, t, tmp)  # tmp = 1-t
+        self.clip_t(cee, 1e-6, 1.0, cee)
+        self.log_t(cee, cee)  # cee = ln(1-y)
+        self.mult_tt(tmp, cee, tmp)  # tmp = (1-t) * ln(1-y)
+        self.clip_t(y, 1e-6, 1.0, cee)
+        self.log_t(cee, cee)  # cee = ln(y)
+        self.mult_tt(t, cee, cee)  # cee = t * ln(y)
+        self.add_tt(tmp, cee, cee)
+        self.sum_t(cee, axis=1, out=loss)
+        self.mult_st(-1, loss, loss)
+
+    def sigmoid_ce_backward(self, y, t, loss_deltas, in_deltas):
+        """Backpropagate through a sigmoid and the binomial cross entropy.
+
+        Adds `loss_deltas[i, 0] * (y - t)` to the deltas of the inputs of the
+        sigmoid.
+
+        Args:
+            y (array_type): Matrix of outputs of the sigmoid.
+            t (array_type): Matrix of binary targets with the same shape.
+            loss_deltas (array_type): Column vector of deltas with respect to
+                                      the loss of each row.
+            in_deltas (array_type): Matrix to which the deltas with respect
+                                    to the inputs of the sigmoid are added.
+        Returns:
+            None
+        """
+        deltas = self.allocate_scratch(y.shape)
+        self.subtract_tt(y, t, deltas)
+        self.mult_add_mv(deltas, loss_deltas, in_deltas)
+
+    def softmax_ce_backward(self, probabilities, targets, loss_deltas,
+                            in_deltas):
+        """Backpropagate through a softmax and the multinomial cross entropy.
+
+        Adds `loss_deltas[i, 0] * (probabilities - one_hot(targets))` to the
+        deltas of the inputs of the softmax.
+
+        Args:
+            probabilities (array_type): Matrix of outputs of the softmax.
+            targets (array_type): Column vector of class indices.
+            loss_deltas (array_type): Column vector of deltas with respect to
+                                      the loss of each row.
+            in_deltas (array_type): Matrix to which the deltas with respect
+                                    to the inputs of the softmax are added.
+        Returns:
+            None
+        """
+        deltas = self.allocate_scratch(probabilities.shape)
+        self.binarize_v(targets, deltas)
+        self.subtract_tt(probabilities, deltas, deltas)
+        self.mult_add_mv(deltas, loss_deltas, in_deltas)
+
+    def softmax_ce_forward(self, m, targets, probabilities, loss):
+        """Compute a softmax and its multinomial cross entropy.
+
+        Computes the softmax over the rows of :attr:`m` and
+        `loss[i, 0] = -ln(probabilities[i, targets[i, 0]])`, where the
+        argument of the logarithm is clipped to [1e-6, 1].
+
+        Args:
+            m (array_type): Input matrix.
+            targets (array_type): Column vector of class indices.
+            probabilities (array_type): Matrix into which the softmax of
+                                        :attr:`m` is placed.
+            loss (array_type): Column vector into which the loss of each row
+                               is placed.
+        Returns:
+            None
+        """
+        self.softmax_m(m, probabilities)
+        self.index_m_by_v(probabilities, targets, loss)
+        self.clip_t(loss, 1e-6, 1.0, loss)
+        self.log_t(loss, loss)
+        self.mult_st(-1, loss, loss)
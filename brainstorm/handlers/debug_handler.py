@@ -2,9 +2,12 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
 
+import threading
+
 import numpy as np
 
 from brainstorm.handlers.base_handler import Handler
+from brainstorm.utils import find_calling_layer_pass
 
 
 # ############################## Debug Array ################################ #
@@ -35,22 +38,41 @@ class DebugArray(object):
         return DebugArray(arr=self.array.reshape(new_shape))
 
 
-def _check_for_inf(handler, arg, name):
+def _check_for_inf(handler, arg, name, location=''):
     if isinstance(arg, (int, float)) and not np.isfinite(arg):
-        raise ValueError('NaN or Inf encountered in "{}" argument'
-                         .format(name))
+        raise ValueError('NaN or Inf encountered in "{}" argument{}'
+                         .format(name, location))
     if isinstance(arg, DebugArray) and not handler.is_fully_finite(arg):
-        raise ValueError('NaN or Inf encountered in "{}"'.format(name))
+        raise ValueError('NaN or Inf encountered in "{}"{}'
+                         .format(name, location))
+
+
+def _check_arguments(handler, args, kwargs):
+    for i, arg in enumerate(args, start=1):
+        _check_for_inf(handler, arg, '{}.'.format(i))
+    for n, v in kwargs.items():
+        _check_for_inf(handler, v, n)
+
+
+def _get_non_finite_arguments(handler, args, kwargs):
+    arguments = [('{}.'.format(i), arg) for i, arg in enumerate(args, start=1)]
+    arguments += list(kwargs.items())
+    return {n for n, arg in arguments
+            if isinstance(arg, DebugArray) and not handler.is_fully_finite(arg)}
+
+
+def _format_location(layer, pass_, *args):
+    if layer is None:
+        return ''
+    return ' in the {} pass of layer "{}"'.format(pass_, layer.name)
 
 
 def check_for_inf_or_nan(f):
     def checked_f(*args, **kwargs):
+        if args[0].is_replaying():
+            return args[0].replay_operation(f, args, kwargs)
         result = f(*args, **kwargs)
-        handler = args[0]
-        for i, arg in enumerate(args, start=1):
-            _check_for_inf(handler, arg, '{}.'.format(i))
-        for n, v in kwargs.items():
-            _check_for_inf(handler, v, n)
+        args[0].check_operation(f.__name__, args, kwargs)
         return result
 
     return checked_f
@@ -59,16 +81,151 @@ def check_for_inf_or_nan(f):
 # ############################# Debug Handler ############################### #
 
 class DebugHandler(Handler):
-    __undescribed__ = {'EMPTY', 'array_type'}
-
-    def __init__(self, handler):
+    """Handler wrapper that checks the arguments of all operations.
+
+    Every operation asserts that its arguments have the right types and
+    shapes. By default all arrays are also checked for NaN or Inf values
+    after every operation, which is slow. The cheaper checking modes below
+    can be combined. Whenever NaN or Inf is found, the error names the
+    operation and the layer pass in which it occurred.
+
+    Note:
+        The layers are found by inspecting the call stack, which doesn't
+        work for operations replayed from execution plans.
+
+    Args:
+        handler (brainstorm.handlers.base_handler.Handler):
+            The handler that actually executes the operations.
+        check_every (Optional[int]):
+            Only check the arguments of every Nth operation.
+            Defaults to 1.
+        layers (Optional[list[str]]):
+            Only check the operations issued by the layers with these names.
+            Defaults to None, which means all operations.
+        layer_boundaries (Optional[bool]):
+            Instead of checking operations, check the outputs after every
+            forward pass and the input deltas and gradients after every
+            backward pass of a layer. If NaN or Inf is found, the pass is
+            replayed with every operation checked to report the one that
+            produced the non-finite values. Defaults to False.
+    """
+    __undescribed__ = {'EMPTY', 'array_type', '_num_operations',
+                       '_layer_passes', '_replayed_passes'}
+
+    def __init__(self, handler, check_every=1, layers=None,
+                 layer_boundaries=False):
         super(DebugHandler, self).__init__()
         self.handler = handler
+        self.check_every = check_every
+        self.layers = None if layers is None else sorted(layers)
+        self.layer_boundaries = layer_boundaries
         self.EMPTY = DebugArray(arr=handler.EMPTY)
         self.array_type = DebugArray
+        self._num_operations = 0
+        # the current and the replayed layer pass per thread, since layers
+        # might run concurrently
+        self._layer_passes = {}
+        self._replayed_passes = {}
 
     def __init_from_description__(self, description):
-        self.__init__(self.handler)
+        self.__init__(self.handler, self.check_every, self.layers,
+                      self.layer_boundaries)
+
+    def check_operation(self, name, args, kwargs):
+        """Check the arguments of an operation for NaN or Inf, depending on
+        the checking mode."""
+        if self.layers is not None or self.layer_boundaries:
+            layer = self._get_layer_pass()[0]
+            if self.layers is not None and (layer is None or
+                                            layer.name not in self.layers):
+                return
+            if self.layer_boundaries:
+                return
+        self._num_operations += 1
+        if self._num_operations % self.check_every == 0:
+            try:
+                _check_arguments(self, args[1:], kwargs)
+            except ValueError as e:
+                # not using the cached layer pass, since layers might also
+                # be run without a network that releases the scratch memory
+                raise ValueError('{} of {}{}'.format(
+                    e, name, _format_location(*find_calling_layer_pass())))
+
+    def _get_layer_pass(self):
+        # a layer pass lasts until the network releases the scratch memory,
+        # so the call stack only has to be inspected once per pass
+        thread = threading.current_thread().ident
+        if thread not in self._layer_passes:
+            layer_pass = find_calling_layer_pass()
+            if layer_pass[0] is None:
+                return layer_pass
+            self._layer_passes[thread] = layer_pass
+        return self._layer_passes[thread]
+
+    def _check_layer_boundary(self, layer_pass):
+        layer, pass_, buffers = layer_pass[:3]
+        if self.layers is not None and layer.name not in self.layers:
+            return
+        if pass_ == 'forward':
+            checked = [('outputs.' + n, a) for n, a in buffers.outputs.items()]
+        else:
+            checked = [('input_deltas.' + n, a)
+                       for n, a in buffers.input_deltas.items()]
+            checked += [('gradients.' + n, a)
+                        for n, a in buffers.gradients.items()]
+        if all(self.is_fully_finite(a) for n, a in checked):
+            return
+
+        self._replay_layer_pass(layer_pass)
+        # the replay didn't find the operation
+        location = _format_location(layer, pass_)
+        for n, a in checked:
+            _check_for_inf(self, a, n, location)
+
+    def _replay_layer_pass(self, layer_pass):
+        """Run a layer pass again with every operation checked.
+
+        The arguments of the operations of the original pass have been
+        overwritten by later operations in the meantime, so they can't tell
+        which operation produced the non-finite values.
+        """
+        layer, pass_, buffers, training_pass = layer_pass
+        if pass_ == 'forward':
+            written = [buffers.outputs, buffers.internals]
+        else:
+            written = [buffers.input_deltas, buffers.gradients,
+                       buffers.output_deltas, buffers.internals]
+        # the buffers the pass accumulates into would otherwise already
+        # contain the non-finite values before the replay gets there
+        for a in [a for b in written for a in b.values()]:
+            if not self.is_fully_finite(a):
+                self.handler.fill(a.array, 0.0)
+        thread = threading.current_thread().ident
+        self._replayed_passes[thread] = _format_location(layer, pass_)
+        try:
+            if pass_ == 'forward':
+                layer.forward_pass(buffers, training_pass)
+            else:
+                layer.backward_pass(buffers)
+        finally:
+            del self._replayed_passes[thread]
+
+    def is_replaying(self):
+        return threading.current_thread().ident in self._replayed_passes
+
+    def replay_operation(self, f, args, kwargs):
+        """Run an operation of a replayed layer pass and raise if it turns
+        any of its arguments non-finite."""
+        non_finite = _get_non_finite_arguments(self, args[1:], kwargs)
+        result = f(*args, **kwargs)
+        if _get_non_finite_arguments(self, args[1:], kwargs) - non_finite:
+            try:
+                _check_arguments(self, args[1:], kwargs)
+            except ValueError as e:
+                raise ValueError('{} of {}{}'.format(
+                    e, f.__name__,
+                    self._replayed_passes[threading.current_thread().ident]))
+        return result
 
     # ------------------------- Allocate new memory ------------------------- #
 
@@ -76,6 +233,18 @@ class DebugHandler(Handler):
         assert_is_shape(shape)
         return DebugArray(self.handler.allocate(shape))
 
+    def allocate_activations(self, shape):
+        assert_is_shape(shape)
+        return DebugArray(self.handler.allocate_activations(shape))
+
+    def release_scratch(self):
+        # the network releases the scratch memory after every layer pass
+        thread = threading.current_thread().ident
+        layer_pass = self._layer_passes.pop(thread, None)
+        if layer_pass is not None and self.layer_boundaries:
+            self._check_layer_boundary(layer_pass)
+        super(DebugHandler, self).release_scratch()
+
     def ones(self, shape):
         assert_is_shape(shape)
         return DebugArray(self.handler.ones(shape))
@@ -233,9 +402,14 @@ class DebugHandler(Handler):
     @check_for_inf_or_nan
     def conv2d_backward_batch(self, inputs, weights, padding, stride,
                               in_deltas, out_deltas, weight_deltas,
-                              bias_deltas):
-        assert_debug_arrays(inputs, weights, in_deltas, out_deltas,
-                            weight_deltas, bias_deltas)
+                              bias_deltas, algorithm='im2col'):
+        assert_debug_arrays(inputs, weights, out_deltas)
+        # the deltas that are not needed can be None
+        optional = (in_deltas, weight_deltas, bias_deltas)
+        assert_debug_arrays(*[d for d in optional if d is not None])
+        in_deltas, weight_deltas, bias_deltas = [
+            None if d is None else d.array for d in optional]
+        assert_conv_algorithm(algorithm, weights, stride)
         assert isinstance(padding, int) and 0 <= padding, \
             "invalid padding {}".format(padding)
         assert_is_shape(stride)
@@ -243,15 +417,15 @@ class DebugHandler(Handler):
         # TODO: check shapes of inputs, weights, in_deltas, out_deltas,
         # TODO: weight_deltas, bias_deltas
         self.handler.conv2d_backward_batch(inputs.array, weights.array,
-                                           padding, stride, in_deltas.array,
-                                           out_deltas.array,
-                                           weight_deltas.array,
-                                           bias_deltas.array)
+                                           padding, stride, in_deltas,
+                                           out_deltas.array, weight_deltas,
+                                           bias_deltas, algorithm)
 
     @check_for_inf_or_nan
     def conv2d_forward_batch(self, inputs, weights, bias, outputs,
-                             padding, stride):
+                             padding, stride, algorithm='im2col'):
         assert_debug_arrays(inputs, weights, bias, outputs)
+        assert_conv_algorithm(algorithm, weights, stride)
         assert isinstance(padding, int) and 0 <= padding, \
             "invalid padding {}".format(padding)
         assert_is_shape(stride)
@@ -259,7 +433,7 @@ class DebugHandler(Handler):
         # TODO check shapes of inputs, weights, bias, and outputs
         self.handler.conv2d_forward_batch(inputs.array, weights.array,
                                           bias.array, outputs.array,
-                                          padding, stride)
+                                          padding, stride, algorithm)
 
     @check_for_inf_or_nan
     def dot_add_mm(self, a, b, out, transa=False, transb=False):
@@ -342,6 +516,42 @@ class DebugHandler(Handler):
         assert_shapes_equal(a, out)
         self.handler.log_t(a.array, out.array)
 
+    @check_for_inf_or_nan
+    def lstm_backward_step(self, act_gates, peepholes, cell_prev, act_cell,
+                           out_deltas, next_gate_deltas, next_act_gates,
+                           next_cell_deltas, gate_deltas, cell_deltas,
+                           activation):
+        assert_debug_arrays(act_gates, peepholes, cell_prev, act_cell,
+                            out_deltas, next_gate_deltas, next_act_gates,
+                            next_cell_deltas, gate_deltas, cell_deltas)
+        assert_shapes_equal(cell_prev, act_cell, out_deltas,
+                            next_cell_deltas, cell_deltas)
+        assert_shapes_equal(act_gates, next_gate_deltas, next_act_gates,
+                            gate_deltas)
+        assert_lstm_shapes(act_gates, peepholes, cell_prev)
+        assert activation in self.act_func, \
+            "unknown activation {}".format(activation)
+        self.handler.lstm_backward_step(
+            act_gates.array, peepholes.array, cell_prev.array, act_cell.array,
+            out_deltas.array, next_gate_deltas.array, next_act_gates.array,
+            next_cell_deltas.array, gate_deltas.array, cell_deltas.array,
+            activation)
+
+    @check_for_inf_or_nan
+    def lstm_forward_step(self, gates, act_gates, peepholes, cell_prev, cell,
+                          act_cell, out, activation):
+        assert_debug_arrays(gates, act_gates, peepholes, cell_prev, cell,
+                            act_cell, out)
+        assert_shapes_equal(cell_prev, cell, act_cell, out)
+        assert_shapes_equal(gates, act_gates)
+        assert_lstm_shapes(gates, peepholes, cell_prev)
+        assert activation in self.act_func, \
+            "unknown activation {}".format(activation)
+        self.handler.lstm_forward_step(gates.array, act_gates.array,
+                                       peepholes.array, cell_prev.array,
+                                       cell.array, act_cell.array, out.array,
+                                       activation)
+
     @check_for_inf_or_nan
     def maxpool2d_backward_batch(self, inputs, window, outputs, padding,
                                  stride, argmax, in_deltas, out_deltas):
@@ -531,6 +741,52 @@ class DebugHandler(Handler):
         assert len(m.shape) == 2, "len({}) != 2".format(m.shape)
         self.handler.softmax_m(m.array, out.array)
 
+    # --------------------------- Loss functions ---------------------------- #
+
+    @check_for_inf_or_nan
+    def binomial_ce_backward(self, y, t, loss_deltas, in_deltas):
+        assert_debug_arrays(y, t, loss_deltas, in_deltas)
+        assert_shapes_equal(y, t, in_deltas)
+        assert_loss_shapes(y, loss_deltas)
+        self.handler.binomial_ce_backward(y.array, t.array, loss_deltas.array,
+                                          in_deltas.array)
+
+    @check_for_inf_or_nan
+    def binomial_ce_forward(self, y, t, loss):
+        assert_debug_arrays(y, t, loss)
+        assert_shapes_equal(y, t)
+        assert_loss_shapes(y, loss)
+        self.handler.binomial_ce_forward(y.array, t.array, loss.array)
+
+    @check_for_inf_or_nan
+    def sigmoid_ce_backward(self, y, t, loss_deltas, in_deltas):
+        assert_debug_arrays(y, t, loss_deltas, in_deltas)
+        assert_shapes_equal(y, t, in_deltas)
+        assert_loss_shapes(y, loss_deltas)
+        self.handler.sigmoid_ce_backward(y.array, t.array, loss_deltas.array,
+                                         in_deltas.array)
+
+    @check_for_inf_or_nan
+    def softmax_ce_backward(self, probabilities, targets, loss_deltas,
+                            in_deltas):
+        assert_debug_arrays(probabilities, targets, loss_deltas, in_deltas)
+        assert_shapes_equal(probabilities, in_deltas)
+        assert_shapes_equal(targets, loss_deltas)
+        assert_loss_shapes(probabilities, targets)
+        assert_class_indices(self.handler, targets, probabilities.shape[1])
+        self.handler.softmax_ce_backward(probabilities.array, targets.array,
+                                         loss_deltas.array, in_deltas.array)
+
+    @check_for_inf_or_nan
+    def softmax_ce_forward(self, m, targets, probabilities, loss):
+        assert_debug_arrays(m, targets, probabilities, loss)
+        assert_shapes_equal(m, probabilities)
+        assert_shapes_equal(targets, loss)
+        assert_loss_shapes(m, targets)
+        assert_class_indices(self.handler, targets, m.shape[1])
+        self.handler.softmax_ce_forward(m.array, targets.array,
+                                        probabilities.array, loss.array)
+
 
 # ############################ Helper Methods ############################### #
 
@@ -563,3 +819,32 @@ def assert_shapes_equal(ref_shape, *shapes):
 def assert_is_scalar(s):
     assert isinstance(s, (int, float)), \
         "{} is not a scalar but a {}".format(s, type(s))
+
+
+def assert_lstm_shapes(gates, peepholes, cell):
+    batch_size, size = cell.shape
+    assert gates.shape == (batch_size, 4 * size), \
+        "{} != {}".format(gates.shape, (batch_size, 4 * size))
+    assert peepholes.shape == (3, size), \
+        "{} != {}".format(peepholes.shape, (3, size))
+
+
+def assert_loss_shapes(m, v):
+    assert len(m.shape) == 2, "len({}) != 2".format(m.shape)
+    assert v.shape == (m.shape[0], 1), \
+        "{} != {}".format(v.shape, (m.shape[0], 1))
+
+
+def assert_class_indices(handler, v, nr_classes):
+    v = handler.get_numpy_copy(v.array)
+    assert v.size == 0 or (v.min() >= 0 and int(v.max()) < nr_classes), \
+        "class indices out of range [0, {})".format(nr_classes)
+
+
+def assert_conv_algorithm(algorithm, weights, stride):
+    assert algorithm in ('im2col', 'winograd', 'fft', 'auto'), \
+        "unknown convolution algorithm {}".format(algorithm)
+    if algorithm == 'winograd':
+        assert weights.shape[1:3] == (3, 3) and tuple(stride) == (1, 1), \
+            "winograd needs 3x3 kernels and stride 1 but got {} and {}" \
+            .format(weights.shape[1:3], stride)
@@ -2,40 +2,119 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
 
+import threading
+
 import numpy as np
 
-import brainstorm.handlers._cpuop
+from brainstorm.handlers import _cpuop
+from brainstorm.handlers.autotuner import get_thread_counts
 from brainstorm.handlers.base_handler import Handler
 from brainstorm.randomness import global_rnd
 
+try:
+    from brainstorm.handlers import _blas
+except ImportError:  # built without scipy
+    _blas = None
+
+# per-thread buffers for the products of _gemm without BLAS and for the
+# operands converted to the compute dtype
+_workspace = threading.local()
+
+# codes of the activation functions used by the fused Cython kernels
+_ACTIVATION_CODES = {'linear': 0, 'sigmoid': 1, 'tanh': 2, 'rel': 3}
+
+# the positions of the arguments that the Cython kernels write to, mapped to
+# whether the kernel also reads them (i.e. adds to them)
+_KERNEL_OUTPUTS = {
+    'avgpool_backward': {5: True},
+    'avgpool_forward': {2: False},
+    'binarize_v': {1: False},
+    'binomial_ce_backward': {3: True},
+    'binomial_ce_forward': {2: False},
+    'col2im_batch': {9: True},
+    'im2col_batch': {9: False},
+    'index_m_by_v': {2: False},
+    'lstm_backward_step': {8: False, 9: False},
+    'lstm_forward_step': {0: True, 1: False, 4: False, 5: False, 6: False},
+    'maxpool_backward': {6: True},
+    'maxpool_forward': {2: False, 5: False},
+    'sigmoid_ce_backward': {3: True},
+    'softmax_ce_backward': {3: True},
+    'softmax_ce_forward': {2: False, 3: False},
+}
+
 
 # noinspection PyMethodMayBeStatic
 class NumpyHandler(Handler):
-    __undescribed__ = {'context', 'EMPTY', 'rnd'}
-
-    def __init__(self, dtype, seed=None):
+    """Handler that uses numpy arrays and runs on the CPU.
+
+    Args:
+        dtype (numpy.dtype):
+            Data type of all arrays allocated by this handler.
+        seed (Optional[int]):
+            Seed for the random state of this handler.
+        num_threads (Optional[int]):
+            Number of threads used by the parallel Cython kernels
+            (pooling, im2col and col2im). Defaults to 1.
+        conv_chunk_size (Optional[int]):
+            Number of images that the convolution lowers into a single
+            column matrix, which is then processed by one large GEMM.
+            Defaults to None, which means the whole minibatch.
+        activation_dtype (Optional[numpy.dtype]):
+            Data type of the activations, internals and deltas of a network,
+            e.g. float16 for mixed-precision training. Parameters, gradients
+            and buffers marked as full precision keep using `dtype`, and
+            matrix products accumulate in at least float32.
+            Defaults to None, which means `dtype`.
+        autotuner (Optional[brainstorm.handlers.autotuner.Autotuner]):
+            Benchmarks the implementations of the convolution and pooling
+            operations per shape and picks the fastest: the algorithm, chunk
+            size and thread count for convolutions with algorithm 'auto'
+            and the thread count for pooling. Defaults to None, which means
+            no tuning.
+    """
+    __undescribed__ = {'context', 'EMPTY', 'rnd', '_conv_workspace'}
+
+    def __init__(self, dtype, seed=None, num_threads=1, conv_chunk_size=None,
+                 activation_dtype=None, autotuner=None):
         super(NumpyHandler, self).__init__()
         self.dtype = dtype
+        self.activation_dtype = activation_dtype
+        self.num_threads = num_threads
+        self.conv_chunk_size = conv_chunk_size
+        self.autotuner = autotuner
         self.context = 'numpy'
         self.EMPTY = np.zeros(0)
         self.rnd = global_rnd.create_random_state(seed)
+        # one workspace per thread, since layers might run concurrently
+        self._conv_workspace = {}
 
     array_type = np.ndarray
 
     def __describe__(self):
-        return {
+        description = {
             '@type': self.__class__.__name__,
             'dtype': str(np.dtype(self.dtype))
         }
+        if self.activation_dtype is not None:
+            description['activation_dtype'] = str(
+                np.dtype(self.activation_dtype))
+        return description
 
     def __init_from_description__(self, description):
-        self.__init__(np.dtype(description['dtype']))
+        activation_dtype = description.get('activation_dtype')
+        self.__init__(np.dtype(description['dtype']),
+                      activation_dtype=activation_dtype and
+                      np.dtype(activation_dtype))
 
     # ------------------------- Allocate new memory ------------------------- #
 
     def allocate(self, size):
         return np.zeros(size, dtype=self.dtype)
 
+    def allocate_activations(self, shape):
+        return np.zeros(shape, dtype=self.activation_dtype or self.dtype)
+
     def ones(self, shape):
         return np.ones(shape=shape, dtype=self.dtype)
 
@@ -75,144 +154,342 @@ class NumpyHandler(Handler):
         np.abs(a, out=out)
 
     def add_into_if(self, a, out, cond):
-        out[cond != 0] += a[cond != 0]
+        views = _as_2d_views(a, cond, out)
+        if views is None:
+            out[cond != 0] += a[cond != 0]
+        else:
+            _cpuop.add_if(*views)
 
     def add_mv(self, m, v, out):
-        out[:] = m + v
+        np.add(m, v, out=out)
 
     def add_st(self, s, t, out):
-        out[:] = t + s
+        np.add(t, s, out=out)
 
     def add_tt(self, a, b, out):
-        out[:] = a + b
+        np.add(a, b, out=out)
 
     def avgpool2d_backward_batch(self, inputs, window, outputs, padding,
                                  stride, in_deltas, out_deltas):
-        brainstorm.handlers._cpuop.avgpool_backward(inputs, window, outputs, padding, stride,
-                                in_deltas, out_deltas)
+        num_threads = self._get_pool_threads('avg', inputs, window, outputs,
+                                             padding, stride)
+        self._call_kernel(_cpuop.avgpool_backward, inputs, window, outputs,
+                          padding, stride, in_deltas, out_deltas, num_threads)
 
     def avgpool2d_forward_batch(self, inputs, window, outputs, padding,
                                 stride):
-        brainstorm.handlers._cpuop.avgpool_forward(inputs, window, outputs, padding, stride)
+        num_threads = self._get_pool_threads('avg', inputs, window, outputs,
+                                             padding, stride)
+        self._call_kernel(_cpuop.avgpool_forward, inputs, window, outputs,
+                          padding, stride, num_threads)
 
     def binarize_v(self, v, out):
-        out[:] = 0.
-        for i in range(v.shape[0]):
-            out[i, int(v[i])] = 1.0
+        self._call_kernel(_cpuop.binarize_v, v, out)
 
     def broadcast_t(self, a, axis, out):
         assert (out.shape[:axis] + (1,) + out.shape[axis+1:]) == a.shape
-        out[:] = a[:]  # automatically does the right thing via broadcasting
+        np.copyto(out, a)  # automatically broadcasts
 
     def clip_t(self, a, a_min, a_max, out):
         np.clip(a, a_min, a_max, out)
 
     def conv2d_backward_batch(self, inputs, params, padding, stride,
-                              in_deltas, out_deltas, dparams, dbias):
+                              in_deltas, out_deltas, dparams, dbias,
+                              algorithm='im2col'):
+        config = self._get_conv_config(algorithm, inputs, params, padding,
+                                       stride)
+        self._conv2d_backward(inputs, params, padding, stride, in_deltas,
+                              out_deltas, dparams, dbias, **config)
+
+    def _conv2d_backward(self, inputs, params, padding, stride, in_deltas,
+                         out_deltas, dparams, dbias, algorithm, num_threads,
+                         chunk_size):
+        if algorithm == 'winograd':
+            _winograd_conv2d_backward(inputs, params, padding, in_deltas,
+                                      out_deltas, dparams, dbias)
+            return
+        if algorithm == 'fft':
+            _fft_conv2d_backward(inputs, params, padding, stride, in_deltas,
+                                 out_deltas, dparams, dbias)
+            return
+        self._im2col_conv2d_backward(inputs, params, padding, stride,
+                                     in_deltas, out_deltas, dparams, dbias,
+                                     num_threads, chunk_size)
+
+    def _im2col_conv2d_backward(self, inputs, params, padding, stride,
+                                in_deltas, out_deltas, dparams, dbias,
+                                num_threads, chunk_size):
         num_filters = params.shape[0]
-        num_images, input_rows, input_cols, num_input_maps = inputs.shape
+        num_images = inputs.shape[0]
         kernel_shape = params.shape[1:]
         num_output_pixels = out_deltas.shape[1] * out_deltas.shape[2]
-        num_kernel_params = np.prod(kernel_shape)
+        num_kernel_params = int(np.prod(kernel_shape))
 
-        dparams.fill(0.0)
-        dbias.fill(0.0)
-        col = np.zeros((num_output_pixels, num_kernel_params),
-                       dtype=self.dtype)
+        if dparams is not None:
+            dparams.fill(0.0)
+            reshaped_dparams = dparams.reshape(num_filters, num_kernel_params)
+        if dbias is not None:
+            dbias.fill(0.0)
+        reshaped_params = params.reshape((num_filters, num_kernel_params))
 
-        for i in range(num_images):
-            brainstorm.handlers._cpuop.im2col(inputs[i].reshape(inputs[i].size),
-                          input_rows, input_cols, num_input_maps,
-                          kernel_shape[0], kernel_shape[1],
-                          padding, padding, padding, padding,
-                          stride[0], stride[1], col.reshape(col.size))
+        for start, stop in _get_chunks(num_images, chunk_size):
+            col = self._get_conv_workspace(
+                (stop - start, num_output_pixels, num_kernel_params))
+            flat_col = col.reshape((-1, num_kernel_params))
+            flat_out_deltas = out_deltas[start:stop].reshape((-1,
+                                                              num_filters))
 
             # Compute gradients
-            reshaped_dparams = dparams.reshape(num_filters, num_kernel_params)
-            reshaped_out_deltas = out_deltas[i].reshape((num_output_pixels,
-                                                         num_filters))
-            self.dot_add_mm(reshaped_out_deltas, col, out=reshaped_dparams,
-                            transa=True)
-            dbias += np.sum(reshaped_out_deltas, axis=0)
+            if dparams is not None:
+                self._call_kernel(_cpuop.im2col_batch, inputs[start:stop],
+                                  kernel_shape[0], kernel_shape[1],
+                                  padding, padding, padding, padding,
+                                  stride[0], stride[1], col, num_threads)
+                self.dot_add_mm(flat_out_deltas, flat_col, reshaped_dparams,
+                                transa=True)
+            if dbias is not None:
+                dbias += np.sum(flat_out_deltas, axis=0, dtype=dbias.dtype)
 
             # Compute in_deltas
-            reshaped_params = params.reshape((num_filters, num_kernel_params))
-            np.dot(reshaped_out_deltas, reshaped_params, out=col)
-            brainstorm.handlers._cpuop.col2im(col.reshape(col.size),
-                          input_rows, input_cols, num_input_maps,
-                          kernel_shape[0], kernel_shape[1],
-                          padding, padding, padding, padding,
-                          stride[0], stride[1],
-                          in_deltas[i].reshape(in_deltas[i].size))
+            if in_deltas is None:
+                continue
+            self.dot_mm(flat_out_deltas, reshaped_params, flat_col)
+            self._call_kernel(_cpuop.col2im_batch, col,
+                              kernel_shape[0], kernel_shape[1],
+                              padding, padding, padding, padding,
+                              stride[0], stride[1], in_deltas[start:stop],
+                              num_threads)
 
     def conv2d_forward_batch(self, inputs, weights, bias, outputs,
-                             padding, stride):
+                             padding, stride, algorithm='im2col'):
+        config = self._get_conv_config(algorithm, inputs, weights, padding,
+                                       stride)
+        self._conv2d_forward(inputs, weights, bias, outputs, padding, stride,
+                             **config)
+
+    def _conv2d_forward(self, inputs, weights, bias, outputs, padding, stride,
+                        algorithm, num_threads, chunk_size):
+        if algorithm == 'winograd':
+            _winograd_conv2d_forward(inputs, weights, bias, outputs, padding)
+            return
+        if algorithm == 'fft':
+            _fft_conv2d_forward(inputs, weights, bias, outputs, padding,
+                                stride)
+            return
+
         num_filters = weights.shape[0]
-        num_images, input_rows, input_cols, num_input_maps = inputs.shape
+        num_images = inputs.shape[0]
         kernel_shape = weights.shape[1:]
         num_output_pixels = outputs.shape[1] * outputs.shape[2]
-        num_kernel_params = np.prod(kernel_shape)
-        out_shape = (num_output_pixels, num_filters)
-
-        for i in range(num_images):
-            col = np.zeros((num_output_pixels, num_kernel_params),
-                           dtype=self.dtype)
-            brainstorm.handlers._cpuop.im2col(inputs[i].reshape(inputs[i].size),
-                          input_rows, input_cols, num_input_maps,
-                          kernel_shape[0], kernel_shape[1],
-                          padding, padding, padding, padding, stride[0],
-                          stride[1], col.reshape(col.size))
-
-            reshaped_params = weights.reshape(num_filters, num_kernel_params)
-            np.dot(col, reshaped_params.T, out=outputs[i].reshape(out_shape))
-
-        outputs += bias.reshape((1, 1, 1, num_filters))
+        num_kernel_params = int(np.prod(kernel_shape))
+        reshaped_params = weights.reshape(num_filters, num_kernel_params)
+
+        for start, stop in _get_chunks(num_images, chunk_size):
+            col_shape = (stop - start, num_output_pixels, num_kernel_params)
+            flat_outputs = _flatten_without_copy(outputs[start:stop])
+            is_strided = flat_outputs is None
+            if is_strided:
+                # outputs are strided such that they can't be flattened, so
+                # the product goes to the workspace behind col first
+                flat_outputs = self._get_conv_workspace(
+                    ((stop - start) * num_output_pixels, num_filters),
+                    offset=int(np.prod(col_shape)))
+            col = self._get_conv_workspace(col_shape)
+            self._call_kernel(_cpuop.im2col_batch, inputs[start:stop],
+                              kernel_shape[0], kernel_shape[1],
+                              padding, padding, padding, padding,
+                              stride[0], stride[1], col, num_threads)
+            self.dot_mm(col.reshape((-1, num_kernel_params)),
+                        reshaped_params, flat_outputs, transb=True)
+            flat_outputs += bias.reshape((1, num_filters))
+            if is_strided:
+                outputs[start:stop] = flat_outputs.reshape(
+                    outputs[start:stop].shape)
+
+    def _call_kernel(self, kernel, *args):
+        """Call a Cython kernel that expects all arrays in self.dtype.
+
+        Arrays of another dtype (e.g. float16 activations) are converted
+        into per-thread staging buffers for the call, and those the kernel
+        writes to are copied back afterwards.
+        """
+        converted = [i for i, a in enumerate(args)
+                     if isinstance(a, np.ndarray) and a.dtype != self.dtype]
+        if not converted:
+            return kernel(*args)
+        outputs = _KERNEL_OUTPUTS[kernel.__name__]
+        staged = list(args)
+        for i in converted:
+            staged[i] = _get_workspace(('kernel', i), args[i].shape,
+                                       self.dtype)
+            if outputs.get(i, True):
+                np.copyto(staged[i], args[i])
+        result = kernel(*staged)
+        for i in converted:
+            if i in outputs:
+                np.copyto(args[i], staged[i], casting='same_kind')
+        return result
+
+    def _get_conv_config(self, algorithm, inputs, weights, padding, stride):
+        """Return the algorithm, thread count and chunk size to use for a
+        convolution, tuning them if the algorithm is 'auto'."""
+        if algorithm != 'auto':
+            _check_conv_algorithm(algorithm, weights.shape, stride)
+            return {'algorithm': algorithm, 'num_threads': self.num_threads,
+                    'chunk_size': self.conv_chunk_size}
+        if self.autotuner is None:
+            return {'algorithm': 'im2col', 'num_threads': self.num_threads,
+                    'chunk_size': self.conv_chunk_size}
+
+        key = 'conv2d {} {} {} {} {} {}'.format(
+            np.dtype(self.dtype), inputs.dtype, inputs.shape, weights.shape,
+            padding, tuple(stride))
+        # batched and per-image im2col with all thread counts
+        candidates = [{'algorithm': 'im2col', 'num_threads': n,
+                       'chunk_size': c}
+                      for n in get_thread_counts(self.num_threads)
+                      for c in [None] + sorted({1, self.conv_chunk_size} -
+                                               {None})]
+        if tuple(weights.shape[1:3]) == (3, 3) and tuple(stride) == (1, 1):
+            candidates.append({'algorithm': 'winograd', 'num_threads': 1,
+                               'chunk_size': None})
+        candidates.append({'algorithm': 'fft', 'num_threads': 1,
+                           'chunk_size': None})
+
+        out_h = (inputs.shape[1] + 2 * padding - weights.shape[1]) // \
+            stride[0] + 1
+        out_w = (inputs.shape[2] + 2 * padding - weights.shape[2]) // \
+            stride[1] + 1
+        outputs = np.zeros((inputs.shape[0], out_h, out_w, weights.shape[0]),
+                           dtype=inputs.dtype)
+        in_deltas = np.zeros_like(inputs)
+        dweights = np.zeros_like(weights)
+        bias = np.zeros(weights.shape[0], dtype=weights.dtype)
+        dbias = np.zeros_like(bias)
+
+        def run(**config):
+            self._conv2d_forward(inputs, weights, bias, outputs, padding,
+                                 stride, **config)
+            self._conv2d_backward(inputs, weights, padding, stride, in_deltas,
+                                  outputs, dweights, dbias, **config)
+
+        return self.autotuner.choose(key, candidates, run)
+
+    def _get_pool_threads(self, pool_type, inputs, window, outputs, padding,
+                          stride):
+        """Return the number of threads to use for a pooling operation,
+        which is tuned if the handler has an autotuner."""
+        if self.autotuner is None:
+            return self.num_threads
+        key = '{}pool2d {} {} {} {} {} {}'.format(
+            pool_type, np.dtype(self.dtype), inputs.dtype, inputs.shape,
+            tuple(window), padding, tuple(stride))
+        candidates = [{'num_threads': n}
+                      for n in get_thread_counts(self.num_threads)]
+        outs = np.zeros_like(outputs)
+        in_deltas = np.zeros_like(inputs)
+        argmax = np.zeros_like(outputs)
+
+        def run(num_threads):
+            if pool_type == 'max':
+                self._call_kernel(_cpuop.maxpool_forward, inputs, window,
+                                  outs, padding, stride, argmax, num_threads)
+                self._call_kernel(_cpuop.maxpool_backward, inputs, window,
+                                  outs, padding, stride, argmax, in_deltas,
+                                  outs, num_threads)
+            else:
+                self._call_kernel(_cpuop.avgpool_forward, inputs, window,
+                                  outs, padding, stride, num_threads)
+                self._call_kernel(_cpuop.avgpool_backward, inputs, window,
+                                  outs, padding, stride, in_deltas, outs,
+                                  num_threads)
+
+        return self.autotuner.choose(key, candidates, run)['num_threads']
+
+    def _get_conv_workspace(self, shape, offset=0):
+        """Return a view of the persistent convolution workspace of the
+        calling thread, starting at the given offset.
+
+        The workspace only grows, so after the first batch of a given size
+        no further memory is allocated. Its content is arbitrary.
+        """
+        size = int(np.prod(shape))
+        thread = threading.current_thread().ident
+        workspace = self._conv_workspace.get(thread)
+        if workspace is None or workspace.size < offset + size:
+            workspace = np.empty(offset + size, dtype=self.dtype)
+            self._conv_workspace[thread] = workspace
+        return workspace[offset:offset + size].reshape(shape)
 
     def copy_to_if(self, src, dest, cond):
-        dest[cond != 0] = src[cond != 0]
+        views = _as_2d_views(src, cond, dest)
+        if views is None:
+            dest[cond != 0] = src[cond != 0]
+        else:
+            _cpuop.copy_if(*views)
 
     def dot_add_mm(self, a, b, out, transa=False, transb=False):
-        x = a.T if transa else a
-        y = b.T if transb else b
-        out[:] += np.dot(x, y)
+        _gemm(1.0, a, b, 1.0, out, transa, transb)
 
     def dot_mm(self, a, b, out, transa=False, transb=False):
-        x = a.T if transa else a
-        y = b.T if transb else b
-        # np.dot(x, y, out)  # FIXME: doesn't work with strided out
-        out[:] = np.dot(x, y)
+        _gemm(1.0, a, b, 0.0, out, transa, transb)
 
     def divide_mv(self, m, v, out):
-        out[:] = m / v
+        np.divide(m, v, out=out)
 
     def divide_tt(self, a, b, out):
-        out[:] = a / b
+        np.divide(a, b, out=out)
 
     def fill_gaussian(self, mean, std, out):
-        out[:] = std * self.rnd.standard_normal(out.shape) + mean
+        np.multiply(self.rnd.standard_normal(out.shape), std, out=out)
+        out += mean
 
     def fill_if(self, mem, val, cond):
-        mem[cond != 0] = val
+        views = _as_2d_views(cond, mem)
+        if views is None:
+            mem[cond != 0] = val
+        else:
+            _cpuop.fill_if(val, *views)
 
     def generate_probability_mask(self, mask, probability):
-        mask[:] = self.rnd.uniform(size=mask.shape) < probability
+        np.less(self.rnd.uniform(size=mask.shape), probability, out=mask)
 
     def index_m_by_v(self, m, v, out):
-        for i in range(m.shape[0]):
-            out[i] = m[i, int(v[i])]
+        self._call_kernel(_cpuop.index_m_by_v, m, v, out)
 
     def log_t(self, a, out):
         np.log(a, out)
 
+    def lstm_backward_step(self, act_gates, peepholes, cell_prev, act_cell,
+                           out_deltas, next_gate_deltas, next_act_gates,
+                           next_cell_deltas, gate_deltas, cell_deltas,
+                           activation):
+        self._call_kernel(_cpuop.lstm_backward_step, act_gates, peepholes,
+                          cell_prev, act_cell, out_deltas, next_gate_deltas,
+                          next_act_gates, next_cell_deltas, gate_deltas,
+                          cell_deltas, _ACTIVATION_CODES[activation],
+                          self.num_threads)
+
+    def lstm_forward_step(self, gates, act_gates, peepholes, cell_prev, cell,
+                          act_cell, out, activation):
+        self._call_kernel(_cpuop.lstm_forward_step, gates, act_gates,
+                          peepholes, cell_prev, cell, act_cell, out,
+                          _ACTIVATION_CODES[activation], self.num_threads)
+
     def maxpool2d_backward_batch(self, inputs, window, outputs, padding,
                                  stride, argmax, in_deltas, out_deltas):
-        brainstorm.handlers._cpuop.maxpool_backward(inputs, window, outputs, padding, stride,
-                                argmax, in_deltas, out_deltas)
+        num_threads = self._get_pool_threads('max', inputs, window, outputs,
+                                             padding, stride)
+        self._call_kernel(_cpuop.maxpool_backward, inputs, window, outputs,
+                          padding, stride, argmax, in_deltas, out_deltas,
+                          num_threads)
 
     def maxpool2d_forward_batch(self, inputs, window, outputs, padding,
                                 stride, argmax):
-        brainstorm.handlers._cpuop.maxpool_forward(inputs, window, outputs, padding,
-                               stride, argmax)
+        num_threads = self._get_pool_threads('max', inputs, window, outputs,
+                                             padding, stride)
+        self._call_kernel(_cpuop.maxpool_forward, inputs, window, outputs,
+                          padding, stride, argmax, num_threads)
 
     def merge_tt(self, a, b, out):
         out_flat = out.reshape(-1, out.shape[-1])
@@ -224,16 +501,24 @@ class NumpyHandler(Handler):
         np.fmod(a, b, out)
 
     def mult_add_st(self, s, t, out):
-        out[:] += s * t
+        views = _as_2d_views(t, out)
+        if views is None:
+            out += s * t
+        else:
+            _cpuop.scale_add(s, *views)
 
     def mult_add_tt(self, a, b, out):
-        out[:] += a * b
+        views = _as_2d_views(a, b, out)
+        if views is None:
+            out += a * b
+        else:
+            _cpuop.mult_add(*views)
 
     def mult_mv(self, m, v, out):
-        out[:] = m * v
+        np.multiply(m, v, out=out)
 
     def mult_add_mv(self, m, v, out):
-        out[:] += m * v
+        self.mult_add_tt(m, np.broadcast_to(v, m.shape), out)
 
     def mult_st(self, s, t, out):
         np.multiply(s, t, out)
@@ -249,18 +534,18 @@ class NumpyHandler(Handler):
         ob = out_b.reshape(-1, out_b.shape[-1])
         x_flat = x.reshape(-1, x.shape[-1])
         sa = oa.shape[-1]
-        oa[:] += x_flat[:, :oa.shape[-1]]
-        ob[:] += x_flat[:, oa.shape[-1]:]
+        np.add(oa, x_flat[:, :sa], out=oa)
+        np.add(ob, x_flat[:, sa:], out=ob)
 
     def sqrt_t(self, a, out):
         np.sqrt(a, out)
 
     def subtract_mv(self, m, v, out):
-        out[:] = m - v
+        np.subtract(m, v, out=out)
 
     def subtract_tt(self, a, b, out):
         assert a.shape == b.shape == out.shape
-        out[:] = a - b
+        np.subtract(a, b, out=out)
 
     def sum_t(self, a, axis, out):
         if axis is not None and len(out.shape) == len(a.shape):
@@ -272,27 +557,418 @@ class NumpyHandler(Handler):
     # ------------------------ Activation functions ------------------------- #
 
     def rel(self, x, y):
-        y[:] = x * (x > 0)
+        np.maximum(x, 0., out=y)
 
     def rel_deriv(self, x, y, dy, dx):
-        dx[:] = dy * (y > 0)
+        views = _as_2d_views(y, dy, dx)
+        if views is None:
+            dx[:] = dy * (y > 0)
+        else:
+            _cpuop.rel_deriv(*views)
 
     def sigmoid(self, x, y):
-        indices = x >= 0
-        y[indices] = 1. / (1. + np.exp(-x[indices]))
-        indices = x < 0
-        y[indices] = np.exp(x[indices]) / (1. + np.exp(x[indices]))
+        views = _as_2d_views(x, y)
+        if views is None:
+            indices = x >= 0
+            y[indices] = 1. / (1. + np.exp(-x[indices]))
+            indices = x < 0
+            y[indices] = np.exp(x[indices]) / (1. + np.exp(x[indices]))
+        else:
+            _cpuop.sigmoid(*views)
 
     def sigmoid_deriv(self, x, y, dy, dx):
-        dx[:] = dy * y * (1. - y)
+        views = _as_2d_views(y, dy, dx)
+        if views is None:
+            dx[:] = dy * y * (1. - y)
+        else:
+            _cpuop.sigmoid_deriv(*views)
 
     def softmax_m(self, m, out):
         maxes = np.amax(m, axis=1, keepdims=True)
-        e = np.exp(m - maxes)
-        out[:] = e / np.sum(e, axis=1, keepdims=True)
+        np.subtract(m, maxes, out=out)
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=1, keepdims=True)
 
     def tanh(self, x, y):
         np.tanh(x, y)
 
     def tanh_deriv(self, x, y, dy, dx):
-        dx[:] = dy * (1. - y * y)
+        views = _as_2d_views(y, dy, dx)
+        if views is None:
+            dx[:] = dy * (1. - y * y)
+        else:
+            _cpuop.tanh_deriv(*views)
+
+    # --------------------------- Loss functions ---------------------------- #
+
+    def binomial_ce_backward(self, y, t, loss_deltas, in_deltas):
+        self._call_kernel(_cpuop.binomial_ce_backward, y, t, loss_deltas,
+                          in_deltas, self.num_threads)
+
+    def binomial_ce_forward(self, y, t, loss):
+        self._call_kernel(_cpuop.binomial_ce_forward, y, t, loss,
+                          self.num_threads)
+
+    def sigmoid_ce_backward(self, y, t, loss_deltas, in_deltas):
+        self._call_kernel(_cpuop.sigmoid_ce_backward, y, t, loss_deltas,
+                          in_deltas, self.num_threads)
+
+    def softmax_ce_backward(self, probabilities, targets, loss_deltas,
+                            in_deltas):
+        self._call_kernel(_cpuop.softmax_ce_backward, probabilities, targets,
+                          loss_deltas, in_deltas, self.num_threads)
+
+    def softmax_ce_forward(self, m, targets, probabilities, loss):
+        self._call_kernel(_cpuop.softmax_ce_forward, m, targets,
+                          probabilities, loss, self.num_threads)
+
+
+# ########################### Helper Methods ##################################
+
+def _as_2d_views(*arrays):
+    """Return 2D views of the arrays for the elementwise Cython kernels.
+
+    The last array determines the shape and dtype. Returns None if the
+    arrays differ in shape or dtype, if the dtype is not supported by the
+    kernels, or if any of them can't be viewed as 2D without a copy.
+    """
+    shape, dtype = arrays[-1].shape, arrays[-1].dtype
+    if dtype not in (np.float32, np.float64) or 0 in shape:
+        return None
+    views = []
+    for a in arrays:
+        if not isinstance(a, np.ndarray) or a.shape != shape or \
+                a.dtype != dtype:
+            return None
+        view = _flatten_without_copy(a)
+        if view is None:
+            return None
+        views.append(view)
+    return views
+
+
+def _get_chunks(num_items, chunk_size):
+    chunk_size = chunk_size or max(num_items, 1)
+    for start in range(0, num_items, chunk_size):
+        yield start, min(start + chunk_size, num_items)
+
+
+def _check_conv_algorithm(algorithm, kernel_shape, stride):
+    if algorithm not in ('im2col', 'winograd', 'fft'):
+        raise ValueError('Unknown convolution algorithm: {}'.format(algorithm))
+    if algorithm == 'winograd' and (tuple(kernel_shape[1:3]) != (3, 3) or
+                                    tuple(stride) != (1, 1)):
+        raise ValueError('The winograd convolution needs 3x3 kernels and '
+                         'stride (1, 1), but got {} and {}'
+                         .format(kernel_shape[1:3], stride))
+
+
+def _pad_images(images, top, bottom, left, right):
+    """Zero-pad a batch of images of shape (N, H, W, C) in H and W."""
+    return np.pad(images, ((0, 0), (top, bottom), (left, right), (0, 0)),
+                  mode='constant')
+
+
+# Transformation matrices of Winograd's minimal filtering algorithm
+# F(2x2, 3x3), which computes 2x2 outputs of a 3x3 kernel from 4x4 inputs
+# with 16 instead of 36 multiplications.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                         [0, 1, 1, 0],
+                         [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                         [0, 1, -1, -1]], dtype=np.float64)
+
+
+def _winograd_correlate(images, padding, kernels, out_height, out_width):
+    """Correlate images (N, H, W, C) zero-padded by `padding` with 3x3
+    kernels (F, 3, 3, C) using F(2x2, 3x3).
+
+    Returns the (N, out_height, out_width, F) result.
+    """
+    num_images, height, width, num_channels = images.shape
+    num_filters = kernels.shape[0]
+    dtype = kernels.dtype
+    tiles_h, tiles_w = (out_height + 1) // 2, (out_width + 1) // 2
+    # every 2x2 output tile needs a 4x4 input tile, and the last ones might
+    # reach past the padded images
+    padded = _pad_images(images.astype(dtype, copy=False), padding,
+                         max(2 * tiles_h + 2 - height - padding, 0),
+                         padding,
+                         max(2 * tiles_w + 2 - width - padding, 0))
+    s = padded.strides
+    tiles = np.lib.stride_tricks.as_strided(
+        padded, shape=(num_images, tiles_h, tiles_w, 4, 4, num_channels),
+        strides=(s[0], 2 * s[1], 2 * s[2], s[1], s[2], s[3]))
+
+    bt = _WINOGRAD_BT.astype(dtype)
+    g = _WINOGRAD_G.astype(dtype)
+    at = _WINOGRAD_AT.astype(dtype)
+    v = np.einsum('ai,nhwijc,bj->abnhwc', bt, tiles, bt, optimize=True)
+    u = np.einsum('ai,fijc,bj->abcf', g, kernels, g, optimize=True)
+    # the channels are reduced by one matrix product per tile position
+    m = np.matmul(v.reshape((16, -1, num_channels)),
+                  u.reshape((16, num_channels, num_filters)))
+    y = np.einsum('ia,abpf,jb->pijf', at, m.reshape((4, 4, -1, num_filters)),
+                  at, optimize=True)
+    y = y.reshape((num_images, tiles_h, tiles_w, 2, 2, num_filters))
+    y = y.transpose((0, 1, 3, 2, 4, 5)).reshape(
+        (num_images, 2 * tiles_h, 2 * tiles_w, num_filters))
+    return y[:, :out_height, :out_width]
+
+
+def _winograd_conv2d_forward(inputs, weights, bias, outputs, padding):
+    outputs[...] = _winograd_correlate(inputs, padding, weights,
+                                       outputs.shape[1], outputs.shape[2])
+    outputs += bias
+
+
+def _winograd_conv2d_backward(inputs, weights, padding, in_deltas,
+                              out_deltas, dweights, dbias):
+    height, width = inputs.shape[1:3]
+    # the deltas of the padded inputs are the full correlation of the
+    # output deltas with the rotated and transposed kernels
+    if in_deltas is not None:
+        rotated = weights[:, ::-1, ::-1, :].transpose((3, 1, 2, 0))
+        padded_deltas = _winograd_correlate(out_deltas, 2, rotated,
+                                            height + 2 * padding,
+                                            width + 2 * padding)
+        in_deltas += padded_deltas[:, padding:padding + height,
+                                   padding:padding + width]
+    if dweights is not None:
+        _shifted_weight_gradients(inputs, padding, (1, 1), out_deltas,
+                                  dweights)
+    if dbias is not None:
+        dbias[...] = np.sum(out_deltas, axis=(0, 1, 2), dtype=dbias.dtype)
+
+
+def _shifted_weight_gradients(inputs, padding, stride, out_deltas, dweights):
+    """Compute the weight gradients with one matrix product per kernel
+    position instead of an im2col matrix."""
+    num_filters, kernel_h, kernel_w, num_channels = dweights.shape
+    out_h, out_w = out_deltas.shape[1:3]
+    padded = _pad_images(inputs, padding, padding, padding, padding)
+    flat_deltas = out_deltas.reshape((-1, num_filters))
+    for i in range(kernel_h):
+        for j in range(kernel_w):
+            patch = padded[:, i:i + (out_h - 1) * stride[0] + 1:stride[0],
+                           j:j + (out_w - 1) * stride[1] + 1:stride[1]]
+            _gemm(1.0, flat_deltas, patch.reshape((-1, num_channels)), 0.0,
+                  dweights[:, i, j, :], transa=True)
+
+
+def _fft_conv2d_forward(inputs, weights, bias, outputs, padding, stride):
+    padded = _pad_images(inputs, padding, padding, padding, padding)
+    shape = padded.shape[1:3]
+    x = np.fft.rfft2(padded, s=shape, axes=(1, 2))
+    k = np.fft.rfft2(weights, s=shape, axes=(1, 2))
+    # correlation is the product with the complex conjugate, and the
+    # channels are reduced by one matrix product per frequency
+    y = np.matmul(x.transpose((1, 2, 0, 3)), k.conj().transpose((1, 2, 3, 0)))
+    y = np.fft.irfft2(y.transpose((2, 0, 1, 3)), s=shape, axes=(1, 2))
+    out_h, out_w = outputs.shape[1:3]
+    outputs[...] = y[:, :(out_h - 1) * stride[0] + 1:stride[0],
+                     :(out_w - 1) * stride[1] + 1:stride[1]]
+    outputs += bias
+
+
+def _fft_conv2d_backward(inputs, weights, padding, stride, in_deltas,
+                         out_deltas, dweights, dbias):
+    num_images, height, width, num_channels = inputs.shape
+    kernel_h, kernel_w = weights.shape[1:3]
+    out_h, out_w = out_deltas.shape[1:3]
+    padded = _pad_images(inputs, padding, padding, padding, padding)
+    shape = padded.shape[1:3]
+    # spread the output deltas to the positions of their receptive fields
+    spread = np.zeros(shape=(num_images,) + shape + (weights.shape[0],),
+                      dtype=np.result_type(out_deltas, weights))
+    spread[:, :(out_h - 1) * stride[0] + 1:stride[0],
+           :(out_w - 1) * stride[1] + 1:stride[1]] = out_deltas
+    d = np.fft.rfft2(spread, axes=(1, 2)).transpose((1, 2, 0, 3))
+
+    # the input deltas are the convolution of the deltas with the kernels
+    if in_deltas is not None:
+        k = np.fft.rfft2(weights, s=shape,
+                         axes=(1, 2)).transpose((1, 2, 0, 3))
+        padded_deltas = np.fft.irfft2(
+            np.matmul(d, k).transpose((2, 0, 1, 3)), s=shape, axes=(1, 2))
+        in_deltas += padded_deltas[:, padding:padding + height,
+                                   padding:padding + width]
+    # the weight gradients are the correlation of the inputs with the deltas
+    if dweights is not None:
+        x = np.fft.rfft2(padded, axes=(1, 2)).transpose((1, 2, 0, 3))
+        grads = np.matmul(d.conj().transpose((0, 1, 3, 2)), x)
+        grads = np.fft.irfft2(grads.transpose((2, 0, 1, 3)), s=shape,
+                              axes=(1, 2))
+        dweights[...] = grads[:, :kernel_h, :kernel_w]
+    if dbias is not None:
+        dbias[...] = np.sum(out_deltas, axis=(0, 1, 2), dtype=dbias.dtype)
+
+
+def _gemm(alpha, a, b, beta, out, transa=False, transb=False):
+    """Compute out = alpha * op(a) . op(b) + beta * out in place.
+
+    Uses the BLAS bindings if they are available and the operands allow it,
+    and falls back to numpy otherwise. The product is accumulated in at
+    least float32, even if some of the operands are stored in float16.
+    """
+    compute_dtype = np.promote_types(np.result_type(a, b, out), np.float32)
+    if out.dtype != compute_dtype:
+        result = _get_workspace('out', out.shape, compute_dtype)
+        if beta != 0.0:
+            np.copyto(result, out)
+        _gemm(alpha, a, b, beta, result, transa, transb)
+        np.copyto(out, result, casting='same_kind')
+        return
+    a = _convert_gemm_operand('a', a, compute_dtype)
+    b = _convert_gemm_operand('b', b, compute_dtype)
+    if _blas is not None and out.ndim == 2 and _blas_gemm(
+            alpha, a, b, beta, out, transa, transb):
+        return
+    _numpy_gemm(alpha, a.T if transa else a, b.T if transb else b, beta,
+                out)
+
+
+def _numpy_gemm(alpha, x, y, beta, out):
+    """Compute out = alpha * x . y + beta * out in place using np.dot."""
+    if beta == 0.0 and out.flags.c_contiguous and \
+            not np.shares_memory(out, x) and not np.shares_memory(out, y):
+        np.dot(x, y, out=out)
+        if alpha != 1.0:
+            out *= alpha
+        return
+    product = _get_workspace('product', out.shape, out.dtype)
+    np.dot(x, y, out=product)
+    if alpha != 1.0:
+        product *= alpha
+    if beta == 0.0:
+        out[...] = product
+    else:
+        if beta != 1.0:
+            out *= beta
+        out += product
+
+
+def _convert_gemm_operand(name, x, dtype):
+    """Return x converted to dtype, using the workspace for the copy."""
+    if x.dtype == dtype:
+        return x
+    converted = _get_workspace(name, x.shape, dtype)
+    np.copyto(converted, x)
+    return converted
+
+
+def _get_workspace(name, shape, dtype):
+    """Return a C-contiguous view of the persistent buffer with the given
+    name and dtype of the calling thread.
+
+    The buffers only grow, so repeated calls with the same size don't
+    allocate any memory. Their content is arbitrary.
+    """
+    size = int(np.prod(shape))
+    buffers = getattr(_workspace, 'buffers', None)
+    if buffers is None:
+        buffers = _workspace.buffers = {}
+    key = (name, np.dtype(dtype))
+    workspace = buffers.get(key)
+    if workspace is None or workspace.size < size:
+        workspace = np.empty(size, dtype=dtype)
+        buffers[key] = workspace
+    return workspace[:size].reshape(shape)
+
+
+def _blas_gemm(alpha, a, b, beta, out, transa, transb):
+    """Run _gemm through BLAS. Returns False if that is not possible."""
+    if out.dtype not in (np.float32, np.float64) or \
+            not (a.dtype == b.dtype == out.dtype) or \
+            a.ndim != 2 or b.ndim != 2:
+        return False
+
+    ldc = _get_leading_dimension(out)
+    if ldc is None:
+        if _get_leading_dimension(out.T) is None:
+            return False
+        # compute out.T = op(b).T . op(a).T instead
+        return _blas_gemm(alpha, b, a, beta, out.T, not transb, not transa)
+
+    if np.shares_memory(out, a) or np.shares_memory(out, b):
+        return False
+
+    (a, transa, lda), (b, transb, ldb), (m, n, k) = \
+        _get_blas_gemm_operands(a, b, out, transa, transb)
+    if m == 0 or n == 0:
+        return True
+    if k == 0:
+        if beta == 0.0:
+            out.fill(0.0)
+        else:
+            out *= beta
+        return True
+    _blas.gemm(transa, transb, m, n, k, alpha, a, lda, b, ldb, beta, out,
+               ldc)
+    return True
+
+
+def _get_blas_gemm_operands(a, b, out, transa, transb):
+    """Normalise the operands of a BLAS gemm into row-major views.
+
+    Returns:
+        tuple: The array, transpose flag and leading dimension for a and b,
+        and the sizes (m, n, k) of the product.
+    """
+    a, transa, lda = _get_blas_operand(a, transa)
+    b, transb, ldb = _get_blas_operand(b, transb)
+    m, k = a.shape[::-1] if transa else a.shape
+    n = b.shape[0] if transb else b.shape[1]
+    if out.shape != (m, n) or (b.shape[1] if transb else b.shape[0]) != k:
+        raise ValueError('shape mismatch for dot product: {}{} . {}{} -> {}'
+                         .format(a.shape, '.T' if transa else '', b.shape,
+                                 '.T' if transb else '', out.shape))
+    return (a, transa, lda), (b, transb, ldb), (m, n, k)
+
+
+def _get_blas_operand(m, trans):
+    """Return a row-major view of m for BLAS with its transpose flag and
+    leading dimension, copying it only if it has no unit stride."""
+    ld = _get_leading_dimension(m)
+    if ld is not None:
+        return m, trans, ld
+    ld = _get_leading_dimension(m.T)
+    if ld is not None:
+        return m.T, not trans, ld
+    m = np.ascontiguousarray(m)
+    return m, trans, _get_leading_dimension(m)
+
+
+def _get_leading_dimension(m):
+    """Return the leading dimension of the 2D array m if its rows can be
+    passed to BLAS as a row-major matrix, else None."""
+    rows, cols = m.shape
+    row_stride, col_stride = m.strides
+    if cols > 1 and col_stride != m.itemsize:
+        return None
+    if rows <= 1:
+        return max(cols, 1)
+    if row_stride % m.itemsize or row_stride < max(cols, 1) * m.itemsize:
+        return None
+    return row_stride // m.itemsize
+
+
+def _flatten_without_copy(a):
+    """Return a 2D view of `a` with all but the last dimension merged, or
+    None if that would require a copy.
+
+    Unlike setting the shape of a view, this checks the strides instead of
+    letting numpy build the copy only to discard it.
+    """
+    if a.ndim == 0:
+        return a.reshape((1, 1))
+    dims = [(n, st) for n, st in zip(a.shape[:-1], a.strides[:-1]) if n != 1]
+    for (_, outer_stride), (n, inner_stride) in zip(dims, dims[1:]):
+        if outer_stride != n * inner_stride:
+            return None
+    return a.reshape((-1, a.shape[-1]))
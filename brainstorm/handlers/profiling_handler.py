@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import division, print_function, unicode_literals
+
+import inspect
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+from brainstorm.handlers.base_handler import Handler
+from brainstorm.utils import find_calling_layer_pass
+
+# name under which operations that are not issued by a layer are recorded
+OTHER = 'other'
+
+
+# ########################### Profiling Handler ############################# #
+
+class ProfilingHandler(Handler):
+    """Handler wrapper that profiles all operations it executes.
+
+    For every operation this handler counts the calls and measures the wall
+    time spent in the wrapped handler. It also estimates the floating point
+    operations and the bytes of all array arguments. The numbers are
+    attributed to the layer that issued the operation and to its forward or
+    backward pass. Operations issued outside of a layer, e.g. by a stepper,
+    are attributed to ``'other'``.
+
+    Note:
+        Handlers that run operations asynchronously (like the
+        PyCudaHandler) only report the time needed to launch them.
+
+    Args:
+        handler (brainstorm.handlers.base_handler.Handler):
+            The handler that actually executes the operations.
+    """
+    __undescribed__ = {'EMPTY', 'array_type', 'stats'}
+
+    def __init__(self, handler):
+        super(ProfilingHandler, self).__init__()
+        self.handler = handler
+        self.EMPTY = handler.EMPTY
+        self.array_type = handler.array_type
+        self.stats = OrderedDict()
+
+    def __init_from_description__(self, description):
+        self.__init__(self.handler)
+
+    def reset(self):
+        """Discard all collected statistics."""
+        self.stats = OrderedDict()
+
+    def get_profile(self):
+        """Return the collected statistics as a nested dictionary.
+
+        Returns:
+            OrderedDict:
+                Maps layer name -> pass ('forward', 'backward' or 'other') ->
+                operation name -> dictionary with the entries 'calls',
+                'time' (in seconds), 'flops' and 'bytes'.
+        """
+        profile = OrderedDict()
+        for (layer, pass_, op), (calls, time, flops, nbytes) in \
+                self.stats.items():
+            ops = profile.setdefault(layer, OrderedDict()).setdefault(
+                pass_, OrderedDict())
+            ops[op] = OrderedDict([('calls', calls), ('time', time),
+                                   ('flops', flops), ('bytes', nbytes)])
+        return profile
+
+    def format_profile(self, max_rows=None):
+        """Return the collected statistics as a table sorted by time.
+
+        Args:
+            max_rows (Optional[int]):
+                Maximum number of operations to list. Defaults to all.
+
+        Returns:
+            str: The formatted table.
+        """
+        total_time = sum(s[1] for s in self.stats.values()) or 1.0
+        rows = sorted(self.stats.items(), key=lambda x: -x[1][1])[:max_rows]
+        header = '{:<20} {:<8} {:<24} {:>8} {:>10} {:>6} {:>9} {:>9}'
+        line = '{:<20} {:<8} {:<24} {:>8} {:>10.3f} {:>6.1f} {:>9.3f} ' \
+               '{:>9.3f}'
+        lines = [header.format('layer', 'pass', 'operation', 'calls',
+                               'time [ms]', '%', 'GFLOP/s', 'GB/s')]
+        for (layer, pass_, op), (calls, time, flops, nbytes) in rows:
+            time = max(time, 1e-12)
+            lines.append(line.format(layer, pass_, op, calls, time * 1000,
+                                     100 * time / total_time,
+                                     flops / time / 1e9, nbytes / time / 1e9))
+        return '\n'.join(lines)
+
+    # ------------------------- Allocate new memory ------------------------- #
+
+    def allocate(self, shape):
+        return self.handler.allocate(shape)
+
+    def allocate_activations(self, shape):
+        return self.handler.allocate_activations(shape)
+
+    def allocate_scratch(self, shape):
+        return self.handler.allocate_scratch(shape)
+
+    def release_scratch(self):
+        self.handler.release_scratch()
+
+    def ones(self, shape):
+        return self.handler.ones(shape)
+
+    def zeros(self, shape):
+        return self.handler.zeros(shape)
+
+    # ---------------------------- Copy and Fill ---------------------------- #
+
+    def create_from_numpy(self, arr):
+        return self.handler.create_from_numpy(arr)
+
+    def get_numpy_copy(self, mem):
+        return self.handler.get_numpy_copy(mem)
+
+    # ---------------------------- Debug helpers ---------------------------- #
+
+    def is_fully_finite(self, a):
+        return self.handler.is_fully_finite(a)
+
+
+def _create_profiled_operation(name):
+    def profiled_operation(self, *args, **kwargs):
+        operation = getattr(self.handler, name)
+        start = default_timer()
+        result = operation(*args, **kwargs)
+        time = default_timer() - start
+
+        call_args = inspect.getcallargs(getattr(Handler, name), self,
+                                        *args, **kwargs)
+        del call_args['self']
+        arrays = [a for a in call_args.values()
+                  if isinstance(a, self.array_type)]
+        key = _get_calling_layer_and_pass() + (name,)
+        stats = self.stats.setdefault(key, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += time
+        stats[2] += _estimate_flops(name, call_args, arrays)
+        stats[3] += sum(_get_nbytes(a) for a in arrays)
+        return result
+
+    profiled_operation.__name__ = str(name)
+    profiled_operation.__doc__ = getattr(Handler, name).__doc__
+    return profiled_operation
+
+
+# wrap all operations, including those with a default implementation
+for _name, _member in Handler.__dict__.items():
+    if callable(_member) and not _name.startswith('_') and \
+            _name not in ProfilingHandler.__dict__:
+        setattr(ProfilingHandler, _name, _create_profiled_operation(_name))
+ProfilingHandler.__abstractmethods__ = frozenset()
+
+
+# ########################### Helper Methods ##################################
+
+_FLOP_ESTIMATES = {
+    'dot_mm': lambda a, out, transa, **_:
+        2 * out.size * a.shape[0 if transa else 1],
+    'dot_add_mm': lambda a, out, transa, **_:
+        2 * out.size * a.shape[0 if transa else 1],
+    'conv2d_forward_batch': lambda weights, outputs, **_:
+        2 * outputs.size * int(np.prod(weights.shape[1:])),
+    # one product for the weight gradients and one for the input deltas
+    'conv2d_backward_batch':
+        lambda weights, out_deltas, in_deltas, weight_deltas, **_:
+        2 * ((in_deltas is not None) + (weight_deltas is not None)) *
+        out_deltas.size * int(np.prod(weights.shape[1:])),
+    'avgpool2d_forward_batch': lambda window, outputs, **_:
+        outputs.size * window[0] * window[1],
+    'avgpool2d_backward_batch': lambda window, out_deltas, **_:
+        out_deltas.size * window[0] * window[1],
+    'maxpool2d_forward_batch': lambda window, outputs, **_:
+        outputs.size * window[0] * window[1],
+    'maxpool2d_backward_batch': lambda out_deltas, **_: out_deltas.size,
+    # roughly 16 operations per cell, i.e. 4 per gate
+    'lstm_forward_step': lambda gates, **_: 4 * gates.size,
+    'lstm_backward_step': lambda gate_deltas, **_: 4 * gate_deltas.size,
+}
+
+# operations that only move data around
+_MEMORY_OPERATIONS = {'binarize_v', 'broadcast_t', 'copy_to', 'copy_to_if',
+                      'fill', 'fill_if', 'generate_probability_mask',
+                      'index_m_by_v', 'merge_tt', 'set_from_numpy'}
+
+
+def _estimate_flops(name, call_args, arrays):
+    """Estimate the number of floating point operations of an operation.
+
+    Unless there is a specific estimate, operations are assumed to perform
+    one floating point operation per element of their largest array.
+    """
+    if name in _MEMORY_OPERATIONS:
+        return 0
+    if name in _FLOP_ESTIMATES:
+        return _FLOP_ESTIMATES[name](**call_args)
+    return max([a.size for a in arrays] or [0])
+
+
+def _get_nbytes(array):
+    if hasattr(array, 'nbytes'):
+        return array.nbytes
+    # e.g. DebugArrays, which wrap the actual array
+    return _get_nbytes(array.array)
+
+
+def _get_calling_layer_and_pass():
+    layer, pass_ = find_calling_layer_pass()[:2]
+    if layer is None:
+        return OTHER, OTHER
+    return layer.name, pass_
@@ -18,6 +18,9 @@ from brainstorm.utils import flatten_all_but_last
 culinalg.init()
 NUM_CUDA_THREADS = 1024
 
+# codes of the activation functions used by the fused LSTM kernels
+_ACTIVATION_CODES = {'linear': 0, 'sigmoid': 1, 'tanh': 2, 'rel': 3}
+
 
 def get_blocks(n):
     return (n + NUM_CUDA_THREADS - 1) // NUM_CUDA_THREADS
@@ -172,44 +175,52 @@ class PyCudaHandler(Handler):
         clip_kernel(a, out, a_min, a_max)
 
     def conv2d_backward_batch(self, inputs, params, padding, stride,
-                              in_deltas, out_deltas, dparams, dbias):
+                              in_deltas, out_deltas, dparams, dbias,
+                              algorithm='im2col'):
+        # only im2col is implemented, other algorithms fall back to it
         num_filters = params.shape[0]
         num_images, input_rows, input_cols, num_input_maps = inputs.shape
         kernel_shape = params.shape[1:]
         num_output_pixels = out_deltas.shape[1] * out_deltas.shape[2]
         num_kernel_params = np.prod(kernel_shape)
 
-        dparams.fill(0.0)
-        dbias.fill(0.0)
-        tmp = self.zeros(dbias.shape)
+        if dparams is not None:
+            dparams.fill(0.0)
+        if dbias is not None:
+            dbias.fill(0.0)
+            tmp = self.zeros(dbias.shape)
         col = self.zeros((num_output_pixels, num_kernel_params))
 
         for i in range(num_images):
-            num_cuda_kernels = num_output_pixels * num_input_maps
-
-            _im2col_fp32_impl(np.int32(num_cuda_kernels), inputs[i],
-                              np.int32(input_rows), np.int32(input_cols),
-                              np.int32(kernel_shape[0]),
-                              np.int32(kernel_shape[1]),
-                              np.int32(padding), np.int32(padding),
-                              np.int32(stride[0]), np.int32(stride[1]),
-                              np.int32(out_deltas.shape[2]),
-                              np.int32(num_input_maps),
-                              col.gpudata,
-                              block=(get_blocks(num_cuda_kernels), 1, 1),
-                              grid=(NUM_CUDA_THREADS, 1, 1))
-
-            # Compute gradients
-            reshaped_dparams = dparams.reshape(num_filters, num_kernel_params)
             reshaped_out_deltas = out_deltas[i].reshape((num_output_pixels,
                                                          num_filters))
-            self.dot_add_mm(reshaped_out_deltas, col, out=reshaped_dparams,
-                            transa=True)
 
-            self.sum_t(reshaped_out_deltas, axis=0, out=tmp)
-            self.add_tt(tmp, dbias, out=dbias)
+            # Compute gradients
+            if dparams is not None:
+                num_cuda_kernels = num_output_pixels * num_input_maps
+                _im2col_fp32_impl(np.int32(num_cuda_kernels), inputs[i],
+                                  np.int32(input_rows), np.int32(input_cols),
+                                  np.int32(kernel_shape[0]),
+                                  np.int32(kernel_shape[1]),
+                                  np.int32(padding), np.int32(padding),
+                                  np.int32(stride[0]), np.int32(stride[1]),
+                                  np.int32(out_deltas.shape[2]),
+                                  np.int32(num_input_maps),
+                                  col.gpudata,
+                                  block=(get_blocks(num_cuda_kernels), 1, 1),
+                                  grid=(NUM_CUDA_THREADS, 1, 1))
+                reshaped_dparams = dparams.reshape(num_filters,
+                                                   num_kernel_params)
+                self.dot_add_mm(reshaped_out_deltas, col,
+                                out=reshaped_dparams, transa=True)
+
+            if dbias is not None:
+                self.sum_t(reshaped_out_deltas, axis=0, out=tmp)
+                self.add_tt(tmp, dbias, out=dbias)
 
             # Compute in_deltas
+            if in_deltas is None:
+                continue
             reshaped_params = params.reshape((num_filters, num_kernel_params))
             self.dot_mm(reshaped_out_deltas, reshaped_params, out=col)
             num_cuda_kernels = input_rows * input_cols * num_input_maps
@@ -226,7 +237,8 @@ class PyCudaHandler(Handler):
                               grid=(NUM_CUDA_THREADS, 1, 1))
 
     def conv2d_forward_batch(self, inputs, params, bias, outputs,
-                             padding, stride):
+                             padding, stride, algorithm='im2col'):
+        # only im2col is implemented, other algorithms fall back to it
         num_filters = params.shape[0]
         num_images, input_rows, input_cols, num_input_maps = inputs.shape
         kernel_shape = params.shape[1:]
@@ -287,6 +299,23 @@ class PyCudaHandler(Handler):
     def log_t(self, a, out):
         cumath.log(a, out=out)
 
+    def lstm_backward_step(self, act_gates, peepholes, cell_prev, act_cell,
+                           out_deltas, next_gate_deltas, next_act_gates,
+                           next_cell_deltas, gate_deltas, cell_deltas,
+                           activation):
+        lstm_backward_step_kernel(cell_deltas, gate_deltas, act_gates,
+                                  peepholes, cell_prev, act_cell, out_deltas,
+                                  next_gate_deltas, next_act_gates,
+                                  next_cell_deltas,
+                                  np.int32(act_cell.shape[1]),
+                                  np.int32(_ACTIVATION_CODES[activation]))
+
+    def lstm_forward_step(self, gates, act_gates, peepholes, cell_prev, cell,
+                          act_cell, out, activation):
+        lstm_forward_step_kernel(cell, gates, act_gates, peepholes, cell_prev,
+                                 act_cell, out, np.int32(cell.shape[1]),
+                                 np.int32(_ACTIVATION_CODES[activation]))
+
     def maxpool2d_backward_batch(self, inputs, window, outputs, padding,
                                  stride, argmax, in_deltas, out_deltas):
         in_image_size = inputs.size // inputs.shape[0]
@@ -480,6 +509,80 @@ index_m_by_v_kernel = ElementwiseKernel(
     "index_m_by_v_kernel"
 )
 
+__lstm_preamble = """
+    __device__ float lstm_sigmoid(float x) {
+        return (x >= 0) ? 1.0 / (1.0 + exp(-x)) : exp(x) / (1.0 + exp(x));
+    }
+
+    __device__ float lstm_act(float x, int act) {
+        switch (act) {
+            case 1: return lstm_sigmoid(x);
+            case 2: return tanh(x);
+            case 3: return (x > 0) ? x : 0.0;
+            default: return x;
+        }
+    }
+
+    __device__ float lstm_act_deriv(float y, int act) {
+        switch (act) {
+            case 1: return y * (1.0 - y);
+            case 2: return 1.0 - y * y;
+            case 3: return (y > 0) ? 1.0 : 0.0;
+            default: return 1.0;
+        }
+    }
+"""
+
+lstm_backward_step_kernel = ElementwiseKernel(
+    "float* cell_deltas, float* gate_deltas, float* act_gates, "
+    "float* peepholes, float* cell_prev, float* act_cell, "
+    "float* out_deltas, float* next_gate_deltas, float* next_act_gates, "
+    "float* next_cell_deltas, int n, int act",
+    """
+    const int j = i % n;
+    const int g = (i / n) * 4 * n + j;
+    const float z = act_gates[g];
+    const float in = act_gates[g + n];
+    const float f = act_gates[g + 2 * n];
+    const float o = act_gates[g + 3 * n];
+    const float d_o = out_deltas[i] * act_cell[i] * o * (1.0 - o);
+    const float dc = out_deltas[i] * o * lstm_act_deriv(act_cell[i], act) +
+                     next_cell_deltas[i] * next_act_gates[g + 2 * n] +
+                     next_gate_deltas[g + n] * peepholes[j] +
+                     next_gate_deltas[g + 2 * n] * peepholes[n + j] +
+                     d_o * peepholes[2 * n + j];
+    cell_deltas[i] = dc;
+    gate_deltas[g] = dc * in * lstm_act_deriv(z, act);
+    gate_deltas[g + n] = dc * z * in * (1.0 - in);
+    gate_deltas[g + 2 * n] = dc * cell_prev[i] * f * (1.0 - f);
+    gate_deltas[g + 3 * n] = d_o;
+    """,
+    "lstm_backward_step_kernel",
+    preamble=__lstm_preamble
+)
+
+lstm_forward_step_kernel = ElementwiseKernel(
+    "float* cell, float* gates, float* act_gates, float* peepholes, "
+    "float* cell_prev, float* act_cell, float* out, int n, int act",
+    """
+    const int j = i % n;
+    const int g = (i / n) * 4 * n + j;
+    gates[g + n] += peepholes[j] * cell_prev[i];
+    gates[g + 2 * n] += peepholes[n + j] * cell_prev[i];
+    act_gates[g] = lstm_act(gates[g], act);
+    act_gates[g + n] = lstm_sigmoid(gates[g + n]);
+    act_gates[g + 2 * n] = lstm_sigmoid(gates[g + 2 * n]);
+    cell[i] = act_gates[g + n] * act_gates[g] +
+              act_gates[g + 2 * n] * cell_prev[i];
+    gates[g + 3 * n] += peepholes[2 * n + j] * cell[i];
+    act_gates[g + 3 * n] = lstm_sigmoid(gates[g + 3 * n]);
+    act_cell[i] = lstm_act(cell[i], act);
+    out[i] = act_gates[g + 3 * n] * act_cell[i];
+    """,
+    "lstm_forward_step_kernel",
+    preamble=__lstm_preamble
+)
+
 modulo_tt_kernel = ElementwiseKernel(
     "float* a, float* b, float* out",
     "out[i] =  (float)((int)((a >= 0) ? a[i]+0.5: a[i]-0.5) % (int)((b>=0) ? b[i]+0.5: b[i]-0.5))",
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import division, print_function, unicode_literals
+
+from functools import partial
+
+from brainstorm.handlers.base_handler import Handler
+
+
+# ############################ Execution Plan ############################### #
+
+class ExecutionPlan(object):
+    """A recorded sequence of handler operations with bound arguments.
+
+    Replaying the plan repeats exactly the same operations on exactly the
+    same arrays, without running any of the Python code that originally
+    issued them. It is therefore only valid as long as the recorded arrays
+    are still the buffers in use and the issuing code would not have
+    behaved differently.
+
+    Args:
+        ops (list[functools.partial]):
+            The operations in the order in which they should be executed.
+        buffers (tuple):
+            The buffers that the operations were recorded on.
+    """
+
+    def __init__(self, ops, buffers=()):
+        self.ops = ops
+        self.buffers = buffers
+
+    def is_valid_for(self, buffers):
+        """Check if this plan was recorded on the given buffers."""
+        return len(buffers) == len(self.buffers) and \
+            all(a is b for a, b in zip(buffers, self.buffers))
+
+    def run(self):
+        for op in self.ops:
+            op()
+
+
+# ########################### Recording Handler ############################# #
+
+class RecordingHandler(Handler):
+    """Handler wrapper that records all operations it executes.
+
+    Every operation is forwarded to the wrapped handler and appended to
+    :attr:`ops`, from which an :class:`ExecutionPlan` can be built. Memory
+    allocation and copying data to or from numpy are only forwarded, since
+    they don't belong to the computation.
+
+    Args:
+        handler (brainstorm.handlers.base_handler.Handler):
+            The handler that actually executes the operations.
+    """
+    __undescribed__ = {'EMPTY', 'array_type', 'ops'}
+
+    def __init__(self, handler):
+        super(RecordingHandler, self).__init__()
+        self.handler = handler
+        self.EMPTY = handler.EMPTY
+        self.array_type = handler.array_type
+        self.ops = []
+
+    def __init_from_description__(self, description):
+        self.__init__(self.handler)
+
+    def get_plan(self, buffers=()):
+        """Create an execution plan from the recorded operations."""
+        return ExecutionPlan(list(self.ops), buffers)
+
+    # ------------------------- Allocate new memory ------------------------- #
+
+    def allocate(self, shape):
+        return self.handler.allocate(shape)
+
+    def allocate_activations(self, shape):
+        return self.handler.allocate_activations(shape)
+
+    def allocate_scratch(self, shape):
+        return self.handler.allocate_scratch(shape)
+
+    def release_scratch(self):
+        self.handler.release_scratch()
+
+    def ones(self, shape):
+        return self.handler.ones(shape)
+
+    def zeros(self, shape):
+        return self.handler.zeros(shape)
+
+    # ---------------------------- Copy and Fill ---------------------------- #
+
+    def create_from_numpy(self, arr):
+        return self.handler.create_from_numpy(arr)
+
+    def get_numpy_copy(self, mem):
+        return self.handler.get_numpy_copy(mem)
+
+    # ---------------------------- Debug helpers ---------------------------- #
+
+    def is_fully_finite(self, a):
+        return self.handler.is_fully_finite(a)
+
+
+def _create_recorded_operation(name):
+    def recorded_operation(self, *args, **kwargs):
+        operation = getattr(self.handler, name)
+        self.ops.append(partial(operation, *args, **kwargs))
+        return operation(*args, **kwargs)
+
+    recorded_operation.__name__ = str(name)
+    recorded_operation.__doc__ = getattr(Handler, name).__doc__
+    return recorded_operation
+
+
+# wrap all operations, including those with a default implementation
+for _name, _member in Handler.__dict__.items():
+    if callable(_member) and not _name.startswith('_') and \
+            _name not in RecordingHandler.__dict__:
+        setattr(RecordingHandler, _name, _create_recorded_operation(_name))
+RecordingHandler.__abstractmethods__ = frozenset()
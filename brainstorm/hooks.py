@@ -13,6 +13,7 @@ from six import string_types
 
 from brainstorm.describable import Describable
 from brainstorm import optional
+from brainstorm.handlers import ProfilingHandler
 from brainstorm.structure.network import Network
 from brainstorm.tools import evaluate
 from brainstorm.utils import get_by_path, progress_bar, get_brainstorm_info
@@ -308,6 +309,28 @@ class MonitorLayerInOuts(Hook):
         return log
 
 
+class MonitorProfile(Hook):
+    """
+    Monitor the operations profiled by the ProfilingHandler of the network.
+
+    The statistics are reset after every call, so each log entry covers the
+    operations since the previous one.
+    """
+    def start(self, net, stepper, verbose, named_data_iters):
+        super(MonitorProfile, self).start(net, stepper, verbose,
+                                          named_data_iters)
+        assert isinstance(net.handler, ProfilingHandler), \
+            "{} >> The network has to use a ProfilingHandler, but it uses " \
+            "{}.".format(self.__name__, net.handler.__class__.__name__)
+        net.handler.reset()
+
+    def __call__(self, epoch_nr, update_nr, net, stepper, logs):
+        self.message('\n' + net.handler.format_profile(max_rows=10))
+        profile = net.handler.get_profile()
+        net.handler.reset()
+        return profile
+
+
 class StopAfterEpoch(Hook):
     def __init__(self, max_epochs, timescale='epoch', interval=1, name=None,
                  verbose=None):
@@ -51,6 +51,13 @@ class Layer(object):
             List of outgoing connections
         handler (brainstorm.handlers.base_handler.Handler):
             The handler currently responsible for this layer
+        unused_input_deltas (frozenset[str]):
+            Names of the inputs whose deltas nobody uses. The backward pass
+            may skip computing them. Set by the network before every
+            backward pass.
+        frozen_parameters (frozenset[str]):
+            Names of the parameters that are not trained. The backward pass
+            may skip computing their gradients. Set by the network.
     """
     expected_kwargs = {}
     """Set of all kwargs that this layer accepts"""
@@ -74,6 +81,8 @@ class Layer(object):
         self.incoming = incoming_connections
         self.outgoing = outgoing_connections
         self.handler = None
+        self.unused_input_deltas = frozenset()
+        self.frozen_parameters = frozenset()
         self._validate_kwargs()
         self._validate_in_shapes()
         out, param, intern = self.setup(self.kwargs, self.in_shapes)
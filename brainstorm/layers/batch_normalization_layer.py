@@ -116,8 +116,8 @@ class BatchNormLayerImpl(Layer):
         indeltas = flatten_all_but_last(buffers.input_deltas.default)
         m = outdeltas.shape[0]
 
-        big_tmp = _h.allocate(x_hat.shape)     # big
-        small_tmp = _h.allocate(gamma.shape)  # small
+        big_tmp = _h.allocate_scratch(x_hat.shape)     # big
+        small_tmp = _h.allocate_scratch(gamma.shape)  # small
 
         # ------------- Gradients ---------------
         # Calculate dgamma
@@ -125,7 +125,8 @@ class BatchNormLayerImpl(Layer):
         dgamma_tmp = small_tmp
         _h.mult_tt(outdeltas, x_hat, tmp)
         _h.sum_t(tmp, axis=0, out=dgamma_tmp)
-        _h.add_tt(dgamma_tmp, dgamma, dgamma)
+        if 'gamma' not in self.frozen_parameters:
+            _h.add_tt(dgamma_tmp, dgamma, dgamma)
 
         _h.mult_st(1 / m, dgamma_tmp, dgamma_tmp)
         term1 = big_tmp
@@ -134,7 +135,8 @@ class BatchNormLayerImpl(Layer):
         # Calculate dbeta
         dbeta_tmp = small_tmp
         _h.sum_t(outdeltas, axis=0, out=dbeta_tmp)
-        _h.add_tt(dbeta_tmp, dbeta, dbeta)
+        if 'beta' not in self.frozen_parameters:
+            _h.add_tt(dbeta_tmp, dbeta, dbeta)
         _h.mult_st(1 / m, dbeta_tmp, dbeta_tmp)
 
         # ------------- Deltas ---------------
@@ -3,23 +3,26 @@
 from __future__ import division, print_function, unicode_literals
 from collections import OrderedDict
 from brainstorm.structure.construction import ConstructionWrapper
-from brainstorm.utils import LayerValidationError, flatten_time
+from brainstorm.utils import (LayerValidationError, flatten_time,
+                              get_checkpoint_interval, get_time_segments)
 from brainstorm.layers.base_layer import Layer
 from brainstorm.structure.buffer_structure import BufferStructure, \
     StructureTemplate
 
 
-def Clockwork(size, timing, activation='tanh', name=None):
+def Clockwork(size, timing, activation='tanh', checkpoint_interval=0,
+              name=None):
     return ConstructionWrapper.create(ClockworkLayerImpl,
                                       size=size,
                                       timing=timing,
                                       name=name,
-                                      activation=activation)
+                                      activation=activation,
+                                      checkpoint_interval=checkpoint_interval)
 
 
 class ClockworkLayerImpl(Layer):
     expected_inputs = {'default': StructureTemplate('T', 'B', 'F')}
-    expected_kwargs = {'size', 'timing', 'activation'}
+    expected_kwargs = {'size', 'timing', 'activation', 'checkpoint_interval'}
 
     computes_no_gradients_for = ['timing']
 
@@ -30,6 +33,7 @@ class ClockworkLayerImpl(Layer):
         if not isinstance(self.size, int):
             raise LayerValidationError('size must be int but was {}'.
                                        format(self.size))
+        self.checkpoint_interval = get_checkpoint_interval(kwargs)
 
         in_size = self.in_shapes['default'].feature_size
 
@@ -43,6 +47,8 @@ class ClockworkLayerImpl(Layer):
         parameters['timing'] = BufferStructure(self.size)
 
         internals = OrderedDict()
+        if self.checkpoint_interval:
+            return outputs, parameters, internals
         internals['Ha'] = BufferStructure('T', 'B', self.size, context_size=1)
         internals['dHa'] = BufferStructure('T', 'B', self.size, context_size=1,
                                            is_backward_only=True)
@@ -51,71 +57,149 @@ class ClockworkLayerImpl(Layer):
 
         return outputs, parameters, internals
 
-    def forward_pass(self, buffers, training_pass=True):
-        # prepare
+    def _get_inactive(self, t, timing, tmp, cond):
+        """Set cond to the units that are not updated in time step t."""
+        _h = self.handler
+        _h.fill(tmp, t)
+        _h.modulo_tt(tmp, timing, tmp)
+        _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
+
+    def _forward_steps(self, inputs, outputs, Ha, start, W, R, bias, timing,
+                       tmp, cond, recompute=False):
+        """Run the time steps starting at start for the given inputs.
+
+        The pre-activations Ha are indexed relative to start, the outputs
+        absolutely. If recompute is set, only the pre-activations are
+        computed and the outputs are left as they are.
+        """
         _h = self.handler
-        W, R, bias, timing = buffers.parameters
-        inputs = buffers.inputs.default
-        outputs = buffers.outputs.default
-        Ha = buffers.internals.Ha
-
         flat_inputs = flatten_time(inputs)
-        flat_H = flatten_time(Ha[:-1])
+        flat_H = flatten_time(Ha[:inputs.shape[0]])
 
         _h.dot_mm(flat_inputs, W, flat_H, transb=True)
         _h.add_mv(flat_H, bias.reshape((1, self.size)), flat_H)
 
-        tmp = _h.zeros(timing.shape)
-        cond = _h.zeros(outputs[0].shape)
-        for t in range(inputs.shape[0]):
-            _h.dot_add_mm(outputs[t - 1], R, Ha[t], transb=True)
-            _h.act_func[self.activation](Ha[t], outputs[t])
+        for t in range(start, start + inputs.shape[0]):
+            _h.dot_add_mm(outputs[t - 1], R, Ha[t - start], transb=True)
+            if recompute:
+                continue
+            _h.act_func[self.activation](Ha[t - start], outputs[t])
             # Undo updates
             if t > 0:
-                _h.fill(tmp, t)
-                _h.modulo_tt(tmp, timing, tmp)
-                _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
+                self._get_inactive(t, timing, tmp, cond)
                 _h.copy_to_if(outputs[t - 1], outputs[t], cond)
 
-    def backward_pass(self, buffers):
+    def forward_pass(self, buffers, training_pass=True):
         # prepare
         _h = self.handler
         W, R, bias, timing = buffers.parameters
-        dW, dR, dbias, dtiming = buffers.gradients
         inputs = buffers.inputs.default
         outputs = buffers.outputs.default
-        dinputs = buffers.input_deltas.default
-        doutputs = buffers.output_deltas.default
-        Ha, dHa, dHb = buffers.internals
-
-        tmp = _h.zeros(timing.shape)
-        cond = _h.zeros(outputs[0].shape)
-
-        _h.copy_to(doutputs, dHb)
-        T = inputs.shape[0] - 1
-        _h.act_func_deriv[self.activation](Ha[T], outputs[T], dHb[T], dHa[T])
-        for t in range(T - 1, -1, -1):
-            _h.fill(tmp, t + 1)
-            _h.modulo_tt(tmp, timing, tmp)
-            _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
+        tmp = _h.allocate_scratch(timing.shape)
+        cond = _h.allocate_scratch(outputs[0].shape)
+
+        if not self.checkpoint_interval:
+            self._forward_steps(inputs, outputs, buffers.internals.Ha, 0, W,
+                                R, bias, timing, tmp, cond)
+            return
+
+        k = self.checkpoint_interval
+        Ha = _h.allocate_scratch((k, inputs.shape[1], self.size))
+        for start, stop in get_time_segments(inputs.shape[0], k):
+            self._forward_steps(inputs[start:stop], outputs, Ha, start, W, R,
+                                bias, timing, tmp, cond)
+
+    def _backward_steps(self, outputs, Ha, dHa, dHb, start, stop, R, timing,
+                        tmp, cond):
+        """Backpropagate through the time steps from stop - 1 down to start.
+
+        The internals are indexed relative to start. dHb has to hold the
+        output deltas, and the entries of dHa and dHb after the last time
+        step the deltas of the following time step.
+        """
+        _h = self.handler
+        for t in range(stop - start - 1, -1, -1):
+            self._get_inactive(start + t + 1, timing, tmp, cond)
             _h.add_into_if(dHb[t + 1], dHb[t], cond)
-            _h.fill_if(dHa[t+1], 0.0, cond)
+            _h.fill_if(dHa[t + 1], 0.0, cond)
             _h.dot_add_mm(dHa[t + 1], R, dHb[t])
-            _h.act_func_deriv[self.activation](Ha[t], outputs[t], dHb[t],
-                                               dHa[t])
+            _h.act_func_deriv[self.activation](Ha[t], outputs[start + t],
+                                               dHb[t], dHa[t])
 
+    def _accumulate_gradients(self, inputs, dinputs, outputs, dHa, start, W,
+                              dW, dR, dbias, dbias_tmp):
+        """Add the input deltas and gradients of the time steps starting at
+        start."""
+        _h = self.handler
+        time_size = inputs.shape[0]
         flat_inputs = flatten_time(inputs)
         flat_dinputs = flatten_time(dinputs)
-        flat_dHa = flatten_time(dHa[:-1])
+        flat_dHa = flatten_time(dHa[:time_size])
 
         # Calculate in_deltas and gradients
-        _h.dot_add_mm(flat_dHa, W, flat_dinputs)
-        _h.dot_add_mm(flat_dHa, flat_inputs, dW, transa=True)
-        dbias_tmp = _h.allocate(dbias.shape)
-        _h.sum_t(flat_dHa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbias, dbias_tmp, dbias)
-
-        flat_outputs = flatten_time(outputs[:-2])
-        flat_dHa = flatten_time(dHa[1:-1])
-        _h.dot_add_mm(flat_dHa, flat_outputs, dR, transa=True)
-        _h.dot_add_mm(dHa[0], outputs[-1], dR, transa=True)
+        if 'default' not in self.unused_input_deltas:
+            _h.dot_add_mm(flat_dHa, W, flat_dinputs)
+        if 'W' not in self.frozen_parameters:
+            _h.dot_add_mm(flat_dHa, flat_inputs, dW, transa=True)
+        if 'bias' not in self.frozen_parameters:
+            _h.sum_t(flat_dHa, axis=0, out=dbias_tmp)
+            _h.add_tt(dbias, dbias_tmp, dbias)
+
+        if 'R' not in self.frozen_parameters:
+            flat_outputs = flatten_time(outputs[start:start + time_size - 1])
+            flat_dHa = flatten_time(dHa[1:time_size])
+            _h.dot_add_mm(flat_dHa, flat_outputs, dR, transa=True)
+            _h.dot_add_mm(dHa[0], outputs[start - 1], dR, transa=True)
+
+    def backward_pass(self, buffers):
+        # prepare
+        _h = self.handler
+        W, R, bias, timing = buffers.parameters
+        dW, dR, dbias, dtiming = buffers.gradients
+        inputs = buffers.inputs.default
+        outputs = buffers.outputs.default
+        dinputs = buffers.input_deltas.default
+        doutputs = buffers.output_deltas.default
+        dbias_tmp = _h.allocate_scratch(dbias.shape)
+        tmp = _h.allocate_scratch(timing.shape)
+        cond = _h.allocate_scratch(outputs[0].shape)
+
+        if not self.checkpoint_interval:
+            Ha, dHa, dHb = buffers.internals
+            _h.copy_to(doutputs, dHb)
+            T = inputs.shape[0] - 1
+            _h.act_func_deriv[self.activation](Ha[T], outputs[T], dHb[T],
+                                               dHa[T])
+            self._backward_steps(outputs, Ha, dHa, dHb, 0, T, R, timing, tmp,
+                                 cond)
+            self._accumulate_gradients(inputs, dinputs, outputs, dHa, 0, W,
+                                       dW, dR, dbias, dbias_tmp)
+            return
+
+        k = self.checkpoint_interval
+        # the internals of one segment plus the first time step of the
+        # following segment
+        Ha = _h.allocate_scratch((k + 1, inputs.shape[1], self.size))
+        dHa = _h.allocate_scratch(Ha.shape)
+        dHb = _h.allocate_scratch(Ha.shape)
+        segments = get_time_segments(inputs.shape[0], k)
+        last = segments[-1][1] - segments[-1][0]
+        _h.fill(dHa[last], 0.0)
+        _h.fill(dHb[last], 0.0)
+        for start, stop in reversed(segments):
+            # recompute the pre-activations from the stored outputs
+            self._forward_steps(inputs[start:stop], outputs, Ha, start, W, R,
+                                bias, timing, tmp, cond, recompute=True)
+            _h.copy_to(doutputs[start:stop], dHb[:stop - start])
+            self._backward_steps(outputs, Ha, dHa, dHb, start, stop, R,
+                                 timing, tmp, cond)
+            if start > 0:
+                # the preceding time step discards the deltas of the
+                # inactive units
+                self._get_inactive(start, timing, tmp, cond)
+                _h.fill_if(dHa[0], 0.0, cond)
+            self._accumulate_gradients(inputs[start:stop],
+                                       dinputs[start:stop], outputs, dHa,
+                                       start, W, dW, dR, dbias, dbias_tmp)
+            _h.copy_to(dHa[0], dHa[k])
+            _h.copy_to(dHb[0], dHb[k])
@@ -3,21 +3,24 @@
 from __future__ import division, print_function, unicode_literals
 from collections import OrderedDict
 from brainstorm.structure.construction import ConstructionWrapper
-from brainstorm.utils import LayerValidationError, flatten_time
+from brainstorm.utils import (LayerValidationError, flatten_time,
+                              get_checkpoint_interval, get_time_segments)
 from brainstorm.layers.base_layer import Layer
 from brainstorm.structure.buffer_structure import BufferStructure, StructureTemplate
 
 
-def ClockworkLstm(size, timing, activation='tanh', name=None):
+def ClockworkLstm(size, timing, activation='tanh', checkpoint_interval=0,
+                  name=None):
     return ConstructionWrapper.create(ClockworkLstmLayerImpl,
                                       size=size,
                                       timing=timing,
                                       name=name,
-                                      activation=activation)
+                                      activation=activation,
+                                      checkpoint_interval=checkpoint_interval)
 
 
 class ClockworkLstmLayerImpl(Layer):
-    expected_kwargs = {'size', 'timing', 'activation'}
+    expected_kwargs = {'size', 'timing', 'activation', 'checkpoint_interval'}
     expected_inputs = {'default': StructureTemplate('T', 'B', 'F')}
 
     computes_no_gradients_for = ['timing']
@@ -29,6 +32,7 @@ class ClockworkLstmLayerImpl(Layer):
         if not isinstance(self.size, int):
             raise LayerValidationError('size must be int but was {}'.
                                        format(self.size))
+        self.checkpoint_interval = get_checkpoint_interval(kwargs)
 
         in_size = in_shapes['default'].feature_size
 
@@ -58,6 +62,10 @@ class ClockworkLstmLayerImpl(Layer):
         parameters['timing'] = BufferStructure(self.size)
 
         internals = OrderedDict()
+        if self.checkpoint_interval:
+            internals['Ca'] = BufferStructure('T', 'B', self.size,
+                                              context_size=1)
+            return outputs, parameters, internals
         internals['Za'] = BufferStructure('T', 'B', self.size, context_size=1)
         internals['Zb'] = BufferStructure('T', 'B', self.size, context_size=1)
         internals['Ia'] = BufferStructure('T', 'B', self.size, context_size=1)
@@ -92,241 +100,344 @@ class ClockworkLstmLayerImpl(Layer):
 
         return outputs, parameters, internals
 
-    def forward_pass(self, buffers, training_pass=True):
-        # prepare
+    def _get_inactive(self, t, timing, tmp, cond):
+        """Set cond to the units that are not updated in time step t."""
+        _h = self.handler
+        _h.fill(tmp, t)
+        _h.modulo_tt(tmp, timing, tmp)
+        _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
+
+    def _forward_steps(self, x, y, Ca, activations, start, parameters, tmp,
+                       cond, cell=None):
+        """Run the time steps starting at start for the inputs x.
+
+        The activations (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Cb) are indexed
+        relative to start, the outputs y and cell states Ca absolutely. If
+        cell is given, the new cell states are written to it and y and Ca are
+        left as they are, which is used for recomputing the activations from
+        the stored states.
+        """
         _h = self.handler
         (Wz, Wi, Wf, Wo,
          pi, pf, po,
          Rz, Ri, Rf, Ro,
          bz, bi, bf, bo,
-         timing) = buffers.parameters
-
-        (Za, Zb,
-         Ia, Ib,
-         Fa, Fb,
-         Oa, Ob,
-         Ca, Cb,
-         dZa, dZb,
-         dIa, dIb,
-         dFa, dFb,
-         dOa, dOb,
-         dCa, dCb) = buffers.internals
-        x = buffers.inputs.default
-        y = buffers.outputs.default
-        time_size, batch_size, in_size = x.shape
-
-        # Temporary variable to be filled with the current value of time t
-        tmp = _h.zeros(timing.shape)
-        cond = _h.zeros(y[0].shape)
+         timing) = parameters
+        Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Cb = activations
+        time_size = x.shape[0]
 
         flat_x = flatten_time(x)
-        flat_Za = flatten_time(Za[:-1])
-        flat_Ia = flatten_time(Ia[:-1])
-        flat_Fa = flatten_time(Fa[:-1])
-        flat_Oa = flatten_time(Oa[:-1])
+        flat_Za = flatten_time(Za[:time_size])
+        flat_Ia = flatten_time(Ia[:time_size])
+        flat_Fa = flatten_time(Fa[:time_size])
+        flat_Oa = flatten_time(Oa[:time_size])
         _h.dot_mm(flat_x, Wz, flat_Za, transb=True)
         _h.dot_mm(flat_x, Wi, flat_Ia, transb=True)
         _h.dot_mm(flat_x, Wf, flat_Fa, transb=True)
         _h.dot_mm(flat_x, Wo, flat_Oa, transb=True)
 
-        for t in range(time_size):
+        for t in range(start, start + time_size):
+            i = t - start
+            c = Ca[t] if cell is None else cell
 
             # Block input
-            _h.dot_add_mm(y[t - 1], Rz, Za[t], transb=True)
-            _h.add_mv(Za[t], bz.reshape((1, self.size)), Za[t])
-            _h.act_func[self.activation](Za[t], Zb[t])
+            _h.dot_add_mm(y[t - 1], Rz, Za[i], transb=True)
+            _h.add_mv(Za[i], bz.reshape((1, self.size)), Za[i])
+            _h.act_func[self.activation](Za[i], Zb[i])
 
             # Input Gate
-            _h.dot_add_mm(y[t - 1], Ri, Ia[t], transb=True)
-            _h.mult_add_mv(Ca[t - 1], pi, Ia[t])  # ADDED PEEPHOLE CONNECTION
-            _h.add_mv(Ia[t], bi.reshape((1, self.size)), Ia[t])
-            _h.sigmoid(Ia[t], Ib[t])
+            _h.dot_add_mm(y[t - 1], Ri, Ia[i], transb=True)
+            _h.mult_add_mv(Ca[t - 1], pi, Ia[i])  # ADDED PEEPHOLE CONNECTION
+            _h.add_mv(Ia[i], bi.reshape((1, self.size)), Ia[i])
+            _h.sigmoid(Ia[i], Ib[i])
 
             # Forget Gate
-            _h.dot_add_mm(y[t - 1], Rf, Fa[t], transb=True)
-            _h.mult_add_mv(Ca[t - 1], pf, Fa[t])  # ADDED PEEPHOLE CONNECTION
-            _h.add_mv(Fa[t], bf.reshape((1, self.size)), Fa[t])
-            _h.sigmoid(Fa[t], Fb[t])
+            _h.dot_add_mm(y[t - 1], Rf, Fa[i], transb=True)
+            _h.mult_add_mv(Ca[t - 1], pf, Fa[i])  # ADDED PEEPHOLE CONNECTION
+            _h.add_mv(Fa[i], bf.reshape((1, self.size)), Fa[i])
+            _h.sigmoid(Fa[i], Fb[i])
 
             # Cell
-            _h.mult_tt(Ib[t], Zb[t], Ca[t])
-            _h.mult_add_tt(Fb[t], Ca[t - 1], Ca[t])
+            _h.mult_tt(Ib[i], Zb[i], c)
+            _h.mult_add_tt(Fb[i], Ca[t - 1], c)
 
             # Output Gate
-            _h.dot_add_mm(y[t - 1], Ro, Oa[t], transb=True)
-            _h.mult_add_mv(Ca[t], po, Oa[t])  # ADDED PEEPHOLE CONNECTION
-            _h.add_mv(Oa[t], bo.reshape((1, self.size)), Oa[t])
-            _h.sigmoid(Oa[t], Ob[t])
+            _h.dot_add_mm(y[t - 1], Ro, Oa[i], transb=True)
+            _h.mult_add_mv(c, po, Oa[i])  # ADDED PEEPHOLE CONNECTION
+            _h.add_mv(Oa[i], bo.reshape((1, self.size)), Oa[i])
+            _h.sigmoid(Oa[i], Ob[i])
 
             # Block output
-            _h.act_func[self.activation](Ca[t], Cb[t])
-            _h.mult_tt(Ob[t], Cb[t], y[t])
+            _h.act_func[self.activation](c, Cb[i])
+            if cell is not None:
+                continue
+            _h.mult_tt(Ob[i], Cb[i], y[t])
 
             if t > 0:
-                _h.fill(tmp, t)
-                _h.modulo_tt(tmp, timing, tmp)
-                _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
-
-            # Reset Cell
-                _h.copy_to_if(Ca[t-1], Ca[t], cond)
-            # Reset Block output
-                _h.copy_to_if(y[t-1], y[t], cond)
+                self._get_inactive(t, timing, tmp, cond)
+                # Reset Cell
+                _h.copy_to_if(Ca[t - 1], Ca[t], cond)
+                # Reset Block output
+                _h.copy_to_if(y[t - 1], y[t], cond)
 
-    def backward_pass(self, buffers):
+    def forward_pass(self, buffers, training_pass=True):
         # prepare
         _h = self.handler
-
-        (dWz, dWi, dWf, dWo,
-         dpi, dpf, dpo,
-         dRz, dRi, dRf, dRo,
-         dbz, dbi, dbf, dbo,
-         dtiming) = buffers.gradients
-
-        (Wz, Wi, Wf, Wo,
-         pi, pf, po,
-        Rz, Ri, Rf, Ro,
-        bz, bi, bf, bo,
-        timing) = buffers.parameters
-
-        (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Ca, Cb,
-         dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb) = buffers.internals
-
         x = buffers.inputs.default
-        dx = buffers.input_deltas.default
         y = buffers.outputs.default
-        deltas = buffers.output_deltas.default
-
-        dy = _h.allocate(y.shape)
-
         time_size, batch_size, in_size = x.shape
+        timing = buffers.parameters.timing
 
         # Temporary variable to be filled with the current value of time t
-        tmp = _h.zeros(timing.shape)
-
-        _h.fill(dCa, 0.0)
-        cond = _h.zeros(y[0].shape)
+        tmp = _h.allocate_scratch(timing.shape)
+        cond = _h.allocate_scratch(y[0].shape)
+
+        if not self.checkpoint_interval:
+            internals = buffers.internals
+            activations = (internals.Za, internals.Zb, internals.Ia,
+                           internals.Ib, internals.Fa, internals.Fb,
+                           internals.Oa, internals.Ob, internals.Cb)
+            self._forward_steps(x, y, internals.Ca, activations, 0,
+                                buffers.parameters, tmp, cond)
+            return
+
+        k = self.checkpoint_interval
+        activations = [_h.allocate_scratch((k, batch_size, self.size))
+                       for _ in range(9)]
+        for start, stop in get_time_segments(time_size, k):
+            self._forward_steps(x[start:stop], y, buffers.internals.Ca,
+                                activations, start, buffers.parameters, tmp,
+                                cond)
+
+    def _backward_steps(self, deltas, Ca, activations, internal_deltas, start,
+                        parameters, dy, dy_prev, dCa_prev, tmp, cond):
+        """Backpropagate through the time steps starting at start.
+
+        Like in :meth:`_forward_steps`, the activations, the internal deltas
+        (dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb) and the deltas dy
+        of the outputs are indexed relative to start. The entries after the
+        last time step have to hold the values of the following time step.
+        The deltas that inactive units pass on from the first time step to
+        the preceding one are added to dy_prev and dCa_prev.
+        """
+        _h = self.handler
+        (Wz, Wi, Wf, Wo,
+         pi, pf, po,
+         Rz, Ri, Rf, Ro,
+         bz, bi, bf, bo,
+         timing) = parameters
+        Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Cb = activations
+        dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb = internal_deltas
 
-        for t in range(time_size - 1, -1, - 1):
+        for i in range(deltas.shape[0] - 1, -1, -1):
+            t = start + i
             # Accumulate recurrent deltas
-            _h.add_tt(dy[t], deltas[t], dy[t])
-            _h.fill(tmp, t)
-            _h.modulo_tt(tmp, timing, tmp)
-            _h.broadcast_t(tmp.reshape((1, tmp.shape[0])), 0, cond)
+            _h.add_tt(dy[i], deltas[i], dy[i])
+            self._get_inactive(t, timing, tmp, cond)
 
-            _h.dot_add_mm(dIa[t + 1], Ri, dy[t])
-            _h.dot_add_mm(dFa[t + 1], Rf, dy[t])
-            _h.dot_add_mm(dOa[t + 1], Ro, dy[t])
-            _h.dot_add_mm(dZa[t + 1], Rz, dy[t])
+            _h.dot_add_mm(dIa[i + 1], Ri, dy[i])
+            _h.dot_add_mm(dFa[i + 1], Rf, dy[i])
+            _h.dot_add_mm(dOa[i + 1], Ro, dy[i])
+            _h.dot_add_mm(dZa[i + 1], Rz, dy[i])
 
-            _h.mult_add_mv(dIa[t + 1], pi, dCa[t])
-            _h.mult_add_mv(dFa[t + 1], pf, dCa[t])
+            _h.mult_add_mv(dIa[i + 1], pi, dCa[i])
+            _h.mult_add_mv(dFa[i + 1], pf, dCa[i])
 
             # Output Gate
-            _h.mult_tt(dy[t], Cb[t], dOb[t])
-            _h.fill_if(dOb[t], 0, cond)  # Set inactive to 0
-            _h.sigmoid_deriv(Oa[t], Ob[t], dOb[t], dOa[t])
+            _h.mult_tt(dy[i], Cb[i], dOb[i])
+            _h.fill_if(dOb[i], 0, cond)  # Set inactive to 0
+            _h.sigmoid_deriv(Oa[i], Ob[i], dOb[i], dOa[i])
             # Output influence on peephole:
-            _h.mult_add_mv(dOa[t], po, dCa[t])
+            _h.mult_add_mv(dOa[i], po, dCa[i])
 
             # Cell
-            _h.mult_tt(dy[t], Ob[t], dCb[t])
-            _h.act_func_deriv[self.activation](Ca[t], Cb[t], dCb[t], dCb[t])  # Important change to standard LSTM
-            _h.fill_if(dCb[t], 0, cond)
-            _h.add_tt(dCa[t], dCb[t], dCa[t])
-            _h.mult_add_tt(dCa[t + 1], Fb[t + 1], dCa[t])
+            _h.mult_tt(dy[i], Ob[i], dCb[i])
+            _h.act_func_deriv[self.activation](Ca[t], Cb[i], dCb[i], dCb[i])  # Important change to standard LSTM
+            _h.fill_if(dCb[i], 0, cond)
+            _h.add_tt(dCa[i], dCb[i], dCa[i])
+            _h.mult_add_tt(dCa[i + 1], Fb[i + 1], dCa[i])
 
             # Forget Gate
-            _h.mult_tt(dCa[t], Ca[t - 1], dFb[t])
-            _h.sigmoid_deriv(Fa[t], Fb[t], dFb[t], dFa[t])
+            _h.mult_tt(dCa[i], Ca[t - 1], dFb[i])
+            _h.sigmoid_deriv(Fa[i], Fb[i], dFb[i], dFa[i])
 
             # Input Gate
-            _h.mult_tt(dCa[t], Zb[t], dIb[t])
-            _h.sigmoid_deriv(Ia[t], Ib[t], dIb[t], dIa[t])
+            _h.mult_tt(dCa[i], Zb[i], dIb[i])
+            _h.sigmoid_deriv(Ia[i], Ib[i], dIb[i], dIa[i])
 
             # Block Input
-            _h.mult_tt(dCa[t], Ib[t], dZb[t])
-            _h.act_func_deriv[self.activation](Za[t], Zb[t], dZb[t], dZa[t])
+            _h.mult_tt(dCa[i], Ib[i], dZb[i])
+            _h.act_func_deriv[self.activation](Za[i], Zb[i], dZb[i], dZa[i])
 
             # Copy over the error from previous inactive nodes
-            _h.add_into_if(dy[t], dy[t-1], cond)
-            _h.add_into_if(dCa[t], dCa[t-1], cond)
+            _h.add_into_if(dy[i], dy[i - 1] if i > 0 else dy_prev, cond)
+            _h.add_into_if(dCa[i], dCa[i - 1] if i > 0 else dCa_prev, cond)
 
             # Undo updates to inactive nodes:
-            _h.fill_if(dIa[t], 0, cond)
-            _h.fill_if(dFa[t], 0, cond)
-            _h.fill_if(dZa[t], 0, cond)
-            _h.fill_if(Fb[t], 0, cond)
+            _h.fill_if(dIa[i], 0, cond)
+            _h.fill_if(dFa[i], 0, cond)
+            _h.fill_if(dZa[i], 0, cond)
+            _h.fill_if(Fb[i], 0, cond)
+
+    def _accumulate_gradients(self, x, dx, y, Ca, internal_deltas, start,
+                              parameters, gradients, tmp, dbias_tmp, dpeep):
+        """Add the input deltas and gradients of the time steps starting at
+        start.
+
+        tmp, dbias_tmp and dpeep are temporaries, where tmp has to have room
+        for the cell states of all these time steps.
+        """
+        _h = self.handler
+        (Wz, Wi, Wf, Wo,
+         pi, pf, po,
+         Rz, Ri, Rf, Ro,
+         bz, bi, bf, bo,
+         timing) = parameters
+        (dWz, dWi, dWf, dWo,
+         dpi, dpf, dpo,
+         dRz, dRi, dRf, dRo,
+         dbz, dbi, dbf, dbo,
+         dtiming) = gradients
+        dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb = internal_deltas
+        time_size, batch_size = x.shape[:2]
 
         # Same as for standard RNN:
         flat_inputs = flatten_time(x)
         flat_dinputs = flatten_time(dx)
 
-        flat_dIa = flatten_time(dIa[:-1])
-        flat_dFa = flatten_time(dFa[:-1])
-        flat_dOa = flatten_time(dOa[:-1])
-        flat_dZa = flatten_time(dZa[:-1])
+        gates = (('i', dIa, Wi, dWi, dbi, dRi), ('f', dFa, Wf, dWf, dbf, dRf),
+                 ('o', dOa, Wo, dWo, dbo, dRo), ('z', dZa, Wz, dWz, dbz, dRz))
+        frozen = self.frozen_parameters
 
         # calculate in_deltas and gradients
-        _h.dot_add_mm(flat_dIa, Wi, flat_dinputs)
-        _h.dot_add_mm(flat_dFa, Wf, flat_dinputs)
-        _h.dot_add_mm(flat_dOa, Wo, flat_dinputs)
-        _h.dot_add_mm(flat_dZa, Wz, flat_dinputs)
-
-        _h.dot_add_mm(flat_dIa, flat_inputs, dWi, transa=True)
-        _h.dot_add_mm(flat_dFa, flat_inputs, dWf, transa=True)
-        _h.dot_add_mm(flat_dOa, flat_inputs, dWo, transa=True)
-        _h.dot_add_mm(flat_dZa, flat_inputs, dWz, transa=True)
-
-        dbias_tmp = _h.allocate(dbz.shape)
-        _h.sum_t(flat_dIa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbi, dbias_tmp, dbi)
-        _h.sum_t(flat_dFa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbf, dbias_tmp, dbf)
-        _h.sum_t(flat_dOa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbo, dbias_tmp, dbo)
-        _h.sum_t(flat_dZa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbz, dbias_tmp, dbz)
-
-        flat_outputs = flatten_time(y[:-2])
-
-        flat_cell = flatten_time(Ca[:-2])
-        flat_cell2 = flatten_time(Ca[:-1])
-
-        dWco_tmp = _h.allocate(flat_cell2.shape)
-        dWc_tmp = _h.allocate(dpo.shape)
-        # Peephole connection output weight:
-        _h.mult_tt(flat_cell2, flat_dOa, dWco_tmp)
-        _h.sum_t(dWco_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpo, dWc_tmp, dpo)
+        if 'default' not in self.unused_input_deltas:
+            for g, da, W, dW, db, dR in gates:
+                _h.dot_add_mm(flatten_time(da[:time_size]), W, flat_dinputs)
+        for g, da, W, dW, db, dR in gates:
+            if 'W' + g not in frozen:
+                _h.dot_add_mm(flatten_time(da[:time_size]), flat_inputs, dW,
+                              transa=True)
+            if 'b' + g not in frozen:
+                _h.sum_t(flatten_time(da[:time_size]), axis=0, out=dbias_tmp)
+                _h.add_tt(db, dbias_tmp, db)
+
+        # the first time step is connected to the preceding one (or the
+        # context slice)
+        flat_outputs = flatten_time(y[start:start + time_size - 1])
+        for g, da, W, dW, db, dR in gates:
+            if 'R' + g not in frozen:
+                _h.dot_add_mm(flatten_time(da[1:time_size]), flat_outputs,
+                              dR, transa=True)
+                _h.dot_add_mm(da[0], y[start - 1], dR, transa=True)
+
+        self._accumulate_peephole_gradients(Ca, dIa, dFa, dOa, start,
+                                            time_size, (dpi, dpf, dpo), tmp,
+                                            dpeep)
+
+    def _accumulate_peephole_gradients(self, Ca, dIa, dFa, dOa, start,
+                                       time_size, dpeepholes, tmp, dpeep):
+        """Add the peephole gradients of the time steps starting at start."""
+        _h = self.handler
+        dpi, dpf, dpo = dpeepholes
+        batch_size = dIa.shape[1]
+        frozen = self.frozen_parameters
 
-        flat_dIa = flatten_time(dIa[1:-1])
-        flat_dFa = flatten_time(dFa[1:-1])
-        flat_dOa = flatten_time(dOa[1:-1])
-        flat_dZa = flatten_time(dZa[1:-1])
+        # Peephole connection output weight:
+        if 'po' not in frozen:
+            flat_cell = flatten_time(Ca[start:start + time_size])
+            flat_tmp = tmp[:flat_cell.shape[0]]
+            _h.mult_tt(flat_cell, flatten_time(dOa[:time_size]), flat_tmp)
+            _h.sum_t(flat_tmp, axis=0, out=dpeep)
+            _h.add_tt(dpo, dpeep, dpo)
 
-        _h.dot_add_mm(flat_dIa, flat_outputs, dRi, transa=True)
-        _h.dot_add_mm(flat_dFa, flat_outputs, dRf, transa=True)
-        _h.dot_add_mm(flat_dOa, flat_outputs, dRo, transa=True)
-        _h.dot_add_mm(flat_dZa, flat_outputs, dRz, transa=True)
+        # Other Peephole connections
+        flat_cell = flatten_time(Ca[start:start + time_size - 1])
+        flat_tmp = tmp[:flat_cell.shape[0]]
+        for da, dp, name in ((dIa, dpi, 'pi'), (dFa, dpf, 'pf')):
+            if name in frozen:
+                continue
+            _h.mult_tt(flat_cell, flatten_time(da[1:time_size]), flat_tmp)
+            _h.sum_t(flat_tmp, axis=0, out=dpeep)
+            _h.add_tt(dp, dpeep, dp)
+            _h.mult_tt(Ca[start - 1], da[0], tmp[:batch_size])
+            _h.sum_t(tmp[:batch_size], axis=0, out=dpeep)
+            _h.add_tt(dp, dpeep, dp)
 
-        _h.dot_add_mm(dIa[0], dy[-1], dRi, transa=True)
-        _h.dot_add_mm(dFa[0], dy[-1], dRf, transa=True)
-        _h.dot_add_mm(dOa[0], dy[-1], dRo, transa=True)
-        _h.dot_add_mm(dZa[0], dy[-1], dRz, transa=True)
+    def backward_pass(self, buffers):
+        # prepare
+        _h = self.handler
+        parameters = buffers.parameters
+        gradients = buffers.gradients
+        x = buffers.inputs.default
+        dx = buffers.input_deltas.default
+        y = buffers.outputs.default
+        deltas = buffers.output_deltas.default
+        time_size, batch_size, in_size = x.shape
+        n = self.size
 
-        # Other Peephole connections
-        dWcif_tmp = _h.allocate(flat_cell.shape)
-        _h.mult_tt(flat_cell, flat_dIa, dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpi, dWc_tmp, dpi)
-        _h.mult_tt(flat_cell, flat_dFa, dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpf, dWc_tmp, dpf)
-
-        dWcif_tmp = _h.allocate(dIa[0].shape)
-        _h.mult_tt(dCa[-1], dIa[0], dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpi, dWc_tmp, dpi)
-        _h.mult_tt(dCa[-1], dIa[0], dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpf, dWc_tmp, dpf)
+        # Temporary variable to be filled with the current value of time t
+        tmp = _h.allocate_scratch(parameters.timing.shape)
+        cond = _h.allocate_scratch(y[0].shape)
+        dbias_tmp = _h.allocate_scratch(gradients.bz.shape)
+        dpeep = _h.allocate_scratch(gradients.po.shape)
+
+        if not self.checkpoint_interval:
+            (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Ca, Cb,
+             dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb) = \
+                buffers.internals
+            dy = _h.allocate_scratch(y.shape)
+            _h.fill(dy, 0.0)
+            _h.fill(dCa, 0.0)
+            internal_deltas = (dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa,
+                               dCb)
+            self._backward_steps(deltas[:time_size], Ca,
+                                 (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Cb),
+                                 internal_deltas, 0, parameters, dy, dy[-1],
+                                 dCa[-1], tmp, cond)
+            cells = _h.allocate_scratch((time_size * batch_size, n))
+            self._accumulate_gradients(x, dx, y, Ca, internal_deltas, 0,
+                                       parameters, gradients, cells,
+                                       dbias_tmp, dpeep)
+            return
+
+        Ca = buffers.internals.Ca
+        k = self.checkpoint_interval
+        # the internals of one segment plus the first time step of the
+        # following segment
+        activations = [_h.allocate_scratch((k + 1, batch_size, n))
+                       for _ in range(9)]
+        internal_deltas = [_h.allocate_scratch((k + 1, batch_size, n))
+                           for _ in range(10)]
+        Fb = activations[5]
+        dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb = internal_deltas
+        carried = (Fb, dZa, dIa, dFa, dOa, dCa)
+        dy = _h.allocate_scratch((k, batch_size, n))
+        # deltas that inactive units pass on to the preceding segment
+        dy_prev = _h.allocate_scratch(y[0].shape)
+        dCa_prev = _h.allocate_scratch(y[0].shape)
+        cell = _h.allocate_scratch(y[0].shape)
+        cells = _h.allocate_scratch((k * batch_size, n))
+
+        segments = get_time_segments(time_size, k)
+        last = segments[-1][1] - segments[-1][0]
+        for buf in carried:
+            _h.fill(buf[last], 0.0)
+        _h.fill(dy_prev, 0.0)
+        _h.fill(dCa_prev, 0.0)
+        for start, stop in reversed(segments):
+            # recompute the activations of this segment from the stored
+            # outputs and cell states
+            self._forward_steps(x[start:stop], y, Ca, activations, start,
+                                parameters, tmp, cond, cell)
+            for d, d_prev in ((dy, dy_prev), (dCa, dCa_prev)):
+                _h.fill(d[:stop - start], 0.0)
+                _h.copy_to(d_prev, d[stop - start - 1])
+                _h.fill(d_prev, 0.0)
+            self._backward_steps(deltas[start:stop], Ca, activations,
+                                 internal_deltas, start, parameters, dy,
+                                 dy_prev, dCa_prev, tmp, cond)
+            self._accumulate_gradients(x[start:stop], dx[start:stop], y, Ca,
+                                       internal_deltas, start, parameters,
+                                       gradients, cells, dbias_tmp, dpeep)
+            for buf in carried:
+                _h.copy_to(buf[0], buf[k])
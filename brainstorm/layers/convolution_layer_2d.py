@@ -11,14 +11,20 @@ from brainstorm.utils import flatten_time
 
 
 def Convolution2D(num_filters, kernel_size, stride=(1, 1), padding=0,
-                  activation='rel', name=None):
-    """Create a 2D Convolution layer."""
+                  activation='rel', algorithm='auto', name=None):
+    """Create a 2D Convolution layer.
+
+    The algorithm can be 'im2col', 'winograd' (only for 3x3 kernels with
+    stride 1), 'fft', which pays off for large kernels, or 'auto' (the
+    default), which lets the handler pick the fastest one for each shape.
+    """
     return ConstructionWrapper.create(Convolution2DLayerImpl,
                                       num_filters=num_filters,
                                       kernel_size=kernel_size,
                                       stride=stride,
                                       padding=padding,
                                       activation=activation,
+                                      algorithm=algorithm,
                                       name=name)
 
 
@@ -26,7 +32,7 @@ class Convolution2DLayerImpl(Layer):
 
     expected_inputs = {'default': StructureTemplate('T', 'B', '...')}
     expected_kwargs = {'num_filters', 'kernel_size', 'stride', 'padding',
-                       'activation'}
+                       'activation', 'algorithm'}
 
     def setup(self, kwargs, in_shapes):
         self.activation = kwargs.get('activation', 'tanh')
@@ -46,6 +52,13 @@ class Convolution2DLayerImpl(Layer):
                                         self.kernel_size)
         assert type(self.stride) in [list, tuple] and len(self.stride) == 2, \
             "Stride must be list or tuple of length 2: {}".format(self.stride)
+        self.algorithm = kwargs.get('algorithm', 'auto')
+        assert self.algorithm in ['im2col', 'winograd', 'fft', 'auto'], \
+            "Invalid algorithm: {}".format(self.algorithm)
+        assert self.algorithm != 'winograd' or (
+            tuple(self.kernel_size) == (3, 3) and self.stride == (1, 1)), \
+            "The winograd algorithm needs kernel_size (3, 3) and stride " \
+            "(1, 1) but got {} and {}".format(self.kernel_size, self.stride)
         in_shape = self.in_shapes['default'].feature_shape
         assert self.stride[0] >= 0 and self.stride[1] >= 0, \
             "Invalid stride: {}".format(self.stride)
@@ -86,7 +99,8 @@ class Convolution2DLayerImpl(Layer):
 
         # calculate outputs
         _h.conv2d_forward_batch(flat_inputs, W, bias, flat_outputs,
-                                self.padding, self.stride)
+                                self.padding, self.stride,
+                                algorithm=self.algorithm)
         _h.inplace_act_func[self.activation](outputs)
 
     def backward_pass(self, buffers):
@@ -101,10 +115,16 @@ class Convolution2DLayerImpl(Layer):
 
         # reshape
         flat_inputs = flatten_time(inputs)
-        flat_in_deltas = flatten_time(in_deltas)
+        flat_in_deltas = None if 'default' in self.unused_input_deltas \
+            else flatten_time(in_deltas)
         flat_out_deltas = flatten_time(out_deltas)
+        if 'W' in self.frozen_parameters:
+            dW = None
+        if 'bias' in self.frozen_parameters:
+            dbias = None
 
         # calculate in_deltas and gradients
         _h.inplace_act_func_deriv[self.activation](outputs, out_deltas)
         _h.conv2d_backward_batch(flat_inputs, W, self.padding, self.stride,
-                                 flat_in_deltas, flat_out_deltas, dW, dbias)
+                                 flat_in_deltas, flat_out_deltas, dW, dbias,
+                                 algorithm=self.algorithm)
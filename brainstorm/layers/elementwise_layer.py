@@ -32,7 +32,8 @@ class ElementwiseLayerImpl(Layer):
                                                buffers.outputs.default)
 
     def backward_pass(self, buffers):
-        tmp = self.handler.allocate(buffers.input_deltas.default.shape)
+        tmp = self.handler.allocate_scratch(
+            buffers.input_deltas.default.shape)
         self.handler.act_func_deriv[self.activation](
             buffers.inputs.default, buffers.outputs.default,
             buffers.output_deltas.default, tmp)
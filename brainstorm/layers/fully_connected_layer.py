@@ -73,6 +73,9 @@ class FullyConnectedLayerImpl(Layer):
 
         # calculate in_deltas and gradients
         _h.inplace_act_func_deriv[self.activation](outputs, out_deltas)
-        _h.dot_add_mm(out_deltas, W, out=in_deltas)
-        _h.dot_mm(out_deltas, inputs, out=dW, transa=True)
-        _h.sum_t(out_deltas, axis=0, out=dbias)
+        if 'default' not in self.unused_input_deltas:
+            _h.dot_add_mm(out_deltas, W, out=in_deltas)
+        if 'W' not in self.frozen_parameters:
+            _h.dot_mm(out_deltas, inputs, out=dW, transa=True)
+        if 'bias' not in self.frozen_parameters:
+            _h.sum_t(out_deltas, axis=0, out=dbias)
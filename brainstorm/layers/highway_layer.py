@@ -45,7 +45,7 @@ class HighwayLayerImpl(Layer):
         T = buffers.inputs.T
         y = buffers.outputs.default
 
-        tmp = _h.zeros(x.shape)
+        tmp = _h.allocate_scratch(x.shape)
         _h.subtract_tt(H, x, out=tmp)
         _h.mult_tt(T, tmp, out=tmp)
         _h.add_tt(tmp, x, out=y)
@@ -61,7 +61,8 @@ class HighwayLayerImpl(Layer):
         dT = buffers.input_deltas.T
         dy = buffers.output_deltas.default
 
-        tmp = _h.ones(dx.shape)
+        tmp = _h.allocate_scratch(dx.shape)
+        _h.fill(tmp, 1.0)
         _h.subtract_tt(tmp, T, out=tmp)
         _h.mult_add_tt(tmp, dy, out=dx)
 
@@ -36,7 +36,8 @@ class InputLayerImpl(Layer):
 
         outputs = OrderedDict()
         for n, s in self.kwargs['out_shapes'].items():
-            outputs[n] = BufferStructure(*s)
+            # external data might contain targets like class indices
+            outputs[n] = BufferStructure(*s, is_full_precision=True)
         return outputs, OrderedDict(), OrderedDict()
 
     def _validate_connections(self):
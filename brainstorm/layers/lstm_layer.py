@@ -8,19 +8,40 @@ from brainstorm.layers.base_layer import Layer
 from brainstorm.structure.buffer_structure import (BufferStructure,
                                                    StructureTemplate)
 from brainstorm.structure.construction import ConstructionWrapper
-from brainstorm.utils import LayerValidationError, flatten_time
+from brainstorm.utils import (LayerValidationError, flatten_time,
+                              get_checkpoint_interval, get_time_segments)
 
 
-def Lstm(size, activation='tanh', name=None):
-    """Create an LSTM layer."""
+def Lstm(size, activation='tanh', checkpoint_interval=0, name=None):
+    """Create an LSTM layer.
+
+    The pre-activations and activations of the gates are stored stacked in
+    the internals ``Ga`` and ``Gb`` (and their deltas in ``dGa``) with
+    4 * size features, in the order block input, input gate, forget gate,
+    output gate. So e.g. the forget gate activations are
+    ``net.get('Lstm.internals.Gb')[..., 2 * size:3 * size]``.
+
+    If checkpoint_interval is k > 0, only the outputs and cell states are
+    stored for every time step. The gate activations are recomputed in
+    segments of k time steps during the backward pass, so the memory for
+    them and for the backward internals doesn't grow with the sequence
+    length.
+    """
     return ConstructionWrapper.create(LstmLayerImpl, size=size,
-                                      name=name, activation=activation)
+                                      name=name, activation=activation,
+                                      checkpoint_interval=checkpoint_interval)
 
 
 class LstmLayerImpl(Layer):
 
     expected_inputs = {'default': StructureTemplate('T', 'B', 'F')}
-    expected_kwargs = {'size', 'activation'}
+    expected_kwargs = {'size', 'activation', 'checkpoint_interval'}
+
+    # names of the per-gate parameters in the order they are stacked
+    _W_NAMES = ('Wz', 'Wi', 'Wf', 'Wo')
+    _R_NAMES = ('Rz', 'Ri', 'Rf', 'Ro')
+    _BIAS_NAMES = ('bz', 'bi', 'bf', 'bo')
+    _PEEPHOLE_NAMES = ('pi', 'pf', 'po')
 
     def setup(self, kwargs, in_shapes):
         self.activation = kwargs.get('activation', 'tanh')
@@ -29,6 +50,7 @@ class LstmLayerImpl(Layer):
         if not isinstance(self.size, int):
             raise LayerValidationError('size must be int but was {}'.
                                        format(self.size))
+        self.checkpoint_interval = get_checkpoint_interval(kwargs)
 
         outputs = OrderedDict()
         outputs['default'] = BufferStructure('T', 'B', self.size,
@@ -54,224 +76,269 @@ class LstmLayerImpl(Layer):
         parameters['bo'] = BufferStructure(self.size)
 
         internals = OrderedDict()
-        internals['Za'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Zb'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Ia'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Ib'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Fa'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Fb'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Oa'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['Ob'] = BufferStructure('T', 'B', self.size, context_size=1)
+        if self.checkpoint_interval:
+            internals['Ca'] = BufferStructure('T', 'B', self.size,
+                                              context_size=1)
+            return outputs, parameters, internals
+        # pre-activations and activations of the gates are stacked as
+        # (block input, input gate, forget gate, output gate)
+        internals['Ga'] = BufferStructure('T', 'B', 4 * self.size,
+                                          context_size=1)
+        internals['Gb'] = BufferStructure('T', 'B', 4 * self.size,
+                                          context_size=1)
         internals['Ca'] = BufferStructure('T', 'B', self.size, context_size=1)
         internals['Cb'] = BufferStructure('T', 'B', self.size, context_size=1)
-        internals['dZa'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dZb'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dIa'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dIb'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dFa'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dFb'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dOa'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
-        internals['dOb'] = BufferStructure('T', 'B', self.size, context_size=1,
+        internals['dGa'] = BufferStructure('T', 'B', 4 * self.size,
+                                           context_size=1,
                                            is_backward_only=True)
         internals['dCa'] = BufferStructure('T', 'B', self.size, context_size=1,
                                            is_backward_only=True)
-        internals['dCb'] = BufferStructure('T', 'B', self.size, context_size=1,
-                                           is_backward_only=True)
         return outputs, parameters, internals
 
+    def _allocate_stacked(self, parts):
+        rows = parts[0].shape[0]
+        return self.handler.allocate_scratch((len(parts) * rows,) +
+                                             tuple(parts[0].shape[1:]))
+
+    def _stack(self, parameters, names):
+        """Get the given per-gate parameters as one array.
+
+        The parameters of a layer are laid out in one piece in the order
+        they are declared, so this is normally a view of them. Otherwise
+        they are copied into scratch memory.
+        """
+        stacked = parameters.get_stacked(names)
+        if stacked is not None:
+            return stacked
+        _h = self.handler
+        parts = [parameters[name] for name in names]
+        stacked = self._allocate_stacked(parts)
+        rows = parts[0].shape[0]
+        for i, part in enumerate(parts):
+            _h.copy_to(part, stacked[i * rows:(i + 1) * rows])
+        return stacked
+
+    def _stack_gradients(self, gradients, names):
+        """Get an array to add the stacked gradients of the given parameters
+        to, and whether it has to be added to them with _add_unstacked.
+
+        Like for _stack this is normally a view of the gradients, but
+        zeroed scratch memory if any of the parameters is frozen.
+        """
+        if not self.frozen_parameters.intersection(names):
+            stacked = gradients.get_stacked(names)
+            if stacked is not None:
+                return stacked, False
+        stacked = self._allocate_stacked([gradients[name] for name in names])
+        self.handler.fill(stacked, 0.0)
+        return stacked, True
+
+    def _add_unstacked(self, stacked, gradients, names):
+        """Add the per-gate blocks of a stacked array to the gradients,
+        except for the gradients of frozen parameters."""
+        _h = self.handler
+        rows = gradients[names[0]].shape[0]
+        for i, name in enumerate(names):
+            if name not in self.frozen_parameters:
+                part = gradients[name]
+                _h.add_tt(part, stacked[i * rows:(i + 1) * rows], part)
+
+    def _is_trained(self, names):
+        """Check if any of the given parameters is not frozen."""
+        return not self.frozen_parameters.issuperset(names)
+
+    def _forward_steps(self, x, y, Ca, Ga, Gb, Cb, start, W, R, bias,
+                       peepholes, cell=None, out=None):
+        """Run the time steps starting at start for the inputs x.
+
+        The gate and cell activations Ga, Gb and Cb are indexed relative to
+        start, the outputs y and cell states Ca absolutely. If cell and out
+        are given, the new cell states and outputs are written to them
+        instead of Ca and y, which is used for recomputing the activations
+        from the stored states.
+        """
+        _h = self.handler
+        # input projection and bias of all gates for all time steps
+        flat_Ga = flatten_time(Ga[:x.shape[0]])
+        _h.dot_mm(flatten_time(x), W, flat_Ga, transb=True)
+        _h.add_mv(flat_Ga, bias.reshape((1, 4 * self.size)), flat_Ga)
+
+        for t in range(x.shape[0]):
+            _h.dot_add_mm(y[start + t - 1], R, Ga[t], transb=True)
+            _h.lstm_forward_step(Ga[t], Gb[t], peepholes, Ca[start + t - 1],
+                                 Ca[start + t] if cell is None else cell,
+                                 Cb[t], y[start + t] if out is None else out,
+                                 self.activation)
+
     def forward_pass(self, buffers, training_pass=True):
         # prepare
         _h = self.handler
-        (Wz, Wi, Wf, Wo,
-         pi, pf, po,
-         Rz, Ri, Rf, Ro,
-         bz, bi, bf, bo) = buffers.parameters
-
-        (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Ca, Cb,
-         dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb) = buffers.internals
+        parameters = buffers.parameters
         x = buffers.inputs.default
         y = buffers.outputs.default
 
-        time_size, batch_size, in_size = x.shape
+        W = self._stack(parameters, self._W_NAMES)
+        R = self._stack(parameters, self._R_NAMES)
+        bias = self._stack(parameters, self._BIAS_NAMES)
+        peepholes = self._stack(parameters, self._PEEPHOLE_NAMES)
+
+        if not self.checkpoint_interval:
+            Ga, Gb, Ca, Cb, dGa, dCa = buffers.internals
+            self._forward_steps(x, y, Ca, Ga, Gb, Cb, 0, W, R, bias,
+                                peepholes)
+            return
+
+        Ca = buffers.internals.Ca
+        k = self.checkpoint_interval
+        Ga = _h.allocate_scratch((k, x.shape[1], 4 * self.size))
+        Gb = _h.allocate_scratch(Ga.shape)
+        Cb = _h.allocate_scratch((k, x.shape[1], self.size))
+        for start, stop in get_time_segments(x.shape[0], k):
+            self._forward_steps(x[start:stop], y, Ca, Ga, Gb, Cb, start, W, R,
+                                bias, peepholes)
+
+    def _backward_steps(self, deltas, Ca, Gb, Cb, dGa, dCa, start, R,
+                        peepholes, dy):
+        """Backpropagate through the time steps starting at start.
+
+        Like in :meth:`_forward_steps`, the internals are indexed relative
+        to start and their entries after the last time step have to hold
+        the values of the following time step.
+        """
+        _h = self.handler
+        for t in range(deltas.shape[0] - 1, -1, -1):
+            # Accumulate recurrent deltas
+            _h.copy_to(deltas[t], dy)
+            _h.dot_add_mm(dGa[t + 1], R, dy)
+
+            _h.lstm_backward_step(Gb[t], peepholes, Ca[start + t - 1], Cb[t],
+                                  dy, dGa[t + 1], Gb[t + 1], dCa[t + 1],
+                                  dGa[t], dCa[t], self.activation)
+
+    def _accumulate_gradients(self, x, dx, y, Ca, dGa, start, W, dW, dR,
+                              dbias, dpeepholes, tmp, dbias_tmp, dpeep):
+        """Add the input deltas and gradients of the time steps starting at
+        start.
+
+        dW, dR and dbias are the stacked gradients. tmp, dbias_tmp and dpeep
+        are temporaries, where tmp has to have room for the cell states of
+        all these time steps.
+        """
+        _h = self.handler
+        n = self.size
+        time_size, batch_size = x.shape[:2]
+        flat_inputs = flatten_time(x)
+        flat_dinputs = flatten_time(dx)
+        flat_dGa = flatten_time(dGa[:time_size])
 
-        flat_x = flatten_time(x)
-        flat_Za = flatten_time(Za[:-1])
-        flat_Ia = flatten_time(Ia[:-1])
-        flat_Fa = flatten_time(Fa[:-1])
-        flat_Oa = flatten_time(Oa[:-1])
-        _h.dot_mm(flat_x, Wz, flat_Za, transb=True)
-        _h.dot_mm(flat_x, Wi, flat_Ia, transb=True)
-        _h.dot_mm(flat_x, Wf, flat_Fa, transb=True)
-        _h.dot_mm(flat_x, Wo, flat_Oa, transb=True)
-
-        for t in range(time_size):
-            # Block input
-            _h.dot_add_mm(y[t - 1], Rz, Za[t], transb=True)
-            _h.add_mv(Za[t], bz.reshape((1, self.size)), Za[t])
-            _h.act_func[self.activation](Za[t], Zb[t])
-
-            # Input Gate
-            _h.dot_add_mm(y[t - 1], Ri, Ia[t], transb=True)
-            _h.mult_add_mv(Ca[t - 1], pi, Ia[t])
-            _h.add_mv(Ia[t], bi.reshape((1, self.size)), Ia[t])
-            _h.sigmoid(Ia[t], Ib[t])
-
-            # Forget Gate
-            _h.dot_add_mm(y[t - 1], Rf, Fa[t], transb=True)
-            _h.mult_add_mv(Ca[t - 1], pf, Fa[t])
-            _h.add_mv(Fa[t], bf.reshape((1, self.size)), Fa[t])
-            _h.sigmoid(Fa[t], Fb[t])
-
-            # Cell
-            _h.mult_tt(Ib[t], Zb[t], Ca[t])
-            _h.mult_add_tt(Fb[t], Ca[t - 1], Ca[t])
-
-            # Output Gate
-            _h.dot_add_mm(y[t - 1], Ro, Oa[t], transb=True)
-            _h.mult_add_mv(Ca[t], po, Oa[t])
-            _h.add_mv(Oa[t], bo.reshape((1, self.size)), Oa[t])
-            _h.sigmoid(Oa[t], Ob[t])
-
-            # Block output
-            _h.act_func[self.activation](Ca[t], Cb[t])
-            _h.mult_tt(Ob[t], Cb[t], y[t])
+        # Calculate in_deltas and gradients
+        if 'default' not in self.unused_input_deltas:
+            _h.dot_add_mm(flat_dGa, W, flat_dinputs)
+        if self._is_trained(self._W_NAMES):
+            _h.dot_add_mm(flat_dGa, flat_inputs, dW, transa=True)
+        if self._is_trained(self._BIAS_NAMES):
+            _h.sum_t(flat_dGa, axis=0, out=dbias_tmp)
+            _h.add_tt(dbias, dbias_tmp, dbias)
+
+        # the first time step is connected to the preceding one (or the
+        # context slice)
+        if self._is_trained(self._R_NAMES):
+            _h.dot_add_mm(flatten_time(dGa[1:time_size]),
+                          flatten_time(y[start:start + time_size - 1]), dR,
+                          transa=True)
+            _h.dot_add_mm(dGa[0], y[start - 1], dR, transa=True)
+
+        # Peephole connections
+        dpi, dpf, dpo = dpeepholes
+        if 'po' not in self.frozen_parameters:
+            flat_cell = flatten_time(Ca[start:start + time_size])
+            flat_tmp = tmp[:flat_cell.shape[0]]
+            _h.mult_tt(flat_cell, flat_dGa[:, 3 * n:], flat_tmp)
+            _h.sum_t(flat_tmp, axis=0, out=dpeep)
+            _h.add_tt(dpo, dpeep, dpo)
+
+        flat_dGa = flatten_time(dGa[1:time_size])
+        flat_cell = flatten_time(Ca[start:start + time_size - 1])
+        flat_tmp = tmp[:flat_cell.shape[0]]
+        tmp0 = tmp[:batch_size]
+        for i, dp, name in ((1, dpi, 'pi'), (2, dpf, 'pf')):
+            if name in self.frozen_parameters:
+                continue
+            _h.mult_tt(flat_cell, flat_dGa[:, i * n:(i + 1) * n], flat_tmp)
+            _h.sum_t(flat_tmp, axis=0, out=dpeep)
+            _h.add_tt(dp, dpeep, dp)
+            _h.mult_tt(Ca[start - 1], dGa[0][:, i * n:(i + 1) * n], tmp0)
+            _h.sum_t(tmp0, axis=0, out=dpeep)
+            _h.add_tt(dp, dpeep, dp)
 
     def backward_pass(self, buffers):
         # prepare
         _h = self.handler
-        (Wz, Wi, Wf, Wo,
-         pi, pf, po,
-         Rz, Ri, Rf, Ro,
-         bz, bi, bf, bo) = buffers.parameters
-        (dWz, dWi, dWf, dWo,
-         dpi, dpf, dpo,
-         dRz, dRi, dRf, dRo,
-         dbz, dbi, dbf, dbo) = buffers.gradients
-
-        (Za, Zb, Ia, Ib, Fa, Fb, Oa, Ob, Ca, Cb,
-         dZa, dZb, dIa, dIb, dFa, dFb, dOa, dOb, dCa, dCb) = buffers.internals
+        parameters = buffers.parameters
+        gradients = buffers.gradients
+        dpi, dpf, dpo = [gradients[name] for name in self._PEEPHOLE_NAMES]
 
         x = buffers.inputs.default
         dx = buffers.input_deltas.default
         y = buffers.outputs.default
         deltas = buffers.output_deltas.default
 
-        dy = _h.allocate(y.shape)
-        _h.fill(dCa, 0.0)
+        W = self._stack(parameters, self._W_NAMES)
+        R = self._stack(parameters, self._R_NAMES)
+        peepholes = self._stack(parameters, self._PEEPHOLE_NAMES)
 
         time_size, batch_size, in_size = x.shape
-        for t in range(time_size - 1, -1, - 1):
-            # Accumulate recurrent deltas
-            _h.copy_to(deltas[t], dy[t])
-            _h.dot_add_mm(dIa[t + 1], Ri, dy[t])
-            _h.dot_add_mm(dFa[t + 1], Rf, dy[t])
-            _h.dot_add_mm(dOa[t + 1], Ro, dy[t])
-            _h.dot_add_mm(dZa[t + 1], Rz, dy[t])
-
-            # Peephole connection part:
-            _h.mult_add_mv(dIa[t + 1], pi, dCa[t])
-            _h.mult_add_mv(dFa[t + 1], pf, dCa[t])
-
-            # Output Gate
-            _h.mult_tt(dy[t], Cb[t], dOb[t])
-            _h.sigmoid_deriv(Oa[t], Ob[t], dOb[t], dOa[t])
-            # Peephole connection
-            _h.mult_add_mv(dOa[t], po, dCa[t])
-
-            # Cell
-            _h.mult_tt(dy[t], Ob[t], dCb[t])
-            _h.act_func_deriv[self.activation](Ca[t], Cb[t], dCb[t], dCb[t])
-            _h.add_tt(dCa[t], dCb[t], dCa[t])
-            _h.mult_add_tt(dCa[t + 1], Fb[t + 1], dCa[t])
-
-            # Forget Gate
-            _h.mult_tt(dCa[t], Ca[t - 1], dFb[t])
-            _h.sigmoid_deriv(Fa[t], Fb[t], dFb[t], dFa[t])
-
-            # Input Gate
-            _h.mult_tt(dCa[t], Zb[t], dIb[t])
-            _h.sigmoid_deriv(Ia[t], Ib[t], dIb[t], dIa[t])
-
-            # Block Input
-            _h.mult_tt(dCa[t], Ib[t], dZb[t])
-            _h.act_func_deriv[self.activation](Za[t], Zb[t], dZb[t], dZa[t])
-
-        flat_inputs = flatten_time(x)
-        flat_dinputs = flatten_time(dx)
-
-        flat_dIa = flatten_time(dIa[:-1])
-        flat_dFa = flatten_time(dFa[:-1])
-        flat_dOa = flatten_time(dOa[:-1])
-        flat_dZa = flatten_time(dZa[:-1])
-
-        # Calculate in_deltas and gradients
-        _h.dot_add_mm(flat_dIa, Wi, flat_dinputs)
-        _h.dot_add_mm(flat_dFa, Wf, flat_dinputs)
-        _h.dot_add_mm(flat_dOa, Wo, flat_dinputs)
-        _h.dot_add_mm(flat_dZa, Wz, flat_dinputs)
-
-        _h.dot_add_mm(flat_dIa, flat_inputs, dWi, transa=True)
-        _h.dot_add_mm(flat_dFa, flat_inputs, dWf, transa=True)
-        _h.dot_add_mm(flat_dOa, flat_inputs, dWo, transa=True)
-        _h.dot_add_mm(flat_dZa, flat_inputs, dWz, transa=True)
-
-        dbias_tmp = _h.allocate(dbz.shape)
-        _h.sum_t(flat_dIa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbi, dbias_tmp, dbi)
-        _h.sum_t(flat_dFa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbf, dbias_tmp, dbf)
-        _h.sum_t(flat_dOa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbo, dbias_tmp, dbo)
-        _h.sum_t(flat_dZa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbz, dbias_tmp, dbz)
-
-        flat_outputs = flatten_time(y[:-2])
-        flat_cell = flatten_time(Ca[:-2])
-        flat_cell2 = flatten_time(Ca[:-1])
-
-        dWco_tmp = _h.allocate(flat_cell2.shape)
-        dWc_tmp = _h.allocate(dpo.shape)
-
-        # Output gate Peephole
-        _h.mult_tt(flat_cell2, flat_dOa, dWco_tmp)
-        _h.sum_t(dWco_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpo, dWc_tmp, dpo)
-
-        flat_dIa = flatten_time(dIa[1:-1])
-        flat_dFa = flatten_time(dFa[1:-1])
-        flat_dOa = flatten_time(dOa[1:-1])
-        flat_dZa = flatten_time(dZa[1:-1])
-
-        _h.dot_add_mm(flat_dIa, flat_outputs, dRi, transa=True)
-        _h.dot_add_mm(flat_dFa, flat_outputs, dRf, transa=True)
-        _h.dot_add_mm(flat_dOa, flat_outputs, dRo, transa=True)
-        _h.dot_add_mm(flat_dZa, flat_outputs, dRz, transa=True)
-
-        _h.dot_add_mm(dIa[0], dy[-1], dRi, transa=True)
-        _h.dot_add_mm(dFa[0], dy[-1], dRf, transa=True)
-        _h.dot_add_mm(dOa[0], dy[-1], dRo, transa=True)
-        _h.dot_add_mm(dZa[0], dy[-1], dRz, transa=True)
-
-        # Other Peephole connections
-        dWcif_tmp = _h.allocate(flat_cell.shape)
-        _h.mult_tt(flat_cell, flat_dIa, dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpi, dWc_tmp, dpi)
-        _h.mult_tt(flat_cell, flat_dFa, dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpf, dWc_tmp, dpf)
-
-        dWcif_tmp = _h.allocate(dIa[0].shape)
-        _h.mult_tt(dCa[-1], dIa[0], dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpi, dWc_tmp, dpi)
-        _h.mult_tt(dCa[-1], dIa[0], dWcif_tmp)
-        _h.sum_t(dWcif_tmp, axis=0, out=dWc_tmp)
-        _h.add_tt(dpf, dWc_tmp, dpf)
\ No newline at end of file
+        n = self.size
+        dy = _h.allocate_scratch(y[0].shape)
+        stacked_gradients = [
+            (names,) + self._stack_gradients(gradients, names)
+            for names in (self._W_NAMES, self._R_NAMES, self._BIAS_NAMES)]
+        dW, dR, dbias = [stacked for _, stacked, _ in stacked_gradients]
+        dbias_tmp = _h.allocate_scratch(dbias.shape)
+        dpeep = _h.allocate_scratch(dpo.shape)
+
+        if not self.checkpoint_interval:
+            Ga, Gb, Ca, Cb, dGa, dCa = buffers.internals
+            _h.fill(dCa[-1], 0.0)
+            self._backward_steps(deltas[:time_size], Ca, Gb, Cb, dGa, dCa, 0,
+                                 R, peepholes, dy)
+            tmp = _h.allocate_scratch((time_size * batch_size, n))
+            self._accumulate_gradients(x, dx, y, Ca, dGa, 0, W, dW, dR,
+                                       dbias, (dpi, dpf, dpo), tmp,
+                                       dbias_tmp, dpeep)
+        else:
+            Ca = buffers.internals.Ca
+            bias = self._stack(parameters, self._BIAS_NAMES)
+            k = self.checkpoint_interval
+            # the internals of one segment plus the first time step of the
+            # following segment
+            Ga = _h.allocate_scratch((k + 1, batch_size, 4 * n))
+            Gb = _h.allocate_scratch(Ga.shape)
+            dGa = _h.allocate_scratch(Ga.shape)
+            Cb = _h.allocate_scratch((k + 1, batch_size, n))
+            dCa = _h.allocate_scratch(Cb.shape)
+            cell = _h.allocate_scratch(y[0].shape)
+            out = _h.allocate_scratch(y[0].shape)
+            tmp = _h.allocate_scratch((k * batch_size, n))
+
+            segments = get_time_segments(time_size, k)
+            last = segments[-1][1] - segments[-1][0]
+            for buf in (Gb, dGa, dCa):
+                _h.fill(buf[last], 0.0)
+            for start, stop in reversed(segments):
+                # recompute the activations of this segment from the stored
+                # outputs and cell states
+                self._forward_steps(x[start:stop], y, Ca, Ga, Gb, Cb, start,
+                                    W, R, bias, peepholes, cell, out)
+                self._backward_steps(deltas[start:stop], Ca, Gb, Cb, dGa, dCa,
+                                     start, R, peepholes, dy)
+                self._accumulate_gradients(x[start:stop], dx[start:stop], y,
+                                           Ca, dGa, start, W, dW, dR, dbias,
+                                           (dpi, dpf, dpo), tmp, dbias_tmp,
+                                           dpeep)
+                for buf in (Gb, dGa, dCa):
+                    _h.copy_to(buf[0], buf[k])
+
+        for names, stacked, is_scratch in stacked_gradients:
+            if is_scratch:
+                self._add_unstacked(stacked, gradients, names)
@@ -41,7 +41,7 @@ class MaskLayerImpl(Layer):
 
         flat_out_deltas = flatten_time_and_features(
             buffers.output_deltas.default)
-        tmp = self.handler.allocate(flat_out_deltas.shape)
+        tmp = _h.allocate_scratch(flat_out_deltas.shape)
         flat_mask = flatten_time(buffers.inputs.mask)
         flat_in_deltas = flatten_time_and_features(
             buffers.input_deltas.default)
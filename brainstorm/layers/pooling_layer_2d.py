@@ -67,7 +67,8 @@ class Pooling2DLayerImpl(Layer):
         internals = OrderedDict()
         if self.type == 'max':
             argmax_shape = outputs['default'].feature_shape
-            internals['argmax'] = BufferStructure('T', 'B', *argmax_shape)
+            internals['argmax'] = BufferStructure('T', 'B', *argmax_shape,
+                                                  is_full_precision=True)
         return outputs, OrderedDict(), internals
 
     def forward_pass(self, buffers, training_pass=True):
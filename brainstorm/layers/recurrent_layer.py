@@ -8,19 +8,27 @@ from brainstorm.layers.base_layer import Layer
 from brainstorm.structure.buffer_structure import (BufferStructure,
                                                    StructureTemplate)
 from brainstorm.structure.construction import ConstructionWrapper
-from brainstorm.utils import LayerValidationError, flatten_time
+from brainstorm.utils import (LayerValidationError, flatten_time,
+                              get_checkpoint_interval, get_time_segments)
 
 
-def Recurrent(size, activation='tanh', name=None):
-    """Create a Simple Recurrent layer."""
+def Recurrent(size, activation='tanh', checkpoint_interval=0, name=None):
+    """Create a Simple Recurrent layer.
+
+    If checkpoint_interval is k > 0, the pre-activations are not stored but
+    recomputed from the outputs in segments of k time steps during the
+    backward pass, so the memory for them and for the backward internals
+    doesn't grow with the sequence length.
+    """
     return ConstructionWrapper.create(RecurrentLayerImpl, size=size,
-                                      name=name, activation=activation)
+                                      name=name, activation=activation,
+                                      checkpoint_interval=checkpoint_interval)
 
 
 class RecurrentLayerImpl(Layer):
 
     expected_inputs = {'default': StructureTemplate('T', 'B', 'F')}
-    expected_kwargs = {'size', 'activation'}
+    expected_kwargs = {'size', 'activation', 'checkpoint_interval'}
 
     def setup(self, kwargs, in_shapes):
         self.activation = kwargs.get('activation', 'tanh')
@@ -28,6 +36,7 @@ class RecurrentLayerImpl(Layer):
         if not isinstance(self.size, int):
             raise LayerValidationError('size must be int but was {}'.
                                        format(self.size))
+        self.checkpoint_interval = get_checkpoint_interval(kwargs)
 
         in_size = self.in_shapes['default'].feature_size
 
@@ -40,30 +49,77 @@ class RecurrentLayerImpl(Layer):
         parameters['bias'] = BufferStructure(self.size)
 
         internals = OrderedDict()
+        if self.checkpoint_interval:
+            return outputs, parameters, internals
         internals['Ha'] = BufferStructure('T', 'B', self.size, context_size=1)
         internals['dHa'] = BufferStructure('T', 'B', self.size, context_size=1,
                                            is_backward_only=True)
         internals['dHb'] = BufferStructure('T', 'B', self.size, context_size=1,
                                            is_backward_only=True)
         return outputs, parameters, internals
-    
+
+    def _forward_steps(self, inputs, outputs, Ha, start, W, R, bias,
+                       recompute=False):
+        """Run the time steps starting at start for the given inputs.
+
+        The pre-activations Ha are indexed relative to start, the outputs
+        absolutely. If recompute is set, only the pre-activations are
+        computed and the outputs are left as they are.
+        """
+        _h = self.handler
+        flat_inputs = flatten_time(inputs)
+        flat_H = flatten_time(Ha[:inputs.shape[0]])
+
+        _h.dot_mm(flat_inputs, W, flat_H, transb=True)
+        _h.add_mv(flat_H, bias.reshape((1, self.size)), flat_H)
+
+        for t in range(inputs.shape[0]):
+            _h.dot_add_mm(outputs[start + t - 1], R, Ha[t], transb=True)
+            if not recompute:
+                _h.act_func[self.activation](Ha[t], outputs[start + t])
+
     def forward_pass(self, buffers, training_pass=True):
         # prepare
         _h = self.handler
         W, R, bias = buffers.parameters
         inputs = buffers.inputs.default
         outputs = buffers.outputs.default
-        Ha = buffers.internals.Ha
 
+        if not self.checkpoint_interval:
+            self._forward_steps(inputs, outputs, buffers.internals.Ha, 0, W,
+                                R, bias)
+            return
+
+        k = self.checkpoint_interval
+        Ha = _h.allocate_scratch((k, inputs.shape[1], self.size))
+        for start, stop in get_time_segments(inputs.shape[0], k):
+            self._forward_steps(inputs[start:stop], outputs, Ha, start, W, R,
+                                bias)
+
+    def _accumulate_gradients(self, inputs, dinputs, outputs, dHa, start, W,
+                              dW, dR, dbias, dbias_tmp):
+        """Add the input deltas and gradients of the time steps starting at
+        start."""
+        _h = self.handler
+        time_size = inputs.shape[0]
         flat_inputs = flatten_time(inputs)
-        flat_H = flatten_time(Ha[:-1])
-
-        _h.dot_mm(flat_inputs, W, flat_H, transb=True)
-        _h.add_mv(flat_H, bias.reshape((1, self.size)), flat_H)
+        flat_dinputs = flatten_time(dinputs)
+        flat_dHa = flatten_time(dHa[:time_size])
 
-        for t in range(inputs.shape[0]):
-            _h.dot_add_mm(outputs[t - 1], R, Ha[t], transb=True)
-            _h.act_func[self.activation](Ha[t], outputs[t])
+        # calculate in_deltas and gradients
+        if 'default' not in self.unused_input_deltas:
+            _h.dot_add_mm(flat_dHa, W, flat_dinputs)
+        if 'W' not in self.frozen_parameters:
+            _h.dot_add_mm(flat_dHa, flat_inputs, dW, transa=True)
+        if 'bias' not in self.frozen_parameters:
+            _h.sum_t(flat_dHa, axis=0, out=dbias_tmp)
+            _h.add_tt(dbias, dbias_tmp, dbias)
+
+        if 'R' not in self.frozen_parameters:
+            flat_outputs = flatten_time(outputs[start:start + time_size - 1])
+            flat_dHa = flatten_time(dHa[1:time_size])
+            _h.dot_add_mm(flat_dHa, flat_outputs, dR, transa=True)
+            _h.dot_add_mm(dHa[0], outputs[start - 1], dR, transa=True)
 
     def backward_pass(self, buffers):
         # prepare
@@ -74,28 +130,40 @@ class RecurrentLayerImpl(Layer):
         outputs = buffers.outputs.default
         dinputs = buffers.input_deltas.default
         doutputs = buffers.output_deltas.default
-        Ha, dHa, dHb = buffers.internals
-
-        _h.copy_to(doutputs, dHb)
-        T = inputs.shape[0] - 1
-        _h.act_func_deriv[self.activation](Ha[T], outputs[T], dHb[T], dHa[T])
-        for t in range(T - 1, -1, -1):
-            _h.dot_add_mm(dHa[t + 1], R, dHb[t])
-            _h.act_func_deriv[self.activation](Ha[t], outputs[t],
-                                               dHb[t], dHa[t])
-
-        flat_inputs = flatten_time(inputs)
-        flat_dinputs = flatten_time(dinputs)
-        flat_dHa = flatten_time(dHa[:-1])
-
-        # calculate in_deltas and gradients
-        _h.dot_add_mm(flat_dHa, W, flat_dinputs)
-        _h.dot_add_mm(flat_dHa, flat_inputs, dW, transa=True)
-        dbias_tmp = _h.allocate(dbias.shape)
-        _h.sum_t(flat_dHa, axis=0, out=dbias_tmp)
-        _h.add_tt(dbias, dbias_tmp, dbias)
-
-        flat_outputs = flatten_time(outputs[:-2])
-        flat_dHa = flatten_time(dHa[1:-1])
-        _h.dot_add_mm(flat_dHa, flat_outputs, dR, transa=True)
-        _h.dot_add_mm(dHa[0], outputs[-1], dR, transa=True)
+        dbias_tmp = _h.allocate_scratch(dbias.shape)
+
+        if not self.checkpoint_interval:
+            Ha, dHa, dHb = buffers.internals
+            _h.copy_to(doutputs, dHb)
+            T = inputs.shape[0] - 1
+            _h.act_func_deriv[self.activation](Ha[T], outputs[T], dHb[T],
+                                               dHa[T])
+            for t in range(T - 1, -1, -1):
+                _h.dot_add_mm(dHa[t + 1], R, dHb[t])
+                _h.act_func_deriv[self.activation](Ha[t], outputs[t],
+                                                   dHb[t], dHa[t])
+            self._accumulate_gradients(inputs, dinputs, outputs, dHa, 0, W,
+                                       dW, dR, dbias, dbias_tmp)
+            return
+
+        k = self.checkpoint_interval
+        # the internals of one segment plus the first time step of the
+        # following segment
+        Ha = _h.allocate_scratch((k + 1, inputs.shape[1], self.size))
+        dHa = _h.allocate_scratch(Ha.shape)
+        dHb = _h.allocate_scratch(Ha.shape)
+        segments = get_time_segments(inputs.shape[0], k)
+        _h.fill(dHa[segments[-1][1] - segments[-1][0]], 0.0)
+        for start, stop in reversed(segments):
+            # recompute the pre-activations from the stored outputs
+            self._forward_steps(inputs[start:stop], outputs, Ha, start, W, R,
+                                bias, recompute=True)
+            _h.copy_to(doutputs[start:stop], dHb[:stop - start])
+            for t in range(stop - start - 1, -1, -1):
+                _h.dot_add_mm(dHa[t + 1], R, dHb[t])
+                _h.act_func_deriv[self.activation](Ha[t], outputs[start + t],
+                                                   dHb[t], dHa[t])
+            self._accumulate_gradients(inputs[start:stop],
+                                       dinputs[start:stop], outputs, dHa,
+                                       start, W, dW, dR, dbias, dbias_tmp)
+            _h.copy_to(dHa[0], dHa[k])
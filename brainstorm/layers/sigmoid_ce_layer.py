@@ -50,11 +50,7 @@ class SigmoidCELayerImpl(Layer):
         outputs['probabilities'] = BufferStructure('T', 'B', *in_shape)
         outputs['loss'] = BufferStructure('T', 'B', 1)
 
-        internals = OrderedDict()
-        internals['cee'] = BufferStructure('T', 'B', *in_shape)
-        internals['dcee'] = BufferStructure('T', 'B', *in_shape,
-                                            is_backward_only=True)
-        return outputs, OrderedDict(), internals
+        return outputs, OrderedDict(), OrderedDict()
 
     def forward_pass(self, buffers, training_pass=True):
         _h = self.handler
@@ -62,7 +58,6 @@ class SigmoidCELayerImpl(Layer):
 
         inputs = flatten_time_and_features(buffers.inputs.default)
         targets = flatten_time_and_features(buffers.inputs.targets)
-        cee = flatten_time_and_features(buffers.internals.cee)
         loss = flatten_time_and_features(buffers.outputs.loss)
         prob = flatten_time_and_features(buffers.outputs.probabilities)
 
@@ -71,22 +66,7 @@ class SigmoidCELayerImpl(Layer):
 
         # the binomial cross entropy error is given by
         # - (t * ln(y) + (1-t) * ln(1-y))
-        tmp = _h.ones(prob.shape)
-        _h.subtract_tt(tmp, prob, cee)     # cee = 1-y
-        _h.subtract_tt(tmp, targets, tmp)     # tmp  = 1-t
-        _h.clip_t(cee, 1e-6, 1.0, cee)
-        _h.log_t(cee, cee)              # cee = ln(1-y)
-        _h.mult_tt(tmp, cee, tmp)  # tmp = (1-t) * ln(1-y)
-
-        _h.clip_t(prob, 1e-6, 1.0, cee)
-        _h.log_t(cee, cee)              # cee = ln(y)
-        _h.mult_tt(targets, cee, cee)    # cee = t * ln(y)
-
-        _h.add_tt(tmp, cee, cee)        # cee = (1-t) * ln(1-y) + t * ln(y)
-
-        # reshape for summation
-        _h.sum_t(cee, axis=1, out=loss)
-        _h.mult_st(-1, loss, loss)  # * -1
+        _h.binomial_ce_forward(prob, targets, loss)
 
     def backward_pass(self, buffers):
         # prepare
@@ -95,10 +75,8 @@ class SigmoidCELayerImpl(Layer):
 
         dinputs = flatten_time_and_features(buffers.input_deltas.default)
         dloss = flatten_time(buffers.output_deltas.loss)
-        dcee = flatten_time_and_features(buffers.internals.cee)
         targets = flatten_time_and_features(buffers.inputs.targets)
         prob = flatten_time_and_features(buffers.outputs.probabilities)
 
-        _h.subtract_tt(prob, targets, dcee)  # y - t
-        _h.mult_mv(dcee, dloss, dcee)        # out_delta * (y - t)
-        _h.add_tt(dcee, dinputs, dinputs)
+        # out_delta * (y - t)
+        _h.sigmoid_ce_backward(prob, targets, dloss, dinputs)
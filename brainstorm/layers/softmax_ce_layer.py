@@ -57,10 +57,7 @@ class SoftmaxCELayerImpl(Layer):
         outputs['probabilities'] = BufferStructure('T', 'B', *in_shape)
         outputs['loss'] = BufferStructure('T', 'B', *tar_shape)
 
-        internals = OrderedDict()
-        internals['t_bin'] = BufferStructure('T', 'B', *in_shape,
-                                             is_backward_only=True)
-        return outputs, OrderedDict(), internals
+        return outputs, OrderedDict(), OrderedDict()
 
     def forward_pass(self, buffers, training_pass=True):
         # prepare
@@ -76,17 +73,11 @@ class SoftmaxCELayerImpl(Layer):
         flat_loss = flatten_all_but_last(loss)
         flat_targets = flatten_all_but_last(targets)
 
-        # softmax
-        _h.softmax_m(flat_inputs, flat_probs)
-
-        # the multinomial cross entropy error is given by
+        # softmax and multinomial cross entropy error, which is given by
         # - sum over i: p_i * ln(y_i)
         # now our targets are indices so all p_i = 0 except for i=t
-        _h.fill(loss, 0.)
-        _h.index_m_by_v(flat_probs, flat_targets, flat_loss)
-        _h.clip_t(flat_loss, 1e-6, 1.0, flat_loss)
-        _h.log_t(loss, loss)
-        _h.mult_st(-1, loss, loss)
+        _h.softmax_ce_forward(flat_inputs, flat_targets, flat_probs,
+                              flat_loss)
 
     def backward_pass(self, buffers):
         # prepare
@@ -96,19 +87,14 @@ class SoftmaxCELayerImpl(Layer):
 
         dinputs = buffers.input_deltas.default
         dloss = buffers.output_deltas.loss
-        t_bin = buffers.internals.t_bin
 
         # reshape
         flat_probs = flatten_all_but_last(probs)
         flat_targets = flatten_all_but_last(targets)
-        flat_t_bin = flatten_all_but_last(t_bin)
         flat_dloss = flatten_all_but_last(dloss)
         flat_dinputs = flatten_all_but_last(dinputs)
 
         # derivative of multinomial cross-entropy error wrt softmax:
         # y - t
-        _h.binarize_v(flat_targets, flat_t_bin)
-        _h.mult_st(-1, flat_t_bin, flat_t_bin)
-        _h.add_tt(flat_t_bin, flat_probs, flat_t_bin)
-        _h.mult_mv(flat_t_bin, flat_dloss, flat_t_bin)
-        _h.add_tt(flat_t_bin, flat_dinputs, flat_dinputs)
+        _h.softmax_ce_backward(flat_probs, flat_targets, flat_dloss,
+                               flat_dinputs)
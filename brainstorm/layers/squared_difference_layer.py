@@ -68,7 +68,7 @@ class SquaredDifferenceLayerImpl(Layer):
         dinputs_1 = flatten_time_and_features(buffers.input_deltas.inputs_1)
         dinputs_2 = flatten_time_and_features(buffers.input_deltas.inputs_2)
 
-        tmp = _h.allocate(inputs_2.shape)
+        tmp = _h.allocate_scratch(inputs_2.shape)
         # out_deltas has only one feature dimension due to summation,
         # so we broadcast to all feature dimensions
         _h.broadcast_t(out_deltas, 2, grad_diff)
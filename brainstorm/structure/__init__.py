@@ -3,6 +3,7 @@
 from __future__ import division, print_function
 from brainstorm.structure.network import Network
 from brainstorm.structure.architecture import generate_architecture
+from brainstorm.structure.layout import LayoutCache
 
 
-__all__ = ['Network', 'generate_architecture']
+__all__ = ['Network', 'generate_architecture', 'LayoutCache']
@@ -111,13 +111,16 @@ class BufferStructure(object):
         shape = layout['@shape']
         context_size = layout.get('@context_size', 0)
         is_backward_only = layout.get('@is_backward_only', False)
+        is_full_precision = layout.get('@is_full_precision', False)
         return cls(*shape, context_size=context_size,
-                   is_backward_only=is_backward_only)
+                   is_backward_only=is_backward_only,
+                   is_full_precision=is_full_precision)
 
     # The following signature unfortunately is not python2 compatible:
     # def __init__(self, *args, context_size=0, backward_only=False):
     def __init__(self, *args, **kwargs):
-        expected_kwargs = {'context_size', 'is_backward_only'}
+        expected_kwargs = {'context_size', 'is_backward_only',
+                           'is_full_precision'}
         if not set(kwargs.keys()) <= expected_kwargs:
             raise TypeError('Unexpected keyword argument {}'
                             .format(set(kwargs.keys()) - expected_kwargs))
@@ -125,6 +128,9 @@ class BufferStructure(object):
         self.shape = args
         self.context_size = kwargs.get('context_size', 0)
         self.is_backward_only = kwargs.get('is_backward_only', False)
+        # Buffers that hold exact values like indices are never stored in the
+        # reduced precision of a mixed-precision handler
+        self.is_full_precision = kwargs.get('is_full_precision', False)
 
         if 'T' in self.shape:
             self.buffer_type = 2
@@ -206,6 +212,8 @@ class BufferStructure(object):
             descr['@context_size'] = self.context_size
         if self.is_backward_only:
             descr['@is_backward_only'] = True
+        if self.is_full_precision:
+            descr['@is_full_precision'] = True
         return descr
 
     def get_shape(self, time_size, batch_size):
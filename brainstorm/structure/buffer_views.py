@@ -37,6 +37,39 @@ class BufferView(list):
     def values(self):
         return self._asdict().values()
 
+    def get_stacked(self, names):
+        """
+        Get a single view of the given buffers stacked along their first
+        axis, without copying them.
+
+        This is only possible if this view has a flat full buffer holding
+        all its buffers in order, and the given buffers are consecutive and
+        agree in all but the first dimension.
+
+        Args:
+            names (tuple[str]):
+                Names of the buffers to stack.
+        Returns:
+            array_type:
+                The stacked view, or None if the buffers can't be stacked.
+        """
+        buffers = list(self)
+        if self._full_buffer is None or \
+                any(b is None or isinstance(b, BufferView) for b in buffers):
+            return None
+        if sum(b.size for b in buffers) != self._full_buffer.size:
+            return None
+        first = self._buffer_names.index(names[0])
+        if self._buffer_names[first:first + len(names)] != tuple(names):
+            return None
+        parts = buffers[first:first + len(names)]
+        if any(p.shape[1:] != parts[0].shape[1:] for p in parts):
+            return None
+        start = sum(b.size for b in buffers[:first])
+        stop = start + sum(p.size for p in parts)
+        shape = (sum(p.shape[0] for p in parts),) + tuple(parts[0].shape[1:])
+        return self._full_buffer[start:stop].reshape(shape)
+
     def __getitem__(self, item):
         if isinstance(item, int):
             return super(BufferView, self).__getitem__(item)
@@ -3,6 +3,8 @@
 
 from __future__ import division, print_function, unicode_literals
 
+from collections import OrderedDict
+
 import numpy as np
 
 from brainstorm.handlers import default_handler
@@ -40,71 +42,298 @@ def create_buffer_views_from_layout(layout, buffers, hubs, existing_view=None):
         else:
             return BufferView(names, child_buffers, full_buffer)
     else:  # layout['@type'] == 'array':
-        assert full_buffer is not None, layout
+        # backward-only buffers are left out of inference layouts
+        assert full_buffer is not None or layout.get('@is_backward_only'), \
+            layout
         return full_buffer
 
 
-def get_total_size_slices_and_shapes(hubs, time_size, batch_size):
+def get_total_size_slices_and_shapes(hubs, time_size, batch_size,
+                                     live_ranges=None):
         shapes = [h.get_shape(time_size, batch_size) for h in hubs]
-        totals = np.cumsum([0] + [int(np.prod(s)) for s in shapes])
+        sizes = [int(np.prod(s)) for s in shapes]
+        if live_ranges is not None:
+            offsets = pack_live_ranges(sizes, live_ranges)
+            size = max([o + s for o, s in zip(offsets, sizes)] or [0])
+            slices = [slice(o, o + s) for o, s in zip(offsets, sizes)]
+            return size, slices, shapes
+        totals = np.cumsum([0] + sizes)
         size = int(totals[-1])
         slices = [slice(int(i), int(j))
                   for i, j in zip(totals[:-1], totals[1:])]
         return size, slices, shapes
 
 
+def get_forward_live_ranges(hubs, layout):
+    """Determine during which layers the buffers of each hub are needed in
+    a forward pass.
+
+    A hub is live from the first layer that writes or reads it up to the
+    last layer that reads it. Outputs that no layer reads are results and
+    stay live until the end of the pass. Parameters, the inputs of the
+    network, buffers that carry context between forward passes and buffers
+    of the backward pass are always live.
+
+    Args:
+        hubs (list[brainstorm.structure.layout.Hub]):
+            The hubs of the network.
+        layout (dict):
+            The layout of the network.
+
+    Returns:
+        list[tuple[int] or None]:
+            For every hub the first and last position in the canonical layer
+            order in which it is live, or None if it is always live.
+    """
+    position = {name: node['@index'] for name, node in layout.items()
+                if not name.startswith('@') and
+                name not in ('parameters', 'gradients')}
+    end = max(position.values())
+    live_ranges = []
+    for hub in hubs:
+        source_layers = {s.split('.')[0] for s in hub.flat_sources}
+        if hub.btype == 0 or hub.context_size or hub.is_backward_only or \
+                'Input' in source_layers:
+            live_ranges.append(None)
+            continue
+        sink_positions = [position[s.split('.')[0]] for s in hub.sinks]
+        start = min([position[n] for n in source_layers] + sink_positions)
+        live_ranges.append((start, max(sink_positions or [end])))
+    return live_ranges
+
+
+def pack_live_ranges(sizes, live_ranges):
+    """Assign an offset to every buffer such that buffers that are live at
+    the same time don't overlap.
+
+    This is the greedy first-fit heuristic for dynamic storage allocation:
+    the largest buffers are placed first, each at the lowest offset where it
+    doesn't collide with any already placed buffer whose live range
+    overlaps its own.
+
+    Args:
+        sizes (list[int]):
+            The size of every buffer.
+        live_ranges (list[tuple[int] or None]):
+            The first and last step in which every buffer is live, or None
+            if it is always live.
+
+    Returns:
+        list[int]: The offset of every buffer.
+    """
+    def overlap(a, b):
+        return a is None or b is None or (a[0] <= b[1] and b[0] <= a[1])
+
+    offsets = [0] * len(sizes)
+    placed = []
+    for i in sorted(range(len(sizes)), key=lambda j: (-sizes[j], j)):
+        offset = 0
+        for start, stop in sorted((offsets[j], offsets[j] + sizes[j])
+                                  for j in placed
+                                  if overlap(live_ranges[i], live_ranges[j])):
+            if offset + sizes[i] <= start:
+                break
+            offset = max(offset, stop)
+        offsets[i] = offset
+        placed.append(i)
+    return offsets
+
+
+def _round_up(size, bucket):
+    return -(-size // bucket) * bucket
+
+
 class BufferManager(object):
-    def __init__(self, layout, hubs, handler=default_handler):
+    """Allocates the memory for all hubs of a network and creates the views.
+
+    Parameters and gradients don't depend on the time and batch size, so
+    they are kept in an allocation of their own that never moves. The view
+    trees for the other buffers are cached for the most recently used
+    shapes (at most :attr:`max_cached_shapes`), so switching back and forth
+    between shapes is just a dictionary lookup.
+
+    Args:
+        layout (dict):
+            The layout of the network.
+        hubs (list[brainstorm.structure.layout.Hub]):
+            The hubs of the network.
+        handler (Optional[brainstorm.handlers.base_handler.Handler]):
+            The handler used for allocating the memory.
+        reuse_memory (Optional[bool]):
+            If set, hubs that are not needed at the same time during a
+            forward pass share their memory. This makes the memory needed
+            for the activations scale with the widest layers instead of the
+            depth of the network, but only forward passes can be computed
+            and only the outputs of layers that are not connected to any
+            other layer are kept after a forward pass. Defaults to False.
+    """
+    def __init__(self, layout, hubs, handler=default_handler,
+                 reuse_memory=False):
         self.hubs = hubs
         self.handler = handler
         self.layout = layout
+        self.reuse_memory = reuse_memory
+        self.live_ranges = get_forward_live_ranges(hubs, layout) \
+            if reuse_memory else None
         self.time_size = -1
         self.batch_size = -1
+        self.time_bucket = 1
+        self.batch_bucket = 1
         self.size = -1
         self.full_buffer = None
+        self.activation_size = -1
+        self.activation_buffer = None
+        self.parameter_buffer = None
+        self.parameter_buffers = []
+        self.parameter_memory = None
         self.buffers = []
         self.views = None
+        self.max_cached_shapes = 8
+        self._cached_views = OrderedDict()
+        # Parameters and gradients (btype 0) go into the parameter buffer.
+        # Of the rest, buffers that need full precision are allocated with
+        # handler.allocate, all the activations, internals and deltas with
+        # handler.allocate_activations.
+        self.storage = ['parameters' if h.btype == 0 else
+                        'full' if h.is_full_precision else 'activations'
+                        for h in hubs]
+        self._allocate_parameters()
         self.resize(0, 0)
 
-    def resize(self, time_size, batch_size):
-        if time_size == self.time_size and batch_size == self.batch_size:
-            return self.views  # lazy
+    def set_shape_buckets(self, time_bucket=1, batch_bucket=1):
+        """Round the time and batch size up to a multiple of the given
+        bucket sizes when allocating memory.
 
-        self.time_size = time_size
-        self.batch_size = batch_size
-        total_size, slices, shapes = get_total_size_slices_and_shapes(
-            self.hubs, time_size, batch_size)
+        The views still have the exact shape of the data, but a buffer
+        allocated for a bucket is big enough for all shapes in it, so
+        variable sized minibatches don't cause repeated reallocations.
+        """
+        if time_bucket < 1 or batch_bucket < 1:
+            raise ValueError('Bucket sizes have to be positive, but were '
+                             '{} and {}'.format(time_bucket, batch_bucket))
+        self.time_bucket = time_bucket
+        self.batch_bucket = batch_bucket
 
-        if total_size > self.size:
-            self.full_buffer = self.handler.allocate((total_size,))
-            self.size = total_size
+    def _select(self, items, storage):
+        return [i for i, s in zip(items, self.storage) if s == storage]
 
-        self.buffers = [self.full_buffer[slices[i]].reshape(shapes[i])
-                        for i in range(len(self.hubs))]
+    def _allocate_parameters(self):
+        parameter_hubs = self._select(self.hubs, 'parameters')
+        attached_hub = None
+        if self.parameter_memory is not None:
+            attached_hub = self.hubs[self.layout['parameters']['@hub']]
+        allocated_hubs = [h for h in parameter_hubs if h is not attached_hub]
+        size, slices, shapes = get_total_size_slices_and_shapes(
+            allocated_hubs, 0, 0)
+        self.parameter_buffer = self.handler.allocate((size,))
+        allocated = iter([self.parameter_buffer[s].reshape(shape)
+                          for s, shape in zip(slices, shapes)])
+        self.parameter_buffers = [
+            self.parameter_memory.reshape(h.get_shape(0, 0))
+            if h is attached_hub else next(allocated)
+            for h in parameter_hubs]
 
-        parameters = None
-        if self.views is not None:
-            # copy the parameters
-            parameters = self.handler.get_numpy_copy(self.views.parameters)
+    def attach_parameters(self, memory):
+        """Use the given array as memory for the parameters.
 
-        self.views = create_buffer_views_from_layout(
-            self.layout, self.buffers, self.hubs, existing_view=self.views)
+        The parameters are not copied: they simply are the content of the
+        memory from now on, which can for example be a memory-mapped file.
+        Everything else, including the gradients, is still allocated by the
+        handler. Changing the handler copies the parameters to memory of the
+        new handler again.
 
-        if parameters is not None:
-            self.handler.set_from_numpy(self.views.parameters, parameters)
+        Args:
+            memory (array_type):
+                Flat array with one entry per parameter that the handler
+                can operate on.
+        """
+        size = self.layout['parameters']['@shape'][0]
+        if memory.shape != (size,):
+            raise ValueError('Memory of shape {} does not fit {} parameters.'
+                             .format(memory.shape, size))
+        self._reset_buffers()
+        self.parameter_memory = memory if size else None
+        self._allocate_parameters()
+        self.resize(0, 0)
+
+    def _get_buffers(self, storage, time_size, batch_size):
+        hubs = self._select(self.hubs, storage)
+        live_ranges = None
+        if self.live_ranges is not None:
+            live_ranges = self._select(self.live_ranges, storage)
+        size, slices, shapes = get_total_size_slices_and_shapes(
+            hubs, time_size, batch_size, live_ranges)
+        if storage == 'full':
+            allocated_size, allocate = self.size, self.handler.allocate
+        else:
+            allocated_size = self.activation_size
+            allocate = self.handler.allocate_activations
+
+        if size > allocated_size:
+            # allocate enough for the whole bucket
+            bucket_size = get_total_size_slices_and_shapes(
+                hubs, _round_up(time_size, self.time_bucket),
+                _round_up(batch_size, self.batch_bucket), live_ranges)[0]
+            allocated_size = max(size, bucket_size)
+            if storage == 'full':
+                self.full_buffer = allocate((allocated_size,))
+                self.size = allocated_size
+            else:
+                self.activation_buffer = allocate((allocated_size,))
+                self.activation_size = allocated_size
+            # the cached views point to the old memory
+            self._cached_views.clear()
+
+        full_buffer = self.full_buffer if storage == 'full' else \
+            self.activation_buffer
+        return [full_buffer[s].reshape(shape)
+                for s, shape in zip(slices, shapes)]
+
+    def resize(self, time_size, batch_size):
+        if time_size == self.time_size and batch_size == self.batch_size:
+            return self.views  # lazy
+
+        shape = (time_size, batch_size)
+        if shape in self._cached_views:
+            # mark as most recently used
+            self._cached_views[shape] = self._cached_views.pop(shape)
+        else:
+            buffers = {
+                'parameters': list(self.parameter_buffers),
+                'full': self._get_buffers('full', time_size, batch_size),
+                'activations': self._get_buffers('activations', time_size,
+                                                 batch_size)}
+            buffers = [buffers[s].pop(0) for s in self.storage]
+            views = create_buffer_views_from_layout(self.layout, buffers,
+                                                    self.hubs)
+            self._cached_views[shape] = (buffers, views)
+            # with variable sized minibatches there can be lots of shapes
+            while len(self._cached_views) > self.max_cached_shapes:
+                self._cached_views.popitem(last=False)
 
+        self.time_size = time_size
+        self.batch_size = batch_size
+        self.buffers, self.views = self._cached_views[shape]
         return self.views
 
-    def set_handler(self, new_handler):
+    def _reset_buffers(self):
         self.full_buffer = None
         self.size = -1
+        self.activation_buffer = None
+        self.activation_size = -1
         self.time_size = -1
         self.batch_size = -1
+        self.views = None
+        self._cached_views.clear()
+
+    def set_handler(self, new_handler):
         parameters = None
         if self.views is not None:
             parameters = self.handler.get_numpy_copy(self.views.parameters)
-        self.views = None
+        self._reset_buffers()
+        self.parameter_memory = None
         self.handler = new_handler
+        self._allocate_parameters()
         self.resize(0, 0)
         if parameters is not None:
             self.handler.set_from_numpy(self.views.parameters, parameters)
@@ -2,15 +2,27 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
 
-import itertools
+import copy
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import warnings
 from collections import OrderedDict
 
 import numpy as np
 
+from brainstorm.__about__ import __version__
 from brainstorm.structure.buffer_structure import BufferStructure
 from brainstorm.utils import (NetworkValidationError, get_by_path,
                               convert_to_nested_indices, flatten,
-                              get_normalized_path, sort_by_index_key)
+                              get_cache_dir, get_normalized_path,
+                              sort_by_index_key)
+
+
+LAYOUT_ERROR_MESSAGE = "Failed to lay out buffers. Please change connectivity."
 
 
 class Hub(object):
@@ -22,7 +34,7 @@ class Hub(object):
 
         sorted_sources = sorted(source_set)
         flat_sources = list(flatten(sorted_sources))
-        nesting = convert_to_nested_indices(sorted_sources)
+        nesting = list(convert_to_nested_indices(sorted_sources))
 
         # get buffer type for hub and assert its uniform
         structs = [BufferStructure.from_layout(get_by_path(layout, s))
@@ -37,6 +49,8 @@ class Hub(object):
         hub.size = sum(hub.sizes)
         hub.is_backward_only = ensure_uniform([structs[i].is_backward_only
                                                for i in hub.perm])
+        hub.is_full_precision = any([structs[i].is_full_precision
+                                     for i in hub.perm])
         return hub
 
     def __init__(self, flat_sources, nesting, sinks, btype, context_size=0):
@@ -49,6 +63,8 @@ class Hub(object):
         self.sizes = []
         self.size = -1
         self.perm = None
+        self.is_backward_only = False
+        self.is_full_precision = False
 
     def get_shape(self, time_size=1, batch_size=1):
         full_shape = (time_size + self.context_size,
@@ -83,18 +99,40 @@ class Hub(object):
         Given a list of sources and a connection table, find a permutation of
         the sources, such that they can be connected to the sinks via a single
         buffer.
+
+        The entries of the nesting are moved as blocks. Of all the valid
+        orders of these blocks the lexicographically smallest one is used,
+        which is read off a PQ-tree of the consecutive-ones constraints in
+        polynomial time.
+
+        Raises:
+            NetworkValidationError: If no valid order exists.
         """
-        # systematically try all permutations until one satisfies the condition
-        for perm in itertools.permutations(self.nesting):
-            self.perm = list(flatten(perm))
-            ct = np.atleast_2d(self.connection_table[self.perm])
-            if Hub.can_be_connected_with_single_buffer(ct):
-                self.connection_table = ct
-                self.flat_sources = [self.flat_sources[i] for i in self.perm]
-                return
-
-        raise NetworkValidationError("Failed to lay out buffers. "
-                                     "Please change connectivity.")
+        # split the blocks into runs of rows with identical connections and
+        # chain the runs of each block together in their fixed order
+        table = np.atleast_2d(self.connection_table)
+        atoms = []
+        successors = {}
+        for n in self.nesting:
+            first = len(atoms)
+            for row in flatten([n]):
+                if len(atoms) > first and \
+                        np.array_equal(table[row], table[atoms[-1][0]]):
+                    atoms[-1].append(row)
+                else:
+                    atoms.append([row])
+            successors.update((i, i + 1) for i in range(first, len(atoms) - 1))
+
+        atom_table = table[[a[0] for a in atoms]]
+        sets = {frozenset(np.flatnonzero(col).tolist())
+                for col in atom_table.T}
+        sets |= {frozenset(p) for p in successors.items()}
+        sets = [s for s in sets if len(s) > 1]
+
+        order = _get_consecutive_order(len(atoms), sets, successors)
+        self.perm = [row for a in order for row in atoms[a]]
+        self.connection_table = np.atleast_2d(self.connection_table[self.perm])
+        self.flat_sources = [self.flat_sources[i] for i in self.perm]
 
     @staticmethod
     def can_be_connected_with_single_buffer(connection_table):
@@ -130,19 +168,38 @@ class Hub(object):
             yield sink_name, (int(start), int(stop))
 
 
-def create_layout(layers):
+def create_layout(layers, include_backward=True):
+    """Determine the hubs and the layout of all buffers for the given layers.
+
+    Args:
+        layers (dict):
+            The instantiated layers of the network in canonical order.
+        include_backward (Optional[bool]):
+            If set to False, the layout leaves out the deltas, gradients and
+            backward-only internals, such that only forward passes can be
+            computed. The views for the deltas and gradients are empty and
+            backward-only internals are None.
+            Defaults to True.
+
+    Returns:
+        tuple[list[Hub], dict]: The hubs and the layout.
+    """
     # gather connections and order-constraints
-    forced_orders = get_forced_orders(layers)
-    connections = get_connections(layers)
+    forced_orders = get_forced_orders(layers, include_backward)
+    connections = get_connections(layers, include_backward)
 
     # create a stub layout
-    layout = create_layout_stub(layers)
-    all_sources = get_all_sources(forced_orders, connections, layout)
+    layout = create_layout_stub(layers, include_backward)
+    all_sources = get_all_sources(forced_orders, connections, layout,
+                                  include_backward)
 
     # group into hubs and lay them out
     hubs = group_into_hubs(all_sources, forced_orders, connections, layout)
     hubs = sorted(hubs, key=lambda x: (x.is_backward_only, x.btype))
     layout_hubs(hubs, layout)
+    for layer_name in layers:
+        for category in ('parameters', 'gradients'):
+            add_slice_of_all_children(layout[layer_name][category])
 
     # add shape to parameters
     if '@slice' not in layout['parameters']:
@@ -153,11 +210,102 @@ def create_layout(layers):
         layout['gradients']['@hub'] = 0
     param_slice = layout['parameters']['@slice']
     layout['parameters']['@shape'] = (param_slice[1] - param_slice[0],)
-    layout['gradients']['@shape'] = (param_slice[1] - param_slice[0],)
+    grad_slice = layout['gradients']['@slice']
+    layout['gradients']['@shape'] = (grad_slice[1] - grad_slice[0],)
 
     return hubs, layout
 
 
+class LayoutCache(object):
+    """Remembers the hubs and layouts computed by :func:`create_layout`.
+
+    Layouts are keyed by a hash of the architecture and the brainstorm
+    version, and are kept in memory and in a directory with one file per
+    layout, so that an architecture is only laid out once.
+
+    Args:
+        directory (Optional[str]):
+            The directory for storing the layouts. Defaults to ``layouts``
+            in :func:`brainstorm.utils.get_cache_dir`. Pass False to only
+            keep the layouts in memory.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(get_cache_dir(), 'layouts')
+        self.directory = directory
+        self.layouts = {}
+        self._lock = threading.Lock()
+
+    def get(self, architecture, layers, include_backward=True):
+        """Return the hubs and the layout for the given architecture.
+
+        Args:
+            architecture (dict):
+                JSON serializable architecture description.
+            layers (dict):
+                The layers instantiated from the architecture. They are only
+                used if the layout isn't cached yet.
+            include_backward (Optional[bool]):
+                See :func:`create_layout`.
+
+        Returns:
+            tuple[list[Hub], dict]: Copies of the cached hubs and layout.
+        """
+        key = get_architecture_hash(architecture, include_backward)
+        with self._lock:
+            if key not in self.layouts:
+                cached = self._load(key)
+                if cached is None:
+                    cached = create_layout(layers, include_backward)
+                    self._save(key, cached)
+                self.layouts[key] = cached
+            return copy.deepcopy(self.layouts[key])
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def _load(self, key):
+        if not self.directory or not os.path.exists(self._get_filename(key)):
+            return None
+        try:
+            with open(self._get_filename(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, AttributeError, ImportError,
+                pickle.UnpicklingError) as e:
+            warnings.warn('Ignoring the unreadable cached layout {}: {}'
+                          .format(self._get_filename(key), e))
+            return None
+
+    def _save(self, key, cached):
+        if not self.directory:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            # write to a temporary file first, so readers never see a
+            # partially written layout
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(cached, f, protocol=2)
+            os.rename(tmp_name, self._get_filename(key))
+        except (IOError, OSError) as e:
+            warnings.warn('Could not write the cached layout {}: {}'
+                          .format(self._get_filename(key), e))
+
+
+default_layout_cache = LayoutCache(directory=False)
+
+
+def get_architecture_hash(architecture, include_backward=True):
+    """Return a hash of the architecture that doesn't depend on the order of
+    its keys, and that changes with the brainstorm version."""
+    description = json.dumps([__version__, include_backward, architecture],
+                             sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
 def layout_hubs(hubs, layout):
     """
     Determine and fill in the @slice entries into the layout and return total
@@ -170,13 +318,39 @@ def layout_hubs(hubs, layout):
             buffer_layout['@hub'] = hub_nr
 
 
-def get_all_sources(forced_orders, connections, layout):
+def add_slice_of_all_children(layout):
+    """
+    Fill in the @slice, @hub and @shape entries of a BufferView covering all
+    its arrays, if these are laid out in one piece of the same hub. This is
+    the case for the parameters and gradients of a layer, because of their
+    forced order.
+    """
+    children = [v for k, v in layout.items() if not k.startswith('@')]
+    if not children or not all('@slice' in c for c in children):
+        return
+    if len({c['@hub'] for c in children}) != 1:
+        return
+    start = min(c['@slice'][0] for c in children)
+    stop = max(c['@slice'][1] for c in children)
+    if stop - start != sum(c['@slice'][1] - c['@slice'][0]
+                           for c in children):
+        return
+    layout['@slice'] = (start, stop)
+    layout['@hub'] = children[0]['@hub']
+    layout['@shape'] = (stop - start,)
+
+
+def get_all_sources(forced_orders, connections, layout,
+                    include_backward=True):
     """Gather all sources while preserving order of the sources."""
     all_sinks = sorted(set(list(zip(*connections))[1])) if connections else []
     all_sources = list()
     for s in gather_array_nodes(layout):
         if s in all_sinks + ['parameters', 'gradients']:
             continue
+        if not include_backward and \
+                get_by_path(layout, s).get('@is_backward_only'):
+            continue
         for fo in forced_orders:
             if s in set(flatten(all_sources)):
                 break
@@ -189,9 +363,11 @@ def get_all_sources(forced_orders, connections, layout):
     return all_sources
 
 
-def get_forced_orders(layers):
+def get_forced_orders(layers, include_backward=True):
     forced_orders = [get_parameter_order(n, l) for n, l in layers.items()]
-    forced_orders += [get_gradient_order(n, l) for n, l in layers.items()]
+    if include_backward:
+        forced_orders += [get_gradient_order(n, l)
+                          for n, l in layers.items()]
     forced_orders = list(filter(None, forced_orders))
     # ensure no overlap
     for fo in forced_orders:
@@ -204,7 +380,7 @@ def get_forced_orders(layers):
     return forced_orders
 
 
-def create_layout_stub(layers):
+def create_layout_stub(layers, include_backward=True):
     root = {'@type': 'BufferView',
             'parameters': {
                 '@type': 'array',
@@ -215,13 +391,13 @@ def create_layout_stub(layers):
                 '@is_backward_only': True}
             }
     for i, (layer_name, layer) in enumerate(layers.items(), start=2):
-        root[layer_name] = get_layout_stub_for_layer(layer)
+        root[layer_name] = get_layout_stub_for_layer(layer, include_backward)
         root[layer_name]['@type'] = 'BufferView'
         root[layer_name]['@index'] = i
     return root
 
 
-def get_layout_stub_for_layer(layer):
+def get_layout_stub_for_layer(layer, include_backward=True):
     layout = {}
 
     layout['inputs'] = {
@@ -260,6 +436,7 @@ def get_layout_stub_for_layer(layer):
     }
     for k, v in layout['input_deltas'].items():
         v['@is_backward_only'] = True
+        v.pop('@is_full_precision', None)  # deltas never hold exact values
     layout['input_deltas']['@type'] = 'BufferView'
     layout['input_deltas']['@index'] = 4
 
@@ -268,6 +445,7 @@ def get_layout_stub_for_layer(layer):
     }
     for k, v in layout['output_deltas'].items():
         v['@is_backward_only'] = True
+        v.pop('@is_full_precision', None)  # deltas never hold exact values
     layout['output_deltas']['@type'] = 'BufferView'
     layout['output_deltas']['@index'] = 5
 
@@ -279,6 +457,11 @@ def get_layout_stub_for_layer(layer):
     layout['gradients']['@type'] = 'BufferView'
     layout['gradients']['@index'] = 6
 
+    if not include_backward:
+        for category in ['input_deltas', 'output_deltas', 'gradients']:
+            layout[category] = {'@type': 'BufferView',
+                                '@index': layout[category]['@index']}
+
     return layout
 
 
@@ -315,7 +498,7 @@ def get_backward_connection(start, stop, layer):
     return new_start, new_end
 
 
-def get_connections(layers):
+def get_connections(layers, include_backward=True):
     connections = []
     for layer_name, layer in layers.items():
         for con in layer.outgoing:
@@ -324,6 +507,8 @@ def get_connections(layers):
             end = get_normalized_path(con.end_layer, 'inputs', con.input_name)
             connections.append((start, end))
 
+            if not include_backward:
+                continue
             bwd_con = get_backward_connection(start, end, layer)
 
             if bwd_con:
@@ -336,9 +521,11 @@ def get_connections(layers):
             end = 'parameters'
             connections.append((start, end))
 
-            start = get_normalized_path(layer_name, 'gradients', param_name)
-            end = 'gradients'
-            connections.append((start, end))
+            if include_backward:
+                start = get_normalized_path(layer_name, 'gradients',
+                                            param_name)
+                end = 'gradients'
+                connections.append((start, end))
 
     return sorted(connections)
 
@@ -424,3 +611,186 @@ def get_forward_closure(node, connections):
             source_set = new_source_set
             sink_set = new_sink_set
     return source_set, sink_set
+
+
+def _get_overlap_components(sets):
+    """
+    Group the given sets into the connected components of their overlap
+    graph. Two sets overlap if they intersect but neither contains the other.
+    Within a component every set overlaps one of the sets preceding it.
+    """
+    if not sets:
+        return []
+    elements = sorted(frozenset().union(*sets))
+    index = {e: i for i, e in enumerate(elements)}
+    membership = np.zeros((len(sets), len(elements)))
+    for i, s in enumerate(sets):
+        membership[i, [index[e] for e in s]] = 1
+    common = membership.dot(membership.T)
+    sizes = np.diag(common)
+    overlap = ((common > 0) & (common < sizes[:, None]) &
+               (common < sizes[None, :]))
+
+    unvisited = set(range(len(sets)))
+    components = []
+    while unvisited:
+        stack = [min(unvisited)]
+        unvisited.remove(stack[0])
+        component = []
+        while stack:
+            i = stack.pop()
+            component.append(sets[i])
+            for j in np.flatnonzero(overlap[i]).tolist():
+                if j in unvisited:
+                    unvisited.remove(j)
+                    stack.append(j)
+        components.append(component)
+    return components
+
+
+def _order_classes(component):
+    """
+    Partition the union of an overlap component into classes of elements that
+    are contained in the same sets, and order them such that every set covers
+    consecutive classes. This order is unique up to reversal.
+    """
+    classes = [component[0]]
+    covered = component[0]
+    for s in component[1:]:
+        hits = [i for i, c in enumerate(classes) if c & s]
+        first, last = hits[0], hits[-1]
+        if len(hits) != last - first + 1 or \
+                not all(c <= s for c in classes[first + 1:last]):
+            raise NetworkValidationError(LAYOUT_ERROR_MESSAGE)
+        new = s - covered
+        head, tail = classes[first], classes[last]
+        if not new:
+            classes = (classes[:first] + [head - s, head & s] +
+                       classes[first + 1:last] + [tail & s, tail - s] +
+                       classes[last + 1:])
+        elif last == len(classes) - 1 and (first == last or tail <= s):
+            classes = (classes[:first] + [head - s, head & s] +
+                       classes[first + 1:] + [new])
+        elif first == 0 and (first == last or head <= s):
+            classes = ([new] + classes[:last] + [tail & s, tail - s] +
+                       classes[last + 1:])
+        else:
+            raise NetworkValidationError(LAYOUT_ERROR_MESSAGE)
+        classes = [c for c in classes if c]
+        covered |= s
+    return classes
+
+
+def _arrange(frontiers, is_ordered, successors):
+    """
+    Concatenate the smallest frontiers of the children of a PQ-tree node
+    such that the result is lexicographically smallest. The children of a
+    P-node (is_ordered=False) can be ordered arbitrarily, the ones of a Q-node
+    can only be reversed. A leaf that has a successor has to be directly
+    followed by it.
+    """
+    if not is_ordered and len(frontiers) > 2:
+        return [e for f in sorted(frontiers) for e in f]
+
+    position = {f[0]: i for i, f in enumerate(frontiers) if len(f) == 1}
+    required = {position[c] > position[s] for c, s in successors.items()
+                if c in position}
+    if len(required) > 1:
+        raise NetworkValidationError(LAYOUT_ERROR_MESSAGE)
+    if required:
+        reverse = required.pop()
+    else:
+        reverse = frontiers[-1][0] < frontiers[0][0]
+    if reverse:
+        frontiers = frontiers[::-1]
+    return [e for f in frontiers for e in f]
+
+
+def _get_laminar_children(size, nodes):
+    """
+    Determine the children of each node of a laminar family, where the parent
+    of a node is the next larger node around any of its elements.
+
+    Args:
+        size (int):
+            The number of elements.
+        nodes (OrderedDict[frozenset[int], list]):
+            The nodes ordered by size.
+    Returns:
+        dict[frozenset[int], list[frozenset[int]]]: The children of each node.
+    """
+    around = [[] for _ in range(size)]
+    for union in nodes:
+        for e in union:
+            around[e].append(union)
+    children = {union: [] for union in nodes}
+    for union in nodes:
+        chain = around[min(union)]
+        i = chain.index(union)
+        if i + 1 < len(chain):
+            children[chain[i + 1]].append(union)
+    return children
+
+
+def _get_node_frontier(classes, children, frontiers, successors):
+    """
+    Get the smallest frontier of a PQ-tree node with the given classes, from
+    the frontiers of its children and its loose elements.
+    """
+    class_of = {e: i for i, c in enumerate(classes) for e in c}
+    contents = [[] for _ in classes]
+    for child in children:
+        contents[class_of[min(child)]].append(child)
+    class_frontiers = []
+    for c, content in zip(classes, contents):
+        loose = c.difference(*content)
+        parts = [frontiers[x] for x in content] + [[e] for e in loose]
+        if len(parts) == 1:
+            class_frontiers.append(parts[0])
+        else:
+            class_frontiers.append(_arrange(parts, False, successors))
+    if len(classes) == 1:
+        return class_frontiers[0]
+    return _arrange(class_frontiers, True, successors)
+
+
+def _get_consecutive_order(size, sets, successors):
+    """
+    Find the lexicographically smallest order of the elements 0, ..., size - 1
+    in which all the given sets are consecutive and each element is directly
+    followed by its successor.
+
+    The PQ-tree of all such orders is built bottom-up: Each overlap component
+    of the sets is a Q-node over its classes (or a P-node if it consists of a
+    single set) and the unions of the components form a laminar family.
+
+    Args:
+        size (int):
+            The number of elements.
+        sets (list[frozenset[int]]):
+            Distinct sets of at least two elements each.
+        successors (dict[int, int]):
+            Elements that have to be directly followed by another one.
+    Returns:
+        list[int]: The order of the elements.
+    Raises:
+        NetworkValidationError: If no such order exists.
+    """
+    domain = frozenset(range(size))
+    components = _get_overlap_components([s for s in sets if s != domain] +
+                                         [domain])
+    nodes = {}
+    for component in components:
+        union = frozenset().union(*component)
+        if len(component) > 1:
+            nodes[union] = _order_classes(component)
+        else:
+            nodes.setdefault(union, [union])
+    nodes = OrderedDict(sorted(nodes.items(), key=lambda x: len(x[0])))
+    children = _get_laminar_children(size, nodes)
+
+    frontiers = {}
+    for union, classes in nodes.items():
+        frontiers[union] = _get_node_frontier(classes, children[union],
+                                              frontiers, successors)
+    return frontiers[domain]
@@ -3,14 +3,22 @@
 from __future__ import division, print_function, unicode_literals
 
 import json
+import os
 import re
+import struct
+import sys
+import tempfile
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import h5py
 import numpy as np
+import six
+from six.moves import queue
 
 from brainstorm.describable import create_from_description, get_description
 from brainstorm.handlers import default_handler
+from brainstorm.handlers.recording_handler import RecordingHandler
 from brainstorm.initializers import ArrayInitializer, evaluate_initializer
 from brainstorm.layers.loss_layer import LossLayerImpl
 from brainstorm.randomness import Seedable
@@ -18,7 +26,8 @@ from brainstorm.structure.architecture import (generate_architecture,
                                                instantiate_layers_from_architecture)
 from brainstorm.structure.buffer_views import BufferView
 from brainstorm.structure.buffers import BufferManager
-from brainstorm.structure.layout import create_layout
+from brainstorm.structure.layout import (create_layout,
+                                         default_layout_cache)
 from brainstorm.structure.view_references import (order_and_copy_modifiers,
                                                   prune_view_references,
                                                   resolve_references)
@@ -31,62 +40,120 @@ __all__ = ['Network']
 # ################################ Network ####################################
 
 class Network(Seedable):
-    __undescribed__ = {'layers', 'loss_layers', 'buffer', '_buffer_manager'}
+    __undescribed__ = {'layers', 'loss_layers', 'buffer', '_buffer_manager',
+                       'use_execution_plans', '_execution_plans',
+                       'branch_threads', '_forward_dependencies',
+                       '_backward_dependencies', '_thread_pool', 'mode',
+                       'skip_unused_deltas', '_gradient_needs',
+                       '_trainable_slices', '_layer_positions'}
+    __default_values__ = {'frozen_parameters': {}}
 
     # -------------------------- Constructors ---------------------------------
     @classmethod
-    def from_layer(cls, some_layer):
+    def from_layer(cls, some_layer, mode='training', reuse_memory=False):
         """
         Create Network instance from a construction layer.
 
         Args:
             some_layer (brainstorm.construction.ConstructionWrapper):
                 Some layer used to wire up an architecture with `>>`
+            mode (Optional[str]):
+                See :meth:`from_architecture`.
+            reuse_memory (Optional[bool]):
+                See :meth:`from_architecture`.
 
         Returns:
             Network:
                 A fully functional Network instance.
         """
         arch = generate_architecture(some_layer)
-        return cls.from_architecture(arch)
+        return cls.from_architecture(arch, mode=mode,
+                                     reuse_memory=reuse_memory)
 
     @classmethod
-    def from_architecture(cls, architecture):
+    def from_architecture(cls, architecture, mode='training',
+                          reuse_memory=False,
+                          layout_cache=default_layout_cache):
         """
         Create Network instance from given architecture.
 
         Args:
             architecture (dict):
                 JSON serializable Architecture description.
+            mode (Optional[str]):
+                Either 'training' or 'inference'. An inference network
+                doesn't allocate deltas, gradients and backward-only
+                internals, and therefore only supports forward passes.
+                Defaults to 'training'.
+            reuse_memory (Optional[bool]):
+                If set, buffers that are not needed at the same time during
+                a forward pass share their memory. This implies
+                mode='inference', since a backward pass would need the
+                overwritten activations, and only the outputs of layers that
+                aren't connected to other layers are kept. Buffers that carry
+                context between time steps are never reused, so the memory
+                of recurrent layers still grows with the depth of the
+                network. Defaults to False.
+            layout_cache (Optional[brainstorm.structure.layout.LayoutCache]):
+                Cache for the layouts of architectures. Defaults to a cache
+                that only lives in memory. Pass None to always compute the
+                layout.
         Returns:
             Network:
                 A fully functional Network instance.
         """
+        if mode not in ('training', 'inference'):
+            raise ValueError('Unknown network mode "{}". Has to be either '
+                             '"training" or "inference".'.format(mode))
+        if reuse_memory:
+            mode = 'inference'
         layers = instantiate_layers_from_architecture(architecture)
-        hubs, layout = create_layout(layers)
-        buffer_manager = BufferManager(layout, hubs)
-        return cls(layers, buffer_manager, architecture)
+        include_backward = (mode == 'training')
+        if layout_cache is None:
+            hubs, layout = create_layout(layers, include_backward)
+        else:
+            hubs, layout = layout_cache.get(architecture, layers,
+                                            include_backward)
+        buffer_manager = BufferManager(layout, hubs,
+                                       reuse_memory=reuse_memory)
+        return cls(layers, buffer_manager, architecture, mode=mode)
 
     @classmethod
-    def __new_from_description__(cls, description):
-        net = Network.from_architecture(description['architecture'])
+    def __new_from_description__(cls, description, mode='training',
+                                 reuse_memory=False, parameters=None):
+        net = Network.from_architecture(description['architecture'],
+                                        mode=mode, reuse_memory=reuse_memory)
         net.set_handler(create_from_description(description['handler']))
-        net.initialize(create_from_description(description['initializers']))
+        if parameters is None:
+            net.initialize(
+                create_from_description(description['initializers']))
+        else:
+            # the parameters replace the initialization
+            net.initializers = description['initializers']
+            if _can_operate_on(net.handler, parameters):
+                net.attach_parameters(parameters)
+            else:
+                net.handler.set_from_numpy(net.buffer.parameters, parameters)
         net.set_gradient_modifiers(
             create_from_description(description['gradient_modifiers']))
         net.set_weight_modifiers(
             create_from_description(description['weight_modifiers']))
+        net._set_frozen_parameters(description.get('frozen_parameters', {}))
         net.output_name = description.get('output_name')
         return net
 
     @classmethod
-    def from_hdf5(cls, filename):
+    def from_hdf5(cls, filename, mode='training', reuse_memory=False):
         """
         Load network from HDF5 file.
 
         Args:
             filename (str):
                 Name of the file that the network should be loaded from.
+            mode (Optional[str]):
+                See :meth:`from_architecture`.
+            reuse_memory (Optional[bool]):
+                See :meth:`from_architecture`.
 
         Returns:
             Network:
@@ -96,26 +163,80 @@ class Network(Seedable):
             :meth:`.save_as_hdf5`
         """
         with h5py.File(filename, 'r') as f:
-            description = json.loads(f['description'].value.decode())
-            net = create_from_description(description)
+            description = json.loads(f['description'][()].decode())
+            net = cls.__new_from_description__(description, mode=mode,
+                                               reuse_memory=reuse_memory)
             net.handler.set_from_numpy(net.buffer.parameters,
-                                       f['parameters'].value)
+                                       f['parameters'][()])
         return net
 
+    @classmethod
+    def from_mmap(cls, filename, mode='training', reuse_memory=False,
+                  mmap_mode='c'):
+        """
+        Load network from a file written by :meth:`save_as_mmap`.
+
+        If the handler of the network operates on numpy arrays of the dtype
+        stored in the file, the parameters are memory-mapped instead of
+        copied. They are then only read from disk when they are used, and
+        they share the page cache with all other processes that map the
+        same file.
+
+        Args:
+            filename (str):
+                Name of the file that the network should be loaded from.
+            mode (Optional[str]):
+                See :meth:`from_architecture`.
+            reuse_memory (Optional[bool]):
+                See :meth:`from_architecture`.
+            mmap_mode (Optional[str]):
+                How the file is mapped (see :class:`numpy.memmap`): 'r' for
+                read-only parameters, 'r+' to write changes of the parameters
+                back to the file and 'c' to keep changes in memory only.
+                Defaults to 'c'.
+
+        Returns:
+            Network:
+                The loaded network.
+
+        See Also:
+            :meth:`.save_as_mmap`
+        """
+        header, parameters = _read_network_file(filename, mmap_mode)
+        return cls.__new_from_description__(
+            header['description'], mode=mode, reuse_memory=reuse_memory,
+            parameters=parameters)
+
     def __init__(self, layers, buffer_manager, architecture, seed=None,
-                 handler=default_handler):
+                 handler=default_handler, mode='training'):
         super(Network, self).__init__(seed)
         self.layers = layers
+        self.mode = mode
         self.loss_layers = _get_loss_layers(layers)
         self._buffer_manager = buffer_manager
         self.buffer = self._buffer_manager.views
         self.architecture = architecture
         self.handler = None
+        # if set, the passes of the layers are recorded once per buffer size
+        # and replayed afterwards (see _run_with_execution_plan)
+        self.use_execution_plans = False
+        self._execution_plans = {}
+        # if > 1, layers that don't depend on each other are run concurrently
+        # on that many threads (see _run_layers_concurrently)
+        self.branch_threads = 1
+        self._forward_dependencies, self._backward_dependencies = \
+            _get_layer_dependencies(layers)
+        self._thread_pool = None
+        self._layer_positions = {name: i for i, name in enumerate(layers)}
+        # if set, the backward pass skips the deltas that no gradient depends
+        # on (see _get_gradient_needs)
+        self.skip_unused_deltas = False
         self.set_handler(handler)
         self.initializers = {}
         self.weight_modifiers = {}
         self.gradient_modifiers = {}
         self.output_name = None
+        self._set_frozen_parameters({})
 
     def get(self, buffer_path):
         """
@@ -124,7 +245,7 @@ class Network(Seedable):
         Examples:
             >>> parameters = net.get('parameters')
             >>> outputs = net.get('OutputLayer.outputs.probabilities')
-            >>> forget_gates = net.get('Lstm.internals.Fb')
+            >>> cell_states = net.get('Lstm.internals.Ca')
 
         Args:
             buffer_path (str):
@@ -357,6 +478,79 @@ class Network(Seedable):
         self.gradient_modifiers = order_and_copy_modifiers(gradient_mods)
         # TODO: Check that all are ValueModifiers or GradientModifiers
 
+    def freeze(self, default_or_freeze_dict=None, **kwargs):
+        """
+        Freeze parameters of the network, such that they are not trained.
+
+        Frozen parameters are skipped by the steppers and the gradient
+        modifiers, and their gradients are not computed (they stay zero for
+        the layers that support this). Layers that neither have trainable
+        parameters nor are connected to such layers further down are not run
+        in the backward pass at all, and only the deltas needed for the
+        trainable parameters are computed (see :attr:`skip_unused_deltas`).
+        So fine-tuning just the top layers costs little more than a forward
+        pass.
+
+        Parameters to freeze are specified in the same way as initializers,
+        but with True or False instead of an initializer, and there is no
+        fallback (see :meth:`.initialize` for details). Each call replaces
+        the previous freezing. So for example:
+
+        >>> net.freeze(default=True, Output=False)  # train only Output
+        >>> net.freeze(Conv1=True, Conv2={'W': True})
+        >>> net.freeze(False)  # unfreeze all parameters
+
+        Raises:
+            NetworkValidationError:
+                If a parameter is both frozen and not frozen.
+        """
+        freeze_refs = _update_references_with_dict(default_or_freeze_dict,
+                                                   kwargs)
+        all_parameters = {k: v.parameters
+                          for k, v in self.buffer.items()
+                          if k not in ['parameters', 'gradients'] and
+                          'parameters' in v}
+        freezes, fallback = resolve_references(all_parameters, freeze_refs)
+
+        assert not prune_view_references(fallback), \
+            'fallback is not supported for freezing'
+        frozen = {}
+        for layer_name, views in prune_view_references(freezes).items():
+            for view_name, flags in views.items():
+                if len(flags) > 1:
+                    raise NetworkValidationError(
+                        "Conflicting freezing for {}.{}: {}".format(
+                            layer_name, view_name, flags))
+                if flags.pop():
+                    frozen.setdefault(layer_name, []).append(view_name)
+        self._set_frozen_parameters(frozen)
+
+    def _set_frozen_parameters(self, frozen):
+        self.frozen_parameters = {layer_name: sorted(view_names)
+                                  for layer_name, view_names in frozen.items()}
+        for layer_name, layer in self.layers.items():
+            layer.frozen_parameters = frozenset(
+                self.frozen_parameters.get(layer_name, ()))
+        self._gradient_needs = _get_gradient_needs(self.layers,
+                                                   self.frozen_parameters)
+        self._trainable_slices = _get_trainable_slices(
+            self._buffer_manager.layout, self.frozen_parameters)
+        self.clear_execution_plans()
+
+    def get_trainable_slices(self):
+        """Return the slices of the parameters (and gradients) that are not
+        frozen.
+
+        Steppers update only these parts of :attr:`buffer.parameters`.
+        Without frozen parameters this is a single slice spanning all the
+        parameters.
+
+        Returns:
+            list[slice]:
+                Non-overlapping slices in ascending order.
+        """
+        return self._trainable_slices
+
     def set_handler(self, new_handler):
         """
         Change the handler of this network.
@@ -376,6 +570,153 @@ class Network(Seedable):
         self.buffer = self._buffer_manager.views
         for layer in self.layers.values():
             layer.set_handler(new_handler)
+        self.clear_execution_plans()
+
+    def attach_parameters(self, memory):
+        """
+        Use the given array as the memory of the parameters.
+
+        Instead of being copied into memory allocated by the handler, the
+        parameters are read from and written to the array directly, which
+        can e.g. be memory-mapped. Changing the handler copies them again.
+
+        Args:
+            memory (numpy.ndarray):
+                Flat array with one entry per parameter. It has to be of the
+                dtype of the handler.
+
+        Raises:
+            ValueError:
+                If the handler can't operate on the array directly.
+        """
+        if not _can_operate_on(self.handler, memory):
+            raise ValueError('The handler {} can not operate on an array of '
+                             'type {} and dtype {} directly.'.format(
+                                 self.handler, type(memory), memory.dtype))
+        # subclasses like numpy.memmap are not accepted by the handler
+        self._buffer_manager.attach_parameters(memory.view(np.ndarray))
+        self.buffer = self._buffer_manager.views
+        self.clear_execution_plans()
+
+    def share_parameters(self, filename=None):
+        """
+        Move the parameters into a memory-mapped file that other processes
+        can attach to.
+
+        Networks in other processes that were built from the same
+        architecture can use these parameters via
+        :meth:`attach_shared_parameters` (or load the whole network with
+        :meth:`from_mmap`), so the parameters are held in memory only once
+        per host, while every process keeps its own activations. Changes to
+        the parameters made by this network are seen by all of them.
+
+        The file is not deleted automatically, but it can be removed as soon
+        as all processes have attached to it.
+
+        Args:
+            filename (Optional[str]):
+                Name of the file to create. Defaults to a new file in
+                ``/dev/shm`` if available, and in the temporary directory
+                otherwise.
+
+        Returns:
+            str:
+                The name of the file.
+        """
+        if filename is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            fd, filename = tempfile.mkstemp(prefix='brainstorm-',
+                                            suffix='.bsnet', dir=directory)
+            os.close(fd)
+        self.save_as_mmap(filename)
+        try:
+            self.attach_parameters(_read_network_file(filename, 'r+')[1])
+        except ValueError:
+            os.remove(filename)
+            raise
+        return filename
+
+    def attach_shared_parameters(self, filename, writable=False):
+        """
+        Use the parameters shared by another network through
+        :meth:`share_parameters` instead of an own copy.
+
+        Args:
+            filename (str):
+                The file returned by :meth:`share_parameters`.
+            writable (Optional[bool]):
+                If set, this network can change the shared parameters as
+                well. Otherwise they are read-only, which suffices for
+                inference. Defaults to False.
+
+        Raises:
+            NetworkValidationError:
+                If the parameters were shared by a network with a different
+                architecture.
+        """
+        header, parameters = _read_network_file(filename,
+                                                'r+' if writable else 'r')
+        # the architecture in the file went through JSON
+        if header['description']['architecture'] != json.loads(
+                json.dumps(self.architecture)):
+            raise NetworkValidationError(
+                'The parameters in {} belong to a network with a different '
+                'architecture.'.format(filename))
+        self.attach_parameters(parameters)
+
+    def set_shape_buckets(self, time_bucket=1, batch_bucket=1):
+        """
+        Allocate the buffers of this network for whole buckets of shapes.
+
+        The time and batch size of the data are rounded up to a multiple of
+        the bucket sizes when allocating memory. This avoids reallocations
+        for minibatches with varying sequence lengths or batch sizes.
+
+        Args:
+            time_bucket (Optional[int]):
+                The time size is rounded up to a multiple of this.
+                Defaults to 1.
+            batch_bucket (Optional[int]):
+                The batch size is rounded up to a multiple of this.
+                Defaults to 1.
+        """
+        self._buffer_manager.set_shape_buckets(time_bucket, batch_bucket)
+
+    def clear_execution_plans(self):
+        """
+        Discard all recorded execution plans.
+
+        This is necessary if the behaviour of a layer was changed after its
+        passes were recorded, e.g. by modifying one of its attributes.
+
+        See Also:
+            :attr:`use_execution_plans`
+        """
+        self._execution_plans = {}
+
+    def for_inference(self, reuse_memory=False):
+        """
+        Create an inference-only copy of this network.
+
+        The copy shares the architecture, handler, output name and the
+        current parameter values of this network, but doesn't allocate any
+        buffers that are only needed for the backward pass.
+
+        Args:
+            reuse_memory (Optional[bool]):
+                See :meth:`from_architecture`.
+
+        Returns:
+            Network:
+                A new network that only supports forward passes.
+        """
+        net = Network.from_architecture(self.architecture, mode='inference',
+                                        reuse_memory=reuse_memory)
+        net.set_handler(self.handler)
+        net.output_name = self.output_name
+        net.handler.set_from_numpy(net.buffer.parameters,
+                                   self.get('parameters'))
+        return net
 
     # -------------------------- Running Methods ------------------------------
 
@@ -403,7 +744,7 @@ class Network(Seedable):
                 # assert isinstance(data[name], np.ndarray)
                 self.handler.set_from_numpy(buf, data[name])
 
-    def forward_pass(self, training_pass=False, context=None):
+    def forward_pass(self, training_pass=False, context=None, outputs=None):
         """
         Perform a forward pass on all the provided data.
 
@@ -422,29 +763,216 @@ class Network(Seedable):
                 state of the network at the t=-1. This is useful for continuing
                 the computations of a recurrent neural network.
                 Defaults to None.
+            outputs (Optional[list[str]]):
+                If given, only the layers needed for computing these buffers
+                (e.g. ``'Hid.outputs.default'``) are run. Inputs that only
+                the other layers use, like the targets, then don't have to be
+                provided. Defaults to None, which runs all layers.
         """
         if context is None:
             self._buffer_manager.clear_context()
         else:
             self._buffer_manager.apply_context(context)
-        for layer_name, layer in list(self.layers.items())[1:]:
-            layer.forward_pass(self.buffer[layer_name], training_pass)
+        layer_names = self._get_required_layers(outputs)
+        self._run_with_execution_plan(('forward', training_pass, layer_names),
+                                      self._forward_layers, training_pass,
+                                      layer_names)
+
+    def _get_required_layers(self, outputs=None):
+        """Return the names of the layers that the given buffers depend on in
+        the order of the forward pass (all layers for outputs=None)."""
+        names = list(self.layers)[1:]  # the Input layer does nothing
+        if outputs is None:
+            return tuple(names)
+        if isinstance(outputs, six.string_types):
+            outputs = [outputs]
+        required = set()
+        todo = [o.split('.')[0] for o in outputs]
+        while todo:
+            name = todo.pop()
+            if name not in self.layers:
+                raise KeyError('Unknown layer "{}". Available layers are: {}'
+                               .format(name, ', '.join(self.layers)))
+            if name not in required:
+                required.add(name)
+                todo.extend(self._forward_dependencies.get(name, ()))
+        return tuple(n for n in names if n in required)
+
+    def _forward_layers(self, training_pass, layer_names):
+        if self.branch_threads > 1:
+            self._run_layers_concurrently(
+                {n: self._forward_dependencies[n] for n in layer_names},
+                lambda layer: layer.forward_pass(self.buffer[layer.name],
+                                                 training_pass))
+            return
+        for layer_name in layer_names:
+            self.layers[layer_name].forward_pass(self.buffer[layer_name],
+                                                 training_pass)
+            self.handler.release_scratch()
 
     def backward_pass(self):
         """
         Perform a backward pass on all provided data and targets.
 
+        If :attr:`skip_unused_deltas` is set or some parameters are frozen
+        (see :meth:`freeze`), only the deltas that the gradients of the
+        trainable parameters depend on are computed. Layers without such
+        parameters upstream are not run at all, and the deltas of the
+        network inputs stay zero.
+
         Note:
             All the targets to be used during this backward pass have to be
             passed to the network beforehand using provide_external_data.
             Also this backward pass depends on the internal state produced by
             a forward pass. So you have to always run a forward_pass first.
         """
+        if self.mode == 'inference':
+            raise NetworkValidationError(
+                'This network was built for inference and therefore only '
+                'supports forward passes.')
+        prune = self.skip_unused_deltas or bool(self.frozen_parameters)
+        if prune:
+            layer_names, unused_deltas = self._gradient_needs
+        else:
+            layer_names, unused_deltas = tuple(list(self.layers)[1:]), {}
+        for layer_name, layer in self.layers.items():
+            layer.unused_input_deltas = unused_deltas.get(layer_name,
+                                                          frozenset())
         self._buffer_manager.clear_backward_buffers()
-        for layer_name, layer in reversed(list(self.layers.items())[1:]):
-            layer.backward_pass(self.buffer[layer_name])
+        self._run_with_execution_plan(
+            ('backward', prune), self._backward_layers,
+            layer_names)
         self.apply_gradient_modifiers()
 
+    def _backward_layers(self, layer_names):
+        if self.branch_threads > 1:
+            self._run_layers_concurrently(
+                {n: self._backward_dependencies[n] & set(layer_names)
+                 for n in layer_names},
+                lambda layer: layer.backward_pass(self.buffer[layer.name]))
+            return
+        for layer_name in reversed(layer_names):
+            self.layers[layer_name].backward_pass(self.buffer[layer_name])
+            self.handler.release_scratch()
+
+    def _run_layers_concurrently(self, dependencies, run_layer):
+        """Run the passes of all layers on a thread pool.
+
+        Every layer is started as soon as all the layers it depends on have
+        finished, so independent branches of the network overlap. Numpy and
+        BLAS release the GIL for the heavy lifting.
+
+        Args:
+            dependencies (dict[str, set[str]]):
+                Maps the name of every layer to run to the names of the
+                layers that have to finish before it.
+            run_layer (callable):
+                Runs the pass of the given layer.
+        """
+        pool = self._get_thread_pool()
+        finished = queue.Queue()
+        waiting = {name: set(deps) for name, deps in dependencies.items()}
+        running = 0
+        error = None
+        while True:
+            # after an error let the running layers finish but start no
+            # new ones
+            if error is None:
+                running += self._start_ready_layers(waiting, pool, run_layer,
+                                                    finished)
+            if not running:
+                break
+            name, exc_info = finished.get()
+            running -= 1
+            error = error or exc_info
+            for deps in waiting.values():
+                deps.discard(name)
+        if error is not None:
+            six.reraise(*error)
+
+    def _get_thread_pool(self):
+        """Return the thread pool for running layers concurrently, creating
+        a new one if :attr:`branch_threads` has changed."""
+        num_threads, pool = self._thread_pool or (None, None)
+        if num_threads != self.branch_threads:
+            self.close()
+            pool = ThreadPool(self.branch_threads)
+            self._thread_pool = (self.branch_threads, pool)
+        return pool
+
+    def close(self):
+        """Shut down the worker threads used for running layers concurrently.
+
+        The network stays usable: a new thread pool is created by the next
+        pass that needs one.
+        """
+        num_threads, pool = self._thread_pool or (None, None)
+        self._thread_pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __del__(self):
+        # __init__ might have failed before the pool was set
+        if getattr(self, '_thread_pool', None) is not None:
+            self.close()
+
+    def _start_ready_layers(self, waiting, pool, run_layer, finished):
+        """Start the passes of all waiting layers that don't depend on any
+        unfinished layer anymore, in the order of the layers.
+
+        Returns:
+            int: The number of started layers.
+        """
+        ready = sorted([n for n in waiting if not waiting[n]],
+                       key=self._layer_positions.get)
+        for name in ready:
+            del waiting[name]
+            pool.apply_async(self._run_layer_pass,
+                             (self.layers[name], run_layer, finished))
+        return len(ready)
+
+    def _run_layer_pass(self, layer, run_layer, finished):
+        """Run the pass of a layer on a worker thread and report its name
+        and the exception info (or None) to the finished queue."""
+        try:
+            run_layer(layer)
+            self.handler.release_scratch()
+        except Exception:
+            finished.put((layer.name, sys.exc_info()))
+        else:
+            finished.put((layer.name, None))
+
+    def _run_with_execution_plan(self, key, run_layers, *args):
+        """Run the passes of all layers through an execution plan.
+
+        If :attr:`use_execution_plans` is set, the first pass for each key
+        and buffer size is recorded into an execution plan, and subsequent
+        passes just replay that plan instead of running the layers.
+        """
+        if not self.use_execution_plans:
+            run_layers(*args)
+            return
+
+        manager = self._buffer_manager
+        key += (manager.time_size, manager.batch_size)
+        buffers = (manager.parameter_buffer, manager.full_buffer,
+                   manager.activation_buffer)
+        plan = self._execution_plans.get(key)
+        if plan is not None and plan.is_valid_for(buffers):
+            plan.run()
+            return
+
+        recorder = RecordingHandler(self.handler)
+        for layer in self.layers.values():
+            layer.set_handler(recorder)
+        try:
+            run_layers(*args)
+        finally:
+            for layer in self.layers.values():
+                layer.set_handler(self.handler)
+        self._execution_plans[key] = recorder.get_plan(buffers)
+
     def get_loss_values(self):
         """
         Get a dictionary of all the loss values that resulted from a
@@ -498,7 +1026,10 @@ class Network(Seedable):
 
     def apply_gradient_modifiers(self):
         for layer_name, views in self.gradient_modifiers.items():
+            frozen = self.frozen_parameters.get(layer_name, ())
             for view_name, gradient_mods in views.items():
+                if view_name in frozen:
+                    continue
                 for gm in gradient_mods:
                     gm.rnd.set_seed(self.rnd.generate_seed())
                     if isinstance(gm, GradientModifier):
@@ -535,9 +1066,181 @@ class Network(Seedable):
                 'parameters', compression='gzip',
                 data=self.get('parameters'))
 
+    def save_as_mmap(self, filename, comment=''):
+        """
+        Save this network in a file that :meth:`from_mmap` can memory-map.
+
+        The file starts with a versioned header holding the description of
+        this network, which is followed by the raw parameters. They are
+        neither compressed nor converted and start at a page boundary, so
+        that they can be mapped into memory as they are.
+
+        Args:
+            filename (str):
+                Name of the file this network should be saved to.
+                All directories have to exist already.
+
+            comment (Optional[str]):
+                An optional comment that will be saved inside the file.
+        """
+        _write_network_file(filename, get_description(self),
+                            self.get('parameters'), comment)
+
 
 # ########################### Helper Methods ##################################
 
+NETWORK_FILE_MAGIC = b'BSNETMAP'
+NETWORK_FILE_VERSION = 1
+# the parameters start at a multiple of this, so they can be memory-mapped
+NETWORK_FILE_ALIGNMENT = 4096
+# magic, version, alignment and size of the JSON header
+_NETWORK_FILE_PREFIX = struct.Struct(str('<8sIIQ'))
+
+
+def _write_network_file(filename, description, parameters, comment=''):
+    dtype = parameters.dtype.newbyteorder('<')
+    header = json.dumps({
+        'info': get_brainstorm_info().decode(),
+        'comment': comment,
+        'description': description,
+        'dtype': dtype.str,
+        'size': int(parameters.size)
+    }).encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(_NETWORK_FILE_PREFIX.pack(
+            NETWORK_FILE_MAGIC, NETWORK_FILE_VERSION, NETWORK_FILE_ALIGNMENT,
+            len(header)))
+        f.write(header)
+        offset = _get_network_file_offset(len(header), NETWORK_FILE_ALIGNMENT)
+        f.write(b'\0' * (offset - f.tell()))
+        parameters.astype(dtype, copy=False).tofile(f)
+
+
+def _read_network_file(filename, mmap_mode='c'):
+    """Read the header of a network file and memory-map its parameters."""
+    with open(filename, 'rb') as f:
+        prefix = f.read(_NETWORK_FILE_PREFIX.size)
+        if len(prefix) < _NETWORK_FILE_PREFIX.size or \
+                not prefix.startswith(NETWORK_FILE_MAGIC):
+            raise IOError('{} is not a brainstorm network file.'
+                          .format(filename))
+        _, version, alignment, header_size = _NETWORK_FILE_PREFIX.unpack(
+            prefix)
+        if version > NETWORK_FILE_VERSION:
+            raise IOError('{} has the format version {}, but only versions up '
+                          'to {} are supported.'.format(
+                              filename, version, NETWORK_FILE_VERSION))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+
+    if header['size'] == 0:  # numpy can't map empty arrays
+        return header, np.zeros(0, dtype=header['dtype'])
+    parameters = np.memmap(
+        filename, dtype=header['dtype'], mode=mmap_mode,
+        offset=_get_network_file_offset(header_size, alignment),
+        shape=(header['size'],))
+    return header, parameters
+
+
+def _get_network_file_offset(header_size, alignment):
+    start = _NETWORK_FILE_PREFIX.size + header_size
+    return (start + alignment - 1) // alignment * alignment
+
+
+def _can_operate_on(handler, memory):
+    """Check if the handler can use the numpy array as memory directly."""
+    dtype = getattr(handler, 'dtype', None)
+    return handler.array_type is np.ndarray and dtype is not None and \
+        np.dtype(dtype) == memory.dtype
+
+
+def _get_layer_dependencies(layers):
+    """Determine which layers have to finish before each layer can run its
+    forward and its backward pass.
+
+    In the forward pass a layer needs the outputs of all the layers it is
+    connected to. In the backward pass it needs the deltas from all layers
+    it is connected to, and layers connected to the same layer have to
+    take turns, since they all add to the same deltas.
+
+    Returns:
+        tuple[dict[str, set[str]]]:
+            The dependencies for the forward and for the backward pass.
+    """
+    names = list(layers)[1:]  # the Input layer does nothing
+    forward = {name: {c.start_layer for c in layers[name].incoming
+                      if c.start_layer in names} for name in names}
+    backward = {name: {c.end_layer for c in layers[name].outgoing}
+                for name in names}
+    for name in list(layers):
+        # serialize the layers that add to the deltas of this one in the
+        # order of the sequential backward pass
+        consumers = sorted({c.end_layer for c in layers[name].outgoing},
+                           key=names.index, reverse=True)
+        for earlier, later in zip(consumers, consumers[1:]):
+            backward[later].add(earlier)
+    return forward, backward
+
+
+def _get_gradient_needs(layers, frozen_parameters=None):
+    """Determine which deltas the gradients of the trainable parameters
+    depend on.
+
+    A layer has to run its backward pass only if it has parameters that are
+    not frozen or receives inputs from such a layer (directly or further
+    upstream). The deltas of an input are needed only if the layer that
+    produces it runs its backward pass.
+
+    Args:
+        layers (OrderedDict[str, Layer]):
+            The layers of the network in the order of the forward pass.
+        frozen_parameters (Optional[dict[str, list[str]]]):
+            The names of the frozen parameters of each layer.
+
+    Returns:
+        tuple:
+            The names of the layers that need a backward pass in the order
+            of the forward pass, and a dict that maps the names of layers to
+            the set of their inputs whose deltas are not needed.
+    """
+    frozen_parameters = frozen_parameters or {}
+    needs_backward = {}
+    for name, layer in layers.items():
+        trainable = set(layer.parameter_shapes) - set(
+            frozen_parameters.get(name, ()))
+        needs_backward[name] = bool(trainable) or any(
+            needs_backward[c.start_layer] for c in layer.incoming)
+    names = tuple(n for n in list(layers)[1:] if needs_backward[n])
+    unused_deltas = {n: frozenset(c.input_name for c in layers[n].incoming
+                                  if not needs_backward[c.start_layer])
+                     for n in names}
+    return names, unused_deltas
+
+
+def _get_trainable_slices(layout, frozen_parameters):
+    """Determine the slices of the parameter buffer that are not frozen.
+
+    Adjacent trainable parameters are merged into one slice.
+    """
+    offset = layout['parameters']['@slice'][0]
+    trainable = []
+    for layer_name, layer_layout in layout.items():
+        if layer_name in ('parameters', 'gradients') or \
+                layer_name.startswith('@'):
+            continue
+        frozen = frozen_parameters.get(layer_name, ())
+        for view_name, entry in layer_layout.get('parameters', {}).items():
+            if not view_name.startswith('@') and view_name not in frozen:
+                trainable.append(entry['@slice'])
+
+    slices = []
+    for start, stop in sorted(trainable):
+        if slices and slices[-1][1] == start:
+            slices[-1][1] = stop
+        else:
+            slices.append([start, stop])
+    return [slice(start - offset, stop - offset) for start, stop in slices]
+
+
 def _get_loss_layers(layers):
     return [name for name, l in layers.items() if isinstance(l, LossLayerImpl)]
 
@@ -42,6 +42,35 @@ def approx_fprime(x0, f, epsilon, *args):
     return grad
 
 
+def record_allocations(func, *args, **kwargs):
+    """
+    Records the memory allocated by a call to `func` using tracemalloc.
+
+    Args:
+        func (callable):
+            The function to be called with `args` and `kwargs`.
+    Returns:
+        tuple[int]:
+            The number of memory blocks and the number of bytes that were
+            still allocated after the call, and the peak number of bytes
+            allocated during the call (including temporaries).
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        start_size = tracemalloc.get_traced_memory()[0]
+        func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] - start_size
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    count = sum(max(st.count_diff, 0) for st in stats)
+    size = sum(max(st.size_diff, 0) for st in stats)
+    return count, size, peak
+
+
 def set_up_layer(layer, specs):
     layer.set_handler(HANDLER)
     time_steps = specs.get('time_steps', 3)
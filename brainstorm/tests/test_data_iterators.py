@@ -101,6 +101,16 @@ def test_crop_images_operation():
     assert np.allclose(out[:, 1, ...], a[:, 1, 1:4, 2:5, :])
 
 
+def test_crop_images_operation_multithreaded():
+    a = np.random.RandomState(42).randn(3, 6, 5, 5, 4)
+    rows, cols = np.array([0, 1, 2, 0, 1, 2]), np.array([2, 1, 0, 0, 1, 2])
+    expected = np.zeros((3, 6, 3, 3, 4))
+    out = np.zeros((3, 6, 3, 3, 4))
+    _crop_images(a, 3, 3, rows, cols, expected)
+    _crop_images(a, 3, 3, rows, cols, out, num_threads=3)
+    assert np.allclose(out, expected)
+
+
 # ######################## Common Validation Tests ###########################
 
 def test_non5d_data_raises():
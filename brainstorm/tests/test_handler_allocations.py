@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Regression tests that make sure the NumpyHandler operations write directly
+into their outputs instead of allocating temporaries of the operand size.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import numpy as np
+import pytest
+
+from brainstorm.handlers import NumpyHandler, numpy_handler
+from brainstorm.tests.helpers import record_allocations
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+_h = NumpyHandler(np.float64)
+rows, cols = 1000, 300
+nbytes = rows * cols * 8
+# allow for small bookkeeping objects, per-row temporaries and the fixed
+# size (64 KB) buffers of the numpy iterator
+max_peak = nbytes // 20
+
+
+def mat():
+    return np.random.rand(rows, cols)
+
+
+def row():
+    return np.random.rand(1, cols)
+
+
+def cond():
+    return (np.random.rand(rows, cols) > 0.5) * 1.
+
+
+def index_v():
+    return np.random.randint(0, cols, size=(rows, 1)) * 1.
+
+
+operations = {
+    'abs_t': lambda: (mat(), mat()),
+    'add_into_if': lambda: (mat(), mat(), cond()),
+    'add_mv': lambda: (mat(), row(), mat()),
+    'add_st': lambda: (1.5, mat(), mat()),
+    'add_tt': lambda: (mat(), mat(), mat()),
+    'binarize_v': lambda: (index_v(), mat()),
+    'broadcast_t': lambda: (row(), 0, mat()),
+    'clip_t': lambda: (mat(), 0.2, 0.8, mat()),
+    'copy_to': lambda: (mat(), mat()),
+    'copy_to_if': lambda: (mat(), mat(), cond()),
+    'divide_mv': lambda: (mat(), row() + 1, mat()),
+    'divide_tt': lambda: (mat(), mat() + 1, mat()),
+    'dot_add_mm': lambda: (mat(), np.random.rand(cols, cols), mat()),
+    'dot_mm': lambda: (mat(), np.random.rand(cols, cols), mat()),
+    'fill': lambda: (mat(), 0.5),
+    'fill_if': lambda: (mat(), 0.5, cond()),
+    'index_m_by_v': lambda: (mat(), index_v(), np.zeros((rows, 1))),
+    'log_t': lambda: (mat() + 1, mat()),
+    'merge_tt': lambda: (mat(), mat(), np.zeros((rows, 2 * cols))),
+    'modulo_tt': lambda: (mat(), mat() + 1, mat()),
+    'mult_add_mv': lambda: (mat(), row(), mat()),
+    'mult_add_st': lambda: (1.5, mat(), mat()),
+    'mult_add_tt': lambda: (mat(), mat(), mat()),
+    'mult_mv': lambda: (mat(), row(), mat()),
+    'mult_st': lambda: (1.5, mat(), mat()),
+    'mult_tt': lambda: (mat(), mat(), mat()),
+    'sign_t': lambda: (mat() - 0.5, mat()),
+    'split_add_tt': lambda: (np.random.rand(rows, 2 * cols), mat(), mat()),
+    'sqrt_t': lambda: (mat(), mat()),
+    'subtract_mv': lambda: (mat(), row(), mat()),
+    'subtract_tt': lambda: (mat(), mat(), mat()),
+    'sum_t': lambda: (mat(), 0, np.zeros((1, cols))),
+    'rel': lambda: (mat() - 0.5, mat()),
+    'rel_deriv': lambda: (mat(), mat() - 0.5, mat(), mat()),
+    'sigmoid': lambda: (mat() - 0.5, mat()),
+    'sigmoid_deriv': lambda: (mat(), mat(), mat(), mat()),
+    'softmax_m': lambda: (mat(), mat()),
+    'tanh': lambda: (mat(), mat()),
+    'tanh_deriv': lambda: (mat(), mat(), mat(), mat()),
+}
+
+
+@pytest.mark.parametrize('op_name', sorted(operations))
+def test_operation_does_not_allocate_temporaries(op_name):
+    args = operations[op_name]()
+    op = getattr(_h, op_name)
+    op(*args)  # warm up
+    count, size, peak = record_allocations(op, *args)
+    assert peak < max_peak, \
+        "{} allocated {} bytes for outputs of {} bytes".format(op_name, peak,
+                                                               nbytes)
+    assert size < max_peak, \
+        "{} leaked {} bytes in {} blocks".format(op_name, size, count)
+
+
+@pytest.mark.parametrize('op_name', ['add_tt', 'mult_add_tt', 'sigmoid',
+                                     'sigmoid_deriv'])
+def test_operation_does_not_allocate_temporaries_inplace(op_name):
+    args = operations[op_name]()
+    x = args[0]
+    # use the first argument as the output as well
+    args = (x,) + args[1:-1] + (x,)
+    op = getattr(_h, op_name)
+    op(*args)
+    count, size, peak = record_allocations(op, *args)
+    assert peak < max_peak
+
+
+@pytest.mark.skipif(numpy_handler._blas is None,
+                    reason='NumpyHandler was built without BLAS bindings')
+@pytest.mark.parametrize('op_name', ['dot_add_mm', 'dot_mm'])
+@pytest.mark.parametrize('transa', [False, True])
+@pytest.mark.parametrize('transb', [False, True])
+def test_gemm_into_strided_output_does_not_allocate(op_name, transa, transb):
+    a = np.random.rand(cols, rows) if transa else mat()
+    b = np.random.rand(cols, cols)
+    b = b.T if transb else b
+    hub = np.zeros((rows, cols + 10))
+    out = hub[:, 5:5 + cols]
+    op = getattr(_h, op_name)
+    op(a, b, out, transa=transa, transb=transb)
+    count, size, peak = record_allocations(op, a, b, out, transa=transa,
+                                           transb=transb)
+    assert peak < max_peak
+
+
+def test_conv2d_into_strided_output_does_not_allocate():
+    inputs = np.random.rand(20, 32, 32, 3)
+    weights = np.random.rand(8, 3, 3, 3)
+    bias = np.random.rand(8)
+    hub = np.zeros((20, 30, 32, 8))
+    outputs = hub[:, :, 1:31]
+    args = (inputs, weights, bias, outputs, 0, (1, 1))
+    _h.conv2d_forward_batch(*args)  # warm up the workspace
+    count, size, peak = record_allocations(_h.conv2d_forward_batch, *args)
+    assert peak < outputs.nbytes // 4
+
+
+_mixed = NumpyHandler(np.float32, activation_dtype=np.float16)
+
+
+def activations(shape):
+    out = _mixed.allocate_activations(shape)
+    out[:] = np.random.rand(*shape)
+    return out
+
+
+mixed_operations = {
+    'dot_add_mm': lambda: (activations((rows, cols)),
+                           np.random.rand(cols, cols).astype(np.float32),
+                           activations((rows, cols))),
+    'dot_mm': lambda: (activations((rows, cols)),
+                       np.random.rand(cols, cols).astype(np.float32),
+                       activations((rows, cols))),
+    'lstm_forward_step': lambda: (
+        activations((rows, 4 * cols)), activations((rows, 4 * cols)),
+        np.random.rand(3, cols).astype(np.float32),
+        activations((rows, cols)), activations((rows, cols)),
+        activations((rows, cols)), activations((rows, cols)), 'tanh'),
+}
+
+
+@pytest.mark.parametrize('op_name', sorted(mixed_operations))
+def test_mixed_precision_operation_does_not_allocate_temporaries(op_name):
+    args = mixed_operations[op_name]()
+    op = getattr(_mixed, op_name)
+    op(*args)  # warm up the staging buffers
+    count, size, peak = record_allocations(op, *args)
+    assert peak < max_peak, \
+        "{} allocated {} bytes for float16 outputs of {} bytes".format(
+            op_name, peak, nbytes // 4)
+    assert size < max_peak
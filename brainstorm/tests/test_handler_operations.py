@@ -7,6 +7,8 @@ import numpy as np
 import pytest
 
 from brainstorm.handlers import NumpyHandler
+from brainstorm.handlers.autotuner import Autotuner
+from brainstorm.handlers.base_handler import Handler
 from brainstorm.optional import has_pycuda
 
 # np.random.seed(1234)
@@ -75,10 +77,10 @@ def test_conv2d_forward_batch_numpy():
 
                                 output_height = \
                                     (input_shape[0] + 2 * padding -
-                                     kernel_shape[0]) / stride[0] + 1
+                                     kernel_shape[0]) // stride[0] + 1
                                 output_width = \
                                     (input_shape[1] + 2 * padding -
-                                     kernel_shape[1]) / stride[1] + 1
+                                     kernel_shape[1]) // stride[1] + 1
 
                                 outputs = np.zeros((nr_images,
                                                     output_height,
@@ -132,10 +134,10 @@ def test_conv2d_forward_batch_pycuda():
 
                                 output_height = \
                                     (input_shape[0] + 2 * padding -
-                                     kernel_shape[0]) / stride[0] + 1
+                                     kernel_shape[0]) // stride[0] + 1
                                 output_width = \
                                     (input_shape[1] + 2 * padding -
-                                     kernel_shape[1]) / stride[1] + 1
+                                     kernel_shape[1]) // stride[1] + 1
 
                                 outputs = np.zeros((nr_images,
                                                     output_height,
@@ -167,3 +169,412 @@ def test_conv2d_forward_batch_pycuda():
                                     print("Expected:\n", true_outputs)
                                     print("Obtained:\n", outputs)
                                 assert passed
+
+
+@pytest.mark.parametrize("num_threads", [2, 4])
+def test_conv2d_multithreaded_matches_serial(num_threads):
+    rnd = np.random.RandomState(42)
+    serial = NumpyHandler(dtype=dtype)
+    parallel = NumpyHandler(dtype=dtype, num_threads=num_threads)
+    for padding, stride in [(0, (1, 1)), (1, (2, 1)), (2, (2, 2))]:
+        inputs = rnd.rand(5, 7, 6, 3).astype(dtype)
+        weights = rnd.rand(4, 3, 2, 3).astype(dtype)
+        bias = rnd.rand(4).astype(dtype)
+        out_h = (7 + 2 * padding - 3) // stride[0] + 1
+        out_w = (6 + 2 * padding - 2) // stride[1] + 1
+        out_deltas = rnd.rand(5, out_h, out_w, 4).astype(dtype)
+
+        results = []
+        for _h in (serial, parallel):
+            outputs = np.zeros((5, out_h, out_w, 4), dtype=dtype)
+            in_deltas = np.zeros_like(inputs)
+            dweights = np.zeros_like(weights)
+            dbias = np.zeros_like(bias)
+            _h.conv2d_forward_batch(inputs, weights, bias, outputs,
+                                    padding, stride)
+            _h.conv2d_backward_batch(inputs, weights, padding, stride,
+                                     in_deltas, out_deltas, dweights, dbias)
+            results.append((outputs, in_deltas, dweights, dbias))
+
+        for expected, obtained in zip(*results):
+            assert np.allclose(expected, obtained)
+
+
+@pytest.mark.parametrize("num_threads", [2, 4])
+def test_pooling_multithreaded_matches_serial(num_threads):
+    rnd = np.random.RandomState(42)
+    serial = NumpyHandler(dtype=dtype)
+    parallel = NumpyHandler(dtype=dtype, num_threads=num_threads)
+    inputs = rnd.rand(5, 6, 7, 3).astype(dtype)
+    out_deltas = rnd.rand(5, 3, 4, 3).astype(dtype)
+
+    results = []
+    for _h in (serial, parallel):
+        outputs = np.zeros((5, 3, 4, 3), dtype=dtype)
+        argmax = np.zeros_like(outputs)
+        in_deltas = np.zeros_like(inputs)
+        _h.maxpool2d_forward_batch(inputs, (2, 2), outputs, 1, (2, 2), argmax)
+        _h.maxpool2d_backward_batch(inputs, (2, 2), outputs, 1, (2, 2),
+                                    argmax, in_deltas, out_deltas)
+        avg_outputs = np.zeros_like(outputs)
+        avg_in_deltas = np.zeros_like(inputs)
+        _h.avgpool2d_forward_batch(inputs, (2, 2), avg_outputs, 1, (2, 2))
+        _h.avgpool2d_backward_batch(inputs, (2, 2), avg_outputs, 1, (2, 2),
+                                    avg_in_deltas, out_deltas)
+        results.append((outputs, argmax, in_deltas, avg_outputs,
+                        avg_in_deltas))
+
+    for expected, obtained in zip(*results):
+        assert np.allclose(expected, obtained)
+
+
+@pytest.mark.parametrize("conv_chunk_size", [1, 2, 3, None])
+def test_conv2d_chunked_matches_reference(conv_chunk_size):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=dtype, conv_chunk_size=conv_chunk_size)
+    inputs = rnd.rand(5, 7, 6, 3).astype(dtype)
+    weights = rnd.rand(4, 3, 2, 3).astype(dtype)
+    bias = rnd.rand(4).astype(dtype)
+    outputs = np.zeros((5, 7, 7, 4), dtype=dtype)
+    true_outputs = np.zeros_like(outputs)
+    _conv2d_forward_batch(inputs, weights, bias, true_outputs, 1, (1, 1))
+    _h.conv2d_forward_batch(inputs, weights, bias, outputs, 1, (1, 1))
+    assert np.allclose(outputs, true_outputs)
+
+    out_deltas = rnd.rand(5, 7, 7, 4).astype(dtype)
+    ref = NumpyHandler(dtype=dtype, conv_chunk_size=1)
+    results = []
+    for handler in (ref, _h):
+        in_deltas = np.zeros_like(inputs)
+        dweights = np.zeros_like(weights)
+        dbias = np.zeros_like(bias)
+        handler.conv2d_backward_batch(inputs, weights, 1, (1, 1), in_deltas,
+                                      out_deltas, dweights, dbias)
+        results.append((in_deltas, dweights, dbias))
+    for expected, obtained in zip(*results):
+        assert np.allclose(expected, obtained)
+
+
+@pytest.mark.parametrize("algorithm, kernel_size, padding, stride", [
+    ('winograd', (3, 3), 0, (1, 1)),
+    ('winograd', (3, 3), 1, (1, 1)),
+    ('winograd', (3, 3), 2, (1, 1)),
+    ('fft', (3, 3), 1, (1, 1)),
+    ('fft', (5, 4), 2, (2, 2)),
+    ('fft', (2, 3), 0, (3, 2)),
+])
+def test_conv2d_algorithms_match_im2col(algorithm, kernel_size, padding,
+                                        stride):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=np.float64)
+    inputs = rnd.randn(3, 7, 8, 2)
+    weights = rnd.randn(4, kernel_size[0], kernel_size[1], 2)
+    bias = rnd.randn(4)
+    out_h = (7 + 2 * padding - kernel_size[0]) // stride[0] + 1
+    out_w = (8 + 2 * padding - kernel_size[1]) // stride[1] + 1
+    out_deltas = rnd.randn(3, out_h, out_w, 4)
+
+    results = []
+    for alg in ('im2col', algorithm):
+        outputs = np.zeros((3, out_h, out_w, 4))
+        in_deltas = np.ones_like(inputs)
+        dweights = np.zeros_like(weights)
+        dbias = np.zeros_like(bias)
+        _h.conv2d_forward_batch(inputs, weights, bias, outputs, padding,
+                                stride, algorithm=alg)
+        _h.conv2d_backward_batch(inputs, weights, padding, stride, in_deltas,
+                                 out_deltas, dweights, dbias, algorithm=alg)
+        results.append((outputs, in_deltas, dweights, dbias))
+
+    for expected, obtained in zip(*results):
+        assert np.allclose(expected, obtained)
+
+
+@pytest.mark.parametrize("algorithm", ['im2col', 'winograd', 'fft'])
+@pytest.mark.parametrize("skipped", [0, 1, 2])
+def test_conv2d_backward_skips_deltas_passed_as_none(algorithm, skipped):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=np.float64)
+    inputs = rnd.randn(3, 7, 8, 2)
+    weights = rnd.randn(4, 3, 3, 2)
+    out_deltas = rnd.randn(3, 7, 8, 4)
+
+    results = []
+    for skip in (None, skipped):
+        deltas = [np.zeros_like(inputs), np.zeros_like(weights),
+                  np.zeros(4)]
+        args = [None if i == skip else d for i, d in enumerate(deltas)]
+        _h.conv2d_backward_batch(inputs, weights, 1, (1, 1), args[0],
+                                 out_deltas, args[1], args[2],
+                                 algorithm=algorithm)
+        results.append(deltas)
+
+    for i, (expected, obtained) in enumerate(zip(*results)):
+        if i == skipped:
+            assert not np.any(obtained)
+        else:
+            assert np.allclose(expected, obtained)
+
+
+def test_conv2d_winograd_rejects_other_kernels():
+    _h = NumpyHandler(dtype=dtype)
+    inputs = np.zeros((1, 5, 5, 1), dtype=dtype)
+    weights = np.zeros((1, 2, 2, 1), dtype=dtype)
+    outputs = np.zeros((1, 4, 4, 1), dtype=dtype)
+    with pytest.raises(ValueError):
+        _h.conv2d_forward_batch(inputs, weights, np.zeros(1, dtype=dtype),
+                                outputs, 0, (1, 1), algorithm='winograd')
+
+
+def test_conv2d_forward_batch_into_strided_outputs():
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=dtype)
+    inputs = rnd.rand(3, 4, 4, 2).astype(dtype)
+    weights = rnd.rand(5, 3, 3, 2).astype(dtype)
+    bias = rnd.rand(5).astype(dtype)
+    hub = np.zeros((3, 4 * 4 * 5 + 7), dtype=dtype)
+    outputs = hub[:, :4 * 4 * 5].reshape((3, 4, 4, 5))
+    true_outputs = np.zeros((3, 4, 4, 5), dtype=dtype)
+    _conv2d_forward_batch(inputs, weights, bias, true_outputs, 1, (1, 1))
+    _h.conv2d_forward_batch(inputs, weights, bias, outputs, 1, (1, 1))
+    assert np.allclose(outputs, true_outputs)
+    assert np.all(hub[:, 4 * 4 * 5:] == 0)
+
+
+def test_scratch_memory_is_reused_after_release():
+    _h = NumpyHandler(dtype=dtype)
+    a = _h.allocate_scratch((3, 4))
+    b = _h.allocate_scratch((3, 4))
+    assert a is not b
+    assert a.shape == (3, 4) and a.dtype == dtype
+    _h.release_scratch()
+    c = _h.allocate_scratch((3, 4))
+    d = _h.allocate_scratch((3, 4))
+    assert {id(c), id(d)} == {id(a), id(b)}
+    e = _h.allocate_scratch((4, 3))
+    assert e is not a and e is not b
+
+
+def test_scratch_pool_evicts_least_recently_used_shapes():
+    _h = NumpyHandler(dtype=dtype)
+    _h.max_scratch_size = 20
+    a = _h.allocate_scratch((2, 5))
+    _h.release_scratch()
+    b = _h.allocate_scratch((3, 3))
+    _h.release_scratch()
+    c = _h.allocate_scratch((2, 2))
+    _h.release_scratch()
+    assert _h._scratch_free_size <= 20
+    assert _h.allocate_scratch((2, 5)) is not a
+    assert _h.allocate_scratch((3, 3)) is b
+    assert _h.allocate_scratch((2, 2)) is c
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+_lstm_act = {'linear': (lambda x: x, lambda y: np.ones_like(y)),
+             'sigmoid': (_sigmoid, lambda y: y * (1 - y)),
+             'tanh': (np.tanh, lambda y: 1 - y * y),
+             'rel': (lambda x: x * (x > 0), lambda y: (y > 0) * 1.)}
+
+
+@pytest.mark.parametrize('activation', ['linear', 'sigmoid', 'tanh', 'rel'])
+def test_lstm_steps_against_reference(activation):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=np.float64)
+    act, act_deriv = _lstm_act[activation]
+    batch_size, n = 3, 4
+    gates = rnd.randn(batch_size, 4 * n)
+    peepholes = rnd.randn(3, n)
+    cell_prev = rnd.randn(batch_size, n)
+
+    # forward pass
+    ga = gates.copy()
+    ga[:, n:2 * n] += peepholes[0] * cell_prev
+    ga[:, 2 * n:3 * n] += peepholes[1] * cell_prev
+    z, i, f = act(ga[:, :n]), _sigmoid(ga[:, n:2 * n]), \
+        _sigmoid(ga[:, 2 * n:3 * n])
+    cell = i * z + f * cell_prev
+    ga[:, 3 * n:] += peepholes[2] * cell
+    o = _sigmoid(ga[:, 3 * n:])
+    act_cell = act(cell)
+    act_gates = np.hstack([z, i, f, o])
+
+    outs = [np.zeros((batch_size, 4 * n)), np.zeros((batch_size, n)),
+            np.zeros((batch_size, n)), np.zeros((batch_size, n))]
+    _h.lstm_forward_step(gates, outs[0], peepholes, cell_prev, outs[1],
+                         outs[2], outs[3], activation)
+    assert np.allclose(gates, ga)
+    assert np.allclose(outs[0], act_gates)
+    assert np.allclose(outs[1], cell)
+    assert np.allclose(outs[2], act_cell)
+    assert np.allclose(outs[3], o * act_cell)
+
+    # backward pass
+    dy = rnd.randn(batch_size, n)
+    next_gate_deltas = rnd.randn(batch_size, 4 * n)
+    next_act_gates = rnd.rand(batch_size, 4 * n)
+    next_cell_deltas = rnd.randn(batch_size, n)
+    do = dy * act_cell * o * (1 - o)
+    dc = (dy * o * act_deriv(act_cell) +
+          next_cell_deltas * next_act_gates[:, 2 * n:3 * n] +
+          next_gate_deltas[:, n:2 * n] * peepholes[0] +
+          next_gate_deltas[:, 2 * n:3 * n] * peepholes[1] +
+          do * peepholes[2])
+    expected = np.hstack([dc * i * act_deriv(z), dc * z * i * (1 - i),
+                          dc * cell_prev * f * (1 - f), do])
+    gate_deltas = np.zeros((batch_size, 4 * n))
+    cell_deltas = np.zeros((batch_size, n))
+    _h.lstm_backward_step(act_gates, peepholes, cell_prev, act_cell, dy,
+                          next_gate_deltas, next_act_gates, next_cell_deltas,
+                          gate_deltas, cell_deltas, activation)
+    assert np.allclose(cell_deltas, dc)
+    assert np.allclose(gate_deltas, expected)
+
+
+@pytest.mark.parametrize('transa', [False, True])
+@pytest.mark.parametrize('transb', [False, True])
+def test_dot_mm_and_dot_add_mm_with_strided_views(transa, transb):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(dtype=np.float64)
+    hub = rnd.randn(6, 20)
+    a = hub[:4, 0:6] if transa else hub[:, 0:4]
+    b = hub[:3, 6:10] if transb else hub[:4, 6:9]
+    out = hub[:, 12:15]
+    x = a.T if transa else a
+    y = b.T if transb else b
+    rest = hub[:, 15:].copy()
+
+    expected = out + np.dot(x, y)
+    _h.dot_add_mm(a, b, out, transa=transa, transb=transb)
+    assert np.allclose(out, expected)
+
+    expected = np.dot(x, y)
+    _h.dot_mm(a, b, out, transa=transa, transb=transb)
+    assert np.allclose(out, expected)
+    assert np.all(hub[:, 15:] == rest)
+
+
+@pytest.mark.parametrize("num_threads", [1, 3])
+def test_fused_losses_match_default_implementations(num_threads):
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(np.float64, num_threads=num_threads)
+    rows, classes = 20, 5
+    # strided views like in the layers
+    m = rnd.randn(rows, 2 * classes)[:, ::2]
+    indices = rnd.randint(0, classes, size=(rows, 1)).astype(np.float64)
+    y = rnd.uniform(0, 1, size=(rows, classes))
+    y[0, 0], y[1, 1] = 0.0, 1.0  # test clipping
+    t = rnd.randint(0, 2, size=(rows, classes)).astype(np.float64)
+    loss_deltas = rnd.randn(rows, 1)
+    in_deltas = rnd.randn(rows, classes)
+
+    def check(name, args, out_indices):
+        expected = [a.copy() for a in args]
+        getattr(Handler, name)(_h, *expected)
+        getattr(_h, name)(*args)
+        for i in out_indices:
+            assert np.allclose(args[i], expected[i]), name
+
+    check('softmax_ce_forward', [m, indices, np.zeros((rows, classes)),
+                                 np.zeros((rows, 1))], [2, 3])
+    probabilities = np.zeros((rows, classes))
+    _h.softmax_m(m, probabilities)
+    check('softmax_ce_backward', [probabilities, indices, loss_deltas,
+                                  in_deltas.copy()], [3])
+    check('binomial_ce_forward', [y, t, np.zeros((rows, 1))], [2])
+    check('binomial_ce_backward', [y, t, loss_deltas, in_deltas.copy()], [3])
+    check('sigmoid_ce_backward', [y, t, loss_deltas, in_deltas.copy()], [3])
+
+    out = np.zeros((rows, 1))
+    _h.index_m_by_v(m, indices, out)
+    assert np.all(out[:, 0] == m[np.arange(rows), indices[:, 0].astype(int)])
+    out = np.ones((rows, classes))
+    _h.binarize_v(indices, out)
+    assert np.all(out == (np.arange(classes) == indices))
+
+
+def test_fused_softmax_ce_with_float16_probabilities():
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(np.float32, activation_dtype=np.float16)
+    m = rnd.randn(10, 4).astype(np.float16)
+    indices = rnd.randint(0, 4, size=(10, 1)).astype(np.float32)
+    probabilities = np.zeros((10, 4), dtype=np.float16)
+    loss = np.zeros((10, 1), dtype=np.float16)
+    _h.softmax_ce_forward(m, indices, probabilities, loss)
+
+    expected = np.exp(m.astype(np.float64))
+    expected /= expected.sum(axis=1, keepdims=True)
+    assert np.allclose(probabilities, expected, atol=1e-3)
+    assert np.allclose(
+        loss[:, 0], -np.log(expected[np.arange(10), indices[:, 0].astype(int)]),
+        atol=1e-2)
+
+
+def test_fused_lstm_forward_step_with_float16_activations():
+    rnd = np.random.RandomState(42)
+    _h = NumpyHandler(np.float32, activation_dtype=np.float16)
+    gates, act_gates = [rnd.randn(3, 8).astype(np.float16) for _ in range(2)]
+    cell_prev, cell, act_cell, out = [rnd.randn(3, 2).astype(np.float16)
+                                      for _ in range(4)]
+    peepholes = rnd.randn(3, 2).astype(np.float32)
+    args = [gates, act_gates, peepholes, cell_prev, cell, act_cell, out]
+    expected = [a.astype(np.float32) for a in args]
+    NumpyHandler(np.float32).lstm_forward_step(*(expected + ['tanh']))
+    _h.lstm_forward_step(*(args + ['tanh']))
+    # all outputs are written back, including the peepholes added to gates
+    for a, e in zip(args, expected):
+        assert np.allclose(a, e, atol=1e-2)
+
+
+def test_autotuned_conv2d_and_pooling_match_defaults(tmpdir):
+    rnd = np.random.RandomState(42)
+    filename = str(tmpdir.join('autotune.json'))
+    tuned = NumpyHandler(dtype=dtype, autotuner=Autotuner(filename))
+    plain = NumpyHandler(dtype=dtype)
+    inputs = rnd.rand(4, 6, 6, 2).astype(dtype)
+    weights = rnd.rand(3, 3, 3, 2).astype(dtype)
+    bias = rnd.rand(3).astype(dtype)
+    out_deltas = rnd.rand(4, 6, 6, 3).astype(dtype)
+
+    results = []
+    for _h in (plain, tuned):
+        outputs = np.zeros((4, 6, 6, 3), dtype=dtype)
+        in_deltas = np.zeros_like(inputs)
+        dweights = np.zeros_like(weights)
+        dbias = np.zeros_like(bias)
+        _h.conv2d_forward_batch(inputs, weights, bias, outputs, 1, (1, 1),
+                                algorithm='auto')
+        _h.conv2d_backward_batch(inputs, weights, 1, (1, 1), in_deltas,
+                                 out_deltas, dweights, dbias,
+                                 algorithm='auto')
+        pooled = np.zeros((4, 3, 3, 2), dtype=dtype)
+        argmax = np.zeros_like(pooled)
+        _h.maxpool2d_forward_batch(inputs, (2, 2), pooled, 0, (2, 2), argmax)
+        results.append((outputs, in_deltas, dweights, dbias, pooled))
+
+    for expected, obtained in zip(*results):
+        assert np.allclose(expected, obtained, atol=1e-5)
+    assert len(tuned.autotuner.choices) == 2
+
+
+def test_autotuner_reuses_cached_choices(tmpdir):
+    filename = str(tmpdir.join('autotune.json'))
+    candidates = [{'n': 1}, {'n': 2}]
+    tuner = Autotuner(filename, repetitions=1)
+    assert tuner.choose('op', candidates, lambda n: None) in candidates
+
+    def fail(n):
+        raise AssertionError('cached choices must not be benchmarked')
+
+    assert tuner.choose('op', candidates, fail) == tuner.choices['op']
+    assert Autotuner(filename).choose('op', candidates, fail) == \
+        tuner.choices['op']
+    # choices are stored per host
+    assert Autotuner(filename).host == tuner.host
+    other_host = Autotuner(filename)
+    other_host.host, other_host.choices = 'elsewhere', {}
+    with pytest.raises(AssertionError):
+        other_host.choose('op', candidates, fail)
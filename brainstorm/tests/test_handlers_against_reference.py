@@ -668,3 +668,33 @@ def test_split_add_tt(handler):
         x = np.random.randn(*sx).astype(ref_dtype)
         ref_args = (x, a, b)
         assert operation_check(handler, 'split_add_tt', ref_args)
+
+
+@pytest.mark.parametrize("handler", non_default_handlers, ids=handler_ids)
+def test_lstm_forward_step(handler):
+    for activation in ['linear', 'sigmoid', 'tanh', 'rel']:
+        for batch_size, n in [(1, 1), (3, 4), (5, 9)]:
+            gates, act_gates = get_random_arrays([(batch_size, 4 * n)] * 2)
+            peepholes, = get_random_arrays([(3, n)])
+            cell_prev, cell, act_cell, out = get_random_arrays(
+                [(batch_size, n)] * 4)
+            ref_args = (gates, act_gates, peepholes, cell_prev, cell,
+                        act_cell, out, activation)
+            assert operation_check(handler, 'lstm_forward_step', ref_args,
+                                   atol=1e-6)
+
+
+@pytest.mark.parametrize("handler", non_default_handlers, ids=handler_ids)
+def test_lstm_backward_step(handler):
+    for activation in ['linear', 'sigmoid', 'tanh', 'rel']:
+        for batch_size, n in [(1, 1), (3, 4), (5, 9)]:
+            act_gates, next_gate_deltas, next_act_gates, gate_deltas = \
+                get_random_arrays([(batch_size, 4 * n)] * 4)
+            peepholes, = get_random_arrays([(3, n)])
+            cell_prev, act_cell, out_deltas, next_cell_deltas, cell_deltas = \
+                get_random_arrays([(batch_size, n)] * 5)
+            ref_args = (act_gates, peepholes, cell_prev, act_cell, out_deltas,
+                        next_gate_deltas, next_act_gates, next_cell_deltas,
+                        gate_deltas, cell_deltas, activation)
+            assert operation_check(handler, 'lstm_backward_step', ref_args,
+                                   atol=1e-6)
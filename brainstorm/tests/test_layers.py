@@ -158,6 +158,26 @@ def lstm_layer(spec):
     return layer, spec
 
 
+def rnn_layer_checkpointed(spec):
+    layer = RecurrentLayerImpl('RnnLayer',
+                               {'default': BufferStructure('T', 'B', 5)},
+                               NO_CON, NO_CON,
+                               size=7,
+                               activation=spec['activation'],
+                               checkpoint_interval=2)
+    return layer, spec
+
+
+def lstm_layer_checkpointed(spec):
+    layer = LstmLayerImpl('LstmLayer',
+                          {'default': BufferStructure('T', 'B', 5)},
+                          NO_CON, NO_CON,
+                          size=7,
+                          activation=spec['activation'],
+                          checkpoint_interval=2)
+    return layer, spec
+
+
 def mask_layer(spec):
     layer = MaskLayerImpl('MaskLayer',
                           {'default': BufferStructure('T', 'B', 3, 2),
@@ -167,12 +187,14 @@ def mask_layer(spec):
 
 
 def convolution_layer_2d(spec, input_shape=(4, 4, 1),
-                         num_filters=1, kernel_size=(2, 2), stride=(1, 1)):
+                         num_filters=1, kernel_size=(2, 2), stride=(1, 1),
+                         algorithm='im2col'):
     x = BufferStructure('T', 'B', *input_shape)
     layer = Convolution2DLayerImpl('Convolution2DLayer', {'default': x},
                                    NO_CON, NO_CON, num_filters=num_filters,
                                    kernel_size=kernel_size, stride=stride,
-                                   activation=spec['activation'])
+                                   activation=spec['activation'],
+                                   algorithm=algorithm)
     return layer, spec
 
 
@@ -189,6 +211,17 @@ def convolution_layer_2d_c(spec):
                                 kernel_size=(2, 3))
 
 
+def convolution_layer_2d_winograd(spec):
+    return convolution_layer_2d(spec, input_shape=(5, 4, 2), num_filters=2,
+                                kernel_size=(3, 3), algorithm='winograd')
+
+
+def convolution_layer_2d_fft(spec):
+    return convolution_layer_2d(spec, input_shape=(5, 4, 2), num_filters=2,
+                                kernel_size=(2, 3), stride=(2, 1),
+                                algorithm='fft')
+
+
 def maxpooling_layer_2d(spec):
     layer = Pooling2DLayerImpl('Pooling2DLayer',
                                {'default':
@@ -266,6 +299,28 @@ def clockwork_lstm_layer(spec):
     return layer, spec
 
 
+def clockwork_layer_checkpointed(spec):
+    layer = ClockworkLayerImpl('ClockworkRnn',
+                               {'default': BufferStructure('T', 'B', 5)},
+                               NO_CON, NO_CON,
+                               size=7,
+                               activation=spec['activation'],
+                               checkpoint_interval=2)
+    spec['inits'] = {'timing': np.array([1, 1, 2, 2, 3, 3, 5])}
+    return layer, spec
+
+
+def clockwork_lstm_layer_checkpointed(spec):
+    layer = ClockworkLstmLayerImpl('ClockworkLstm',
+                                   {'default': BufferStructure('T', 'B', 5)},
+                                   NO_CON, NO_CON,
+                                   size=7,
+                                   activation=spec['activation'],
+                                   checkpoint_interval=2)
+    spec['inits'] = {'timing': np.array([1, 1, 2, 2, 3, 3, 5])}
+    return layer, spec
+
+
 def merge(spec):
     in_shapes = {'inputs_1': BufferStructure('T', 'B', 3, 2),
                  'inputs_2': BufferStructure('T', 'B', 3, 4)}
@@ -284,12 +339,16 @@ layers_to_test = [
     softmax_ce_layer,
     sigmoid_ce_layer,
     rnn_layer,
+    rnn_layer_checkpointed,
     squared_difference_layer,
     lstm_layer,
+    lstm_layer_checkpointed,
     mask_layer,
     convolution_layer_2d_a,
     convolution_layer_2d_b,
     convolution_layer_2d_c,
+    convolution_layer_2d_winograd,
+    convolution_layer_2d_fft,
     convolution_layer_2d,
     maxpooling_layer_2d,
     avgpooling_layer_2d,
@@ -299,7 +358,9 @@ layers_to_test = [
     l1_decay_layer,
     l2_decay_layer,
     clockwork_layer,
+    clockwork_layer_checkpointed,
     clockwork_lstm_layer,
+    clockwork_lstm_layer_checkpointed,
     merge
 ]
 
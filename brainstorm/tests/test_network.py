@@ -8,9 +8,15 @@ import pytest
 
 from brainstorm import Network
 from brainstorm.data_iterators import Undivided
+from brainstorm.describable import create_from_description, get_description
+from brainstorm.handlers import DebugHandler, NumpyHandler, ProfilingHandler
 from brainstorm.initializers import Gaussian
-from brainstorm.layers import SoftmaxCE, Input, Lstm, Recurrent, FullyConnected
+from brainstorm.layers import (SoftmaxCE, Input, Lstm, Merge, Recurrent,
+                               FullyConnected, Loss, Clockwork, ClockworkLstm,
+                               Elementwise)
+from brainstorm.training.steppers import SgdStepper
 from brainstorm.training.utils import run_network
+from brainstorm.utils import NetworkValidationError
 
 from brainstorm.tests.helpers import HANDLER
 
@@ -31,6 +37,27 @@ def lstm_net():
     return net
 
 
+def build_lstm_softmax_net(mode='training', handler=None, reuse_memory=False,
+                           checkpoint_interval=0, bottom=None,
+                           layer_type=Lstm, **layer_kwargs):
+    """Input >> [bottom >>] Lstm(5) >> FullyConnected(3) >> SoftmaxCE, with
+    the recurrent layer named 'Lstm' unless another name is given."""
+    inp = Input(out_shapes={'default': ('T', 'B', 4),
+                            'targets': ('T', 'B', 1)})
+    out = SoftmaxCE(name='Output')
+    inp - 'targets' >> 'targets' - out
+    layer_kwargs.setdefault('name', 'Lstm')
+    rnn = layer_type(5, checkpoint_interval=checkpoint_interval,
+                     **layer_kwargs)
+    bottom = inp if bottom is None else inp >> bottom
+    bottom >> rnn >> FullyConnected(3, name='Hid') >> out
+    net = Network.from_layer(out - 'loss' >> Loss(), mode=mode,
+                             reuse_memory=reuse_memory)
+    net.set_handler(handler or NumpyHandler(np.float64))
+    net.initialize(Gaussian(0.1), seed=1234)
+    return net
+
+
 layers_to_test_with_context = [
     simple_recurrent_net,
     lstm_net
@@ -107,3 +134,642 @@ def test_forward_pass_with_missing_data():
 
     for _ in run_network(simple_net, it, all_inputs=False):
         pass
+
+
+def test_mixed_precision_matches_full_precision():
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(3, 2, 4),
+            'targets': rnd.randint(0, 3, size=(3, 2, 1))}
+    handler = NumpyHandler(np.float32, activation_dtype=np.float16)
+    mixed_net = build_lstm_softmax_net(handler=handler)
+    full_net = build_lstm_softmax_net(handler=NumpyHandler(np.float32))
+
+    for net in [mixed_net, full_net]:
+        net.provide_external_data(data)
+        net.forward_pass(training_pass=True)
+        net.backward_pass()
+
+    assert mixed_net.buffer.parameters.dtype == np.float32
+    assert mixed_net.buffer.gradients.dtype == np.float32
+    assert mixed_net.buffer.Lstm.outputs.default.dtype == np.float16
+    assert mixed_net.buffer.Hid.output_deltas.default.dtype == np.float16
+    # inputs might contain class indices, so they keep the full precision
+    assert mixed_net.buffer.Input.outputs.targets.dtype == np.float32
+    assert np.allclose(mixed_net.buffer.Hid.outputs.default,
+                       full_net.buffer.Hid.outputs.default, atol=1e-2)
+    assert np.allclose(mixed_net.buffer.gradients,
+                       full_net.buffer.gradients, atol=1e-2)
+    assert np.abs(full_net.buffer.gradients).max() > 0.05
+    assert handler.__describe__()['activation_dtype'] == 'float16'
+
+
+def test_execution_plans_replay_the_recorded_passes():
+    planned_net = build_lstm_softmax_net(handler=HANDLER)
+    planned_net.use_execution_plans = True
+    net = build_lstm_softmax_net(handler=HANDLER)
+    rnd = np.random.RandomState(42)
+    for shape in [(3, 2), (3, 2), (4, 1), (3, 2), (5, 3), (3, 2)]:
+        data = {'default': rnd.randn(*(shape + (4,))),
+                'targets': rnd.randint(0, 3, size=shape + (1,))}
+        for n in [planned_net, net]:
+            n.provide_external_data(data)
+            n.forward_pass(training_pass=True)
+            n.backward_pass()
+        assert np.allclose(planned_net.get('Hid.outputs.default'),
+                           net.get('Hid.outputs.default'))
+        assert np.allclose(planned_net.get('gradients'), net.get('gradients'))
+
+    assert len(planned_net._execution_plans) == 6
+
+
+def test_profiling_handler_attributes_operations_to_layers():
+    inp = Input(out_shapes={'default': ('T', 'B', 4),
+                            'targets': ('T', 'B', 1)})
+    out = SoftmaxCE(name='Output')
+    inp - 'targets' >> 'targets' - out
+    inp >> FullyConnected(3, name='Hid') >> out
+    net = Network.from_layer(out - 'loss' >> Loss())
+    handler = ProfilingHandler(NumpyHandler(np.float64))
+    net.set_handler(handler)
+    net.initialize(Gaussian(0.1), seed=1234)
+    rnd = np.random.RandomState(42)
+    net.provide_external_data({'default': rnd.randn(3, 2, 4),
+                               'targets': rnd.randint(0, 3, size=(3, 2, 1))})
+    handler.reset()
+    net.forward_pass(training_pass=True)
+    net.backward_pass()
+
+    profile = handler.get_profile()
+    assert set(profile['Hid']) == {'forward', 'backward'}
+    dot = profile['Hid']['forward']['dot_mm']
+    assert dot['calls'] == 1
+    assert dot['flops'] == 2 * 6 * 4 * 3
+    assert dot['bytes'] == (6 * 4 + 4 * 3 + 6 * 3) * 8
+    assert dot['time'] > 0
+    assert 'softmax_ce_forward' in profile['Output']['forward']
+    # clearing the context and the backward buffers isn't part of a layer
+    assert set(profile['other']['other']) == {'fill'}
+    assert 'dot_mm' in handler.format_profile()
+
+
+@pytest.mark.parametrize('kwargs, message', [
+    ({}, 'of add_mv in the forward pass of layer "Hid"'),
+    ({'layers': ['Out']}, 'in the forward pass of layer "Out"'),
+    # the NaN enters through the bias, after dot_mm already wrote the outputs
+    ({'layer_boundaries': True},
+     'of add_mv in the forward pass of layer "Hid"'),
+    ({'check_every': 10 ** 6}, None),
+])
+def test_debug_handler_checking_modes_report_layer(kwargs, message):
+    inp = Input(out_shapes={'default': ('T', 'B', 4)})
+    net = Network.from_layer(inp >> FullyConnected(3, name='Hid') >>
+                             FullyConnected(2, name='Out'))
+    handler = DebugHandler(NumpyHandler(np.float64), **kwargs)
+    net.set_handler(handler)
+    net.initialize(Gaussian(0.1), seed=1234)
+    net.provide_external_data({'default': np.ones((3, 2, 4))})
+    net.buffer.Hid.parameters.bias.array[1] = np.nan
+    if message is None:
+        net.forward_pass()
+    else:
+        with pytest.raises(ValueError) as excinfo:
+            net.forward_pass()
+        assert message in str(excinfo.value)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'layer_boundaries': True}])
+def test_debug_handler_reports_operation_of_backward_pass(kwargs):
+    inp = Input(out_shapes={'default': ('T', 'B', 4),
+                            'targets': ('T', 'B', 1)})
+    out = SoftmaxCE(name='Output')
+    inp - 'targets' >> 'targets' - out
+    net = Network.from_layer(inp >> FullyConnected(3, name='Hid') >>
+                             FullyConnected(2, name='Out') >> out)
+    handler = DebugHandler(NumpyHandler(np.float64), **kwargs)
+    net.set_handler(handler)
+    net.initialize(Gaussian(0.1), seed=1234)
+    rnd = np.random.RandomState(42)
+    net.provide_external_data({'default': rnd.randn(3, 2, 4),
+                               'targets': rnd.randint(0, 2, size=(3, 2, 1))})
+    net.forward_pass(training_pass=True)
+    # the NaN enters through the weights, after the activation derivative
+    # already read the output deltas
+    net.buffer.Out.parameters.W.array[0, 0] = np.inf
+    with pytest.raises(ValueError) as excinfo:
+        net.backward_pass()
+    assert ('"2." of dot_add_mm in the backward pass of layer "Out"' in
+            str(excinfo.value))
+
+
+def test_concurrent_branches_match_sequential_passes():
+    def build_net():
+        inp = Input(out_shapes={'default': ('T', 'B', 4),
+                                'targets': ('T', 'B', 1)})
+        merge = Merge(name='Merge')
+        inp >> FullyConnected(5, name='A1') >> FullyConnected(3, name='A2') \
+            >> 'inputs_1' - merge
+        inp >> Lstm(3, name='B1') >> 'inputs_2' - merge
+        out = SoftmaxCE(name='Output')
+        inp - 'targets' >> 'targets' - out
+        merge >> FullyConnected(3, name='Hid') >> out
+        net = Network.from_layer(out - 'loss' >> Loss())
+        net.set_handler(NumpyHandler(np.float64))
+        net.initialize(Gaussian(0.1), seed=1234)
+        return net
+
+    concurrent_net = build_net()
+    concurrent_net.branch_threads = 3
+    net = build_net()
+    rnd = np.random.RandomState(42)
+    for shape in [(3, 2), (4, 5)]:
+        data = {'default': rnd.randn(*(shape + (4,))),
+                'targets': rnd.randint(0, 3, size=shape + (1,))}
+        for n in [concurrent_net, net]:
+            n.provide_external_data(data)
+            n.forward_pass(training_pass=True)
+            n.backward_pass()
+        assert np.allclose(concurrent_net.get('Hid.outputs.default'),
+                           net.get('Hid.outputs.default'))
+        assert np.allclose(concurrent_net.get('Input.output_deltas.default'),
+                           net.get('Input.output_deltas.default'))
+        assert np.allclose(concurrent_net.get('gradients'),
+                           net.get('gradients'))
+
+    # the first layers of both towers add to the deltas of the Input layer
+    assert concurrent_net._backward_dependencies['A1'] == {'A2', 'B1'}
+    assert concurrent_net._forward_dependencies['Merge'] == {'A2', 'B1'}
+
+
+def test_concurrent_branches_propagate_errors():
+    net = simple_recurrent_net()
+    net.set_handler(NumpyHandler(np.float64))
+    net.branch_threads = 2
+    net.provide_external_data({'default': np.ones((2, 1, 2))})
+
+    def fail(buffers, training_pass=True):
+        raise RuntimeError('failing layer')
+
+    net.layers['out'].forward_pass = fail
+    with pytest.raises(RuntimeError):
+        net.forward_pass()
+
+
+def test_closing_network_joins_its_worker_threads():
+    net = simple_recurrent_net()
+    net.set_handler(NumpyHandler(np.float64))
+    net.branch_threads = 2
+    net.provide_external_data({'default': np.ones((2, 1, 2))})
+    net.forward_pass()
+    workers = net._thread_pool[1]._pool
+    assert all(w.is_alive() for w in workers)
+
+    net.close()
+    assert net._thread_pool is None
+    assert not any(w.is_alive() for w in workers)
+    # the next concurrent pass starts a new pool
+    net.forward_pass()
+    assert net._thread_pool is not None
+    net.close()
+
+
+def test_reusing_memory_keeps_outputs_and_scales_with_width():
+    def build_net(reuse_memory, mode='training'):
+        inp = Input(out_shapes={'default': ('T', 'B', 8)})
+        layer = inp
+        for i in range(10):
+            layer = layer >> FullyConnected(16, name='Hid{}'.format(i))
+        net = Network.from_layer(layer >> FullyConnected(2, name='Out'),
+                                 mode=mode, reuse_memory=reuse_memory)
+        net.set_handler(NumpyHandler(np.float64))
+        net.initialize(Gaussian(0.1), seed=1234)
+        return net
+
+    reusing_net = build_net(reuse_memory=True)
+    net = build_net(reuse_memory=False, mode='inference')
+    # reusing memory implies inference, so no deltas or gradients are kept
+    assert reusing_net.mode == 'inference'
+    assert reusing_net.buffer.gradients.size == 0
+    rnd = np.random.RandomState(42)
+    for shape in [(3, 2), (5, 4)]:
+        data = {'default': rnd.randn(*(shape + (8,)))}
+        for n in [reusing_net, net]:
+            n.provide_external_data(data)
+            n.forward_pass()
+        assert np.allclose(reusing_net.get('Out.outputs.default'),
+                           net.get('Out.outputs.default'))
+
+    # the outputs of all layers fit into the memory of two hidden layers
+    assert net._buffer_manager.activation_size - \
+        reusing_net._buffer_manager.activation_size == \
+        5 * 4 * (10 * 16 + 2 - 2 * 16)
+    with pytest.raises(NetworkValidationError):
+        reusing_net.backward_pass()
+
+
+def test_inference_mode_matches_training_forward_pass():
+    net = build_lstm_softmax_net()
+    inference_net = build_lstm_softmax_net(mode='inference')
+    reusing_net = build_lstm_softmax_net(reuse_memory=True)
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(3, 2, 4),
+            'targets': rnd.randint(0, 3, size=(3, 2, 1))}
+    for n in [net, inference_net, reusing_net]:
+        n.provide_external_data(data)
+        n.forward_pass()
+    for path in ['Output.outputs.probabilities', 'Lstm.outputs.default']:
+        assert np.allclose(inference_net.get(path), net.get(path))
+    assert np.allclose(reusing_net.get('Output.outputs.probabilities'),
+                       net.get('Output.outputs.probabilities'))
+    assert reusing_net.mode == 'inference'
+    assert inference_net.get('Output.outputs.loss') == \
+        pytest.approx(net.get('Output.outputs.loss'))
+
+    manager = net._buffer_manager
+    inference_manager = inference_net._buffer_manager
+    assert inference_manager.parameter_buffer.size < \
+        manager.parameter_buffer.size
+    assert inference_manager.activation_size < manager.activation_size
+    assert len(inference_net.buffer.Lstm.gradients) == 0
+    assert len(inference_net.buffer.Lstm.output_deltas) == 0
+    assert inference_net.buffer.Lstm.internals.dGa is None
+    with pytest.raises(NetworkValidationError):
+        inference_net.backward_pass()
+
+
+def test_unknown_network_mode_raises():
+    with pytest.raises(ValueError):
+        build_lstm_softmax_net(mode='evaluation')
+
+
+def test_for_inference_and_from_hdf5_copy_parameters(tmpdir):
+    net = build_lstm_softmax_net()
+    net.output_name = 'Output.outputs.probabilities'
+    filename = str(tmpdir.join('net.h5'))
+    net.save_as_hdf5(filename)
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net.provide_external_data(data)
+    net.forward_pass()
+    expected = net.get('Output.outputs.probabilities')
+
+    for inference_net in [net.for_inference(),
+                          Network.from_hdf5(filename, mode='inference')]:
+        assert inference_net.mode == 'inference'
+        assert inference_net.output_name == net.output_name
+        assert np.allclose(inference_net.get('parameters'),
+                           net.get('parameters'))
+        inference_net.provide_external_data(data)
+        inference_net.forward_pass()
+        assert np.allclose(inference_net.get('Output.outputs.probabilities'),
+                           expected)
+
+
+def test_from_mmap_maps_parameters_into_memory(tmpdir):
+    net = build_lstm_softmax_net()
+    net.output_name = 'Output.outputs.probabilities'
+    filename = str(tmpdir.join('net.bsnet'))
+    net.save_as_mmap(filename, comment='test')
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net.provide_external_data(data)
+    net.forward_pass()
+    expected = net.get('Output.outputs.probabilities')
+
+    mapped_net = Network.from_mmap(filename, mode='inference')
+    assert mapped_net.output_name == net.output_name
+    memory = mapped_net._buffer_manager.parameter_memory
+    assert isinstance(memory.base, np.memmap)
+    assert np.all(mapped_net.get('parameters') == net.get('parameters'))
+    mapped_net.provide_external_data(data)
+    mapped_net.forward_pass()
+    assert np.allclose(mapped_net.get('Output.outputs.probabilities'),
+                       expected)
+
+    # copy-on-write: training the loaded network leaves the file unchanged
+    trained_net = Network.from_mmap(filename)
+    trained_net.provide_external_data(data)
+    trained_net.forward_pass()
+    trained_net.backward_pass()
+    trained_net.buffer.parameters[:] -= trained_net.buffer.gradients
+    assert np.all(Network.from_mmap(filename).get('parameters') ==
+                  net.get('parameters'))
+
+
+def test_from_mmap_copies_parameters_for_other_handlers(tmpdir):
+    net = build_lstm_softmax_net()
+    net.set_handler(HANDLER)
+    filename = str(tmpdir.join('net.bsnet'))
+    net.save_as_mmap(filename)
+    loaded_net = Network.from_mmap(filename)
+    assert loaded_net._buffer_manager.parameter_memory is None
+    assert np.all(loaded_net.get('parameters') == net.get('parameters'))
+
+    with pytest.raises(ValueError):
+        loaded_net.attach_parameters(np.zeros_like(net.get('parameters')))
+
+
+def test_from_mmap_raises_on_invalid_file(tmpdir):
+    filename = str(tmpdir.join('net.h5'))
+    build_lstm_softmax_net().save_as_hdf5(filename)
+    with pytest.raises(IOError):
+        Network.from_mmap(filename)
+
+
+def test_attaching_shared_parameters(tmpdir):
+    net = build_lstm_softmax_net()
+    parameters = net.get('parameters')
+    filename = net.share_parameters(str(tmpdir.join('shared.bsnet')))
+    assert np.all(net.get('parameters') == parameters)
+
+    workers = [build_lstm_softmax_net(mode='inference') for _ in range(2)]
+    for worker in workers:
+        worker.initialize(0)
+        worker.attach_shared_parameters(filename)
+        assert np.all(worker.get('parameters') == parameters)
+        with pytest.raises(ValueError):
+            worker.buffer.parameters[0] = 1.
+
+    # updates of the sharing network are seen by all workers
+    net.buffer.parameters[:] = 2.
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net.provide_external_data(data)
+    net.forward_pass()
+    for worker in workers:
+        assert np.all(worker.get('parameters') == 2.)
+        worker.provide_external_data(data)
+        worker.forward_pass()
+        assert np.allclose(worker.get('Output.outputs.probabilities'),
+                           net.get('Output.outputs.probabilities'))
+
+
+def test_attaching_shared_parameters_of_other_architecture_raises(tmpdir):
+    net = build_lstm_softmax_net()
+    filename = net.share_parameters(str(tmpdir.join('shared.bsnet')))
+
+    # same parameters, but a different checkpoint interval
+    other = build_lstm_softmax_net(checkpoint_interval=2)
+    assert other.buffer.parameters.size == net.buffer.parameters.size
+    with pytest.raises(NetworkValidationError):
+        other.attach_shared_parameters(filename)
+
+
+@pytest.mark.parametrize('branch_threads,use_execution_plans',
+                         [(1, False), (2, False), (1, True)])
+def test_forward_pass_only_runs_layers_needed_for_outputs(
+        branch_threads, use_execution_plans):
+    net = build_lstm_softmax_net()
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net.provide_external_data(data)
+    net.forward_pass()
+    expected = net.get('Hid.outputs.default')
+
+    partial_net = build_lstm_softmax_net()
+    partial_net.branch_threads = branch_threads
+    partial_net.use_execution_plans = use_execution_plans
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Output layer should not run.')
+    partial_net.layers['Output'].forward_pass = fail
+    assert partial_net._get_required_layers(['Hid.outputs.default']) == \
+        ('Lstm', 'Hid')
+
+    for _ in range(2):
+        partial_net.provide_external_data({'default': data['default']},
+                                          all_inputs=False)
+        partial_net.forward_pass(outputs=['Hid.outputs.default'])
+        assert np.allclose(partial_net.get('Hid.outputs.default'), expected)
+
+    with pytest.raises(KeyError):
+        partial_net.forward_pass(outputs=['Missing.outputs.default'])
+
+
+@pytest.mark.parametrize('branch_threads,use_execution_plans',
+                         [(1, False), (2, False), (1, True)])
+def test_backward_pass_skips_unused_deltas(branch_threads,
+                                           use_execution_plans):
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net = build_lstm_softmax_net(bottom=Elementwise('tanh', name='Act'))
+    net.provide_external_data(data)
+    net.forward_pass(training_pass=True)
+    net.backward_pass()
+    expected = net.buffer.gradients.copy()
+    assert np.any(net.get('Act.input_deltas.default'))
+
+    pruned_net = build_lstm_softmax_net(bottom=Elementwise('tanh', name='Act'))
+    pruned_net.skip_unused_deltas = True
+    pruned_net.branch_threads = branch_threads
+    pruned_net.use_execution_plans = use_execution_plans
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Act layer should not run.')
+    pruned_net.layers['Act'].backward_pass = fail
+    assert pruned_net._gradient_needs[0] == ('Lstm', 'Hid', 'Output', 'Loss')
+
+    for _ in range(2):
+        pruned_net.provide_external_data(data)
+        pruned_net.forward_pass(training_pass=True)
+        pruned_net.backward_pass()
+        assert pruned_net.layers['Lstm'].unused_input_deltas == {'default'}
+        assert np.allclose(pruned_net.buffer.gradients, expected)
+        assert not np.any(pruned_net.get('Lstm.input_deltas.default'))
+        assert not np.any(pruned_net.get('Act.input_deltas.default'))
+
+
+def test_freezing_skips_gradients_and_frozen_layers():
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    net = build_lstm_softmax_net(bottom=Elementwise('tanh', name='Act'))
+    net.provide_external_data(data)
+    net.forward_pass(training_pass=True)
+    net.backward_pass()
+    expected = net.get('Hid.gradients.bias')
+
+    frozen_net = build_lstm_softmax_net(bottom=Elementwise('tanh', name='Act'))
+    frozen_net.freeze(default=True, Hid={'bias': False})
+    assert frozen_net.frozen_parameters == {'Lstm': sorted(
+        frozen_net.layers['Lstm'].parameter_shapes), 'Hid': ['W']}
+    hid_bias = frozen_net._buffer_manager.layout['Hid']['parameters']['bias']
+    offset = frozen_net._buffer_manager.layout['parameters']['@slice'][0]
+    assert frozen_net.get_trainable_slices() == [
+        slice(hid_bias['@slice'][0] - offset, hid_bias['@slice'][1] - offset)]
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Frozen layers should not run.')
+    frozen_net.layers['Lstm'].backward_pass = fail
+    frozen_net.layers['Act'].backward_pass = fail
+    frozen_net.provide_external_data(data)
+    frozen_net.forward_pass(training_pass=True)
+    frozen_net.backward_pass()
+    assert np.allclose(frozen_net.get('Hid.gradients.bias'), expected)
+    assert not np.any(frozen_net.get('Hid.gradients.W'))
+
+    # the stepper only updates the bias of Hid
+    parameters = frozen_net.get('parameters')
+    stepper = SgdStepper(learning_rate=1.0)
+    stepper.start(frozen_net)
+    stepper.run()
+    trainable = frozen_net.get_trainable_slices()[0]
+    parameters[trainable] -= frozen_net.get('gradients')[trainable]
+    assert np.allclose(frozen_net.get('parameters'), parameters)
+
+    frozen_net.freeze(False)
+    assert frozen_net.frozen_parameters == {}
+    assert frozen_net.get_trainable_slices() == [
+        slice(0, frozen_net.buffer.parameters.size)]
+
+
+@pytest.mark.parametrize('frozen', [
+    True, {'Wz': True, 'Ri': True, 'pf': True}])
+def test_frozen_lstm_skips_its_gradients(frozen):
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(4, 3, 4),
+            'targets': rnd.randint(0, 3, size=(4, 3, 1))}
+    nets = [build_lstm_softmax_net(
+        bottom=FullyConnected(3, activation='tanh', name='Bottom'))
+        for _ in range(2)]
+    nets[1].freeze(Lstm=frozen)
+    gemms = []
+
+    def record_gemm(a, b, out, transa=False, transb=False):
+        gemms.append((out.shape, transa))
+        NumpyHandler.dot_add_mm(nets[1].handler, a, b, out, transa, transb)
+    nets[1].handler.dot_add_mm = record_gemm
+    for net in nets:
+        net.provide_external_data(data)
+        net.forward_pass(training_pass=True)
+        net.backward_pass()
+
+    frozen_names = set(nets[1].frozen_parameters['Lstm'])
+    for name in nets[1].layers['Lstm'].parameter_shapes:
+        path = 'Lstm.gradients.' + name
+        if name in frozen_names:
+            assert not np.any(nets[1].get(path))
+        else:
+            assert np.allclose(nets[1].get(path), nets[0].get(path))
+    assert np.allclose(nets[1].get('Bottom.gradients.W'),
+                       nets[0].get('Bottom.gradients.W'))
+    # the stacked dW GEMM of all gates
+    dW_gemm = ((4 * 5, 3), True)
+    assert (dW_gemm in gemms) == (frozen is not True)
+
+
+def test_lstm_uses_views_of_its_stacked_parameters():
+    net = build_lstm_softmax_net()
+    handler = ProfilingHandler(NumpyHandler(np.float64))
+    net.set_handler(handler)
+    rnd = np.random.RandomState(42)
+    net.provide_external_data({'default': rnd.randn(3, 2, 4),
+                               'targets': rnd.randint(0, 3, size=(3, 2, 1))})
+    handler.reset()
+    net.forward_pass(training_pass=True)
+    net.backward_pass()
+
+    profile = handler.get_profile()['Lstm']
+    assert 'copy_to' not in profile['forward']
+    # only the output deltas of every time step are copied
+    assert profile['backward']['copy_to']['calls'] == 3
+    # the gradients of the biases and peepholes are summed up, the others
+    # are accumulated directly
+    assert profile['backward']['add_tt']['calls'] == 1 + 3 + 2
+
+
+def test_freezing_is_described_and_rejects_conflicts():
+    net = build_lstm_softmax_net(bottom=Elementwise('tanh', name='Act'))
+    net.freeze(Lstm=True)
+    description = get_description(net)
+    assert description['frozen_parameters'] == net.frozen_parameters
+    net2 = create_from_description(description)
+    assert net2.frozen_parameters == net.frozen_parameters
+    assert net2.layers['Lstm'].frozen_parameters == \
+        set(net.frozen_parameters['Lstm'])
+
+    with pytest.raises(NetworkValidationError):
+        net.freeze({'Lstm': True, 'L*': False})
+
+
+def test_resizing_keeps_parameters_in_place_and_caches_views():
+    net = build_lstm_softmax_net()
+    net.set_shape_buckets(time_bucket=4, batch_bucket=4)
+    manager = net._buffer_manager
+    parameter_buffer = manager.parameter_buffer
+    parameters = net.get('parameters')
+    rnd = np.random.RandomState(42)
+
+    def run(time_size, batch_size):
+        data = {'default': rnd.randn(time_size, batch_size, 4),
+                'targets': rnd.randint(0, 3, size=(time_size, batch_size, 1))}
+        net.provide_external_data(data)
+        net.forward_pass()
+        net.backward_pass()
+        return net.buffer
+
+    views = run(4, 4)
+    activation_buffer = manager.activation_buffer
+    assert run(3, 2) is not views
+    # shapes within the bucket neither reallocate nor rebuild the views
+    assert run(4, 4) is views
+    assert manager.activation_buffer is activation_buffer
+    assert net.buffer.Output.outputs.probabilities.shape == (4, 4, 3)
+
+    run(7, 5)
+    assert manager.activation_buffer is not activation_buffer
+    activation_buffer = manager.activation_buffer
+    run(8, 8)
+    assert manager.activation_buffer is activation_buffer
+    assert manager.parameter_buffer is parameter_buffer
+    assert np.allclose(net.get('parameters'), parameters)
+
+
+def test_resizing_only_caches_views_of_recent_shapes():
+    net = build_lstm_softmax_net()
+    net.set_shape_buckets(time_bucket=16, batch_bucket=16)
+    manager = net._buffer_manager
+    views = manager.resize(16, 16)
+    activation_buffer = manager.activation_buffer
+    for time_size in range(1, 17):
+        for batch_size in range(1, 17):
+            manager.resize(time_size, batch_size)
+            assert len(manager._cached_views) <= manager.max_cached_shapes
+            # the most recent one is still cached
+            assert manager.resize(16, 16) is views
+    assert manager.activation_buffer is activation_buffer
+
+
+@pytest.mark.parametrize('layer_type', [Recurrent, Lstm, Clockwork,
+                                        ClockworkLstm])
+def test_checkpointing_matches_storing_all_internals(layer_type):
+    def build_net(checkpoint_interval):
+        kwargs = {'name': 'Rnn'}
+        if layer_type in (Clockwork, ClockworkLstm):
+            kwargs['timing'] = [1, 1, 2, 2, 3]
+        net = build_lstm_softmax_net(checkpoint_interval=checkpoint_interval,
+                                     layer_type=layer_type, **kwargs)
+        if layer_type in (Clockwork, ClockworkLstm):
+            net.handler.set_from_numpy(net.buffer.Rnn.parameters.timing,
+                                       np.array([1., 1., 2., 2., 3.]))
+        return net
+
+    net = build_net(0)
+    checkpointed_net = build_net(3)
+    rnd = np.random.RandomState(42)
+    data = {'default': rnd.randn(8, 2, 4),
+            'targets': rnd.randint(0, 3, size=(8, 2, 1))}
+    for n in [net, checkpointed_net]:
+        n.provide_external_data(data)
+        n.forward_pass(training_pass=True)
+        n.backward_pass()
+
+    for path in ['Rnn.outputs.default', 'gradients',
+                 'Rnn.input_deltas.default']:
+        assert np.allclose(checkpointed_net.get(path), net.get(path)), path
+    assert checkpointed_net._buffer_manager.activation_size < \
+        net._buffer_manager.activation_size
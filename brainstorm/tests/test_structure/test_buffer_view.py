@@ -136,3 +136,21 @@ def test_deep_copying_of_buffer_view(buffer_view):
 
     foo_view.a[:] = 7
     assert np.all(my_buffer_copy.foo.a == np.ones(2))
+
+
+def test_buffer_view_get_stacked():
+    buffer_names = ['W', 'R', 'b']
+    full_buffer = np.arange(11)
+    buffers = [full_buffer[:6].reshape((3, 2)),
+               full_buffer[6:10].reshape((2, 2)),
+               full_buffer[10:].reshape((1,))]
+    bv = BufferView(buffer_names, buffers, full_buffer)
+
+    stacked = bv.get_stacked(['W', 'R'])
+    assert stacked.shape == (5, 2)
+    assert np.shares_memory(stacked, full_buffer)
+    assert np.all(stacked == np.arange(10).reshape((5, 2)))
+    # different trailing shapes, not consecutive or no full buffer
+    assert bv.get_stacked(['R', 'b']) is None
+    assert bv.get_stacked(['W', 'b']) is None
+    assert BufferView(buffer_names, buffers).get_stacked(['W', 'R']) is None
@@ -5,13 +5,17 @@ from __future__ import division, print_function, unicode_literals
 import numpy as np
 import pytest
 
-from brainstorm.structure.layout import (Hub, create_layout,
+from brainstorm.structure.architecture import \
+    instantiate_layers_from_architecture
+from brainstorm.structure.layout import (Hub, LayoutCache, create_layout,
                                          create_layout_stub,
                                          gather_array_nodes, get_all_sources,
+                                         get_architecture_hash,
                                          get_connections, get_forced_orders,
                                          get_forward_closure, get_order,
                                          get_parameter_order,
                                          merge_connections)
+from brainstorm.utils import NetworkValidationError
 
 
 def test_get_order():
@@ -229,6 +233,78 @@ def test_permute_rows2():
         [0, 0, 1, 1, 1]]))
 
 
+def test_permute_rows_keeps_order_within_nesting():
+    h = Hub([0, 1, 2, 3], [0, [1, 2], 3], [1, 2, 3], 0)
+
+    h.connection_table = np.array([
+        [0, 0, 1],
+        [1, 0, 0],
+        [1, 1, 0],
+        [0, 1, 1]])
+    h.permute_rows()
+    assert h.perm == [1, 2, 3, 0]
+
+
+def test_permute_rows_raises_if_impossible():
+    h = Hub([0, 1, 2, 3], [0, 1, 2, 3], [1, 2, 3, 4], 0)
+    h.connection_table = np.array([
+        [1, 0, 0, 1],
+        [1, 1, 0, 0],
+        [0, 1, 1, 0],
+        [0, 0, 1, 1]])
+    with pytest.raises(NetworkValidationError):
+        h.permute_rows()
+
+
+@pytest.mark.parametrize('width', [10, 100, 400])
+def test_permute_rows_wide_hub(width):
+    # every sink connects to a window of sources of a hidden order
+    order = np.random.RandomState(width).permutation(width)
+    windows = [order[i:i + 3] for i in range(width - 2)]
+    h = Hub(list(range(width)), list(range(width)),
+            list(range(len(windows))), 0)
+    h.connection_table = np.zeros((width, len(windows)))
+    for i, window in enumerate(windows):
+        h.connection_table[window, i] = 1
+    h.permute_rows()
+    assert Hub.can_be_connected_with_single_buffer(h.connection_table)
+    assert h.perm in (list(order), list(order[::-1]))
+
+
+def test_create_layout_for_wide_architecture():
+    width = 40
+    order = np.random.RandomState(0).permutation(width)
+    arch = {
+        'Input': {
+            '@type': 'Input',
+            'out_shapes': {'default': ('T', 'B', 2)},
+            '@outgoing_connections': ['L{}'.format(i) for i in range(width)]
+        }
+    }
+    for i in range(width):
+        arch['L{}'.format(i)] = {
+            '@type': 'FullyConnected',
+            'size': i + 1,
+            '@outgoing_connections': []
+        }
+    for i in range(width - 1):
+        arch['S{}'.format(i)] = {
+            '@type': 'FullyConnected',
+            'size': 1,
+            '@outgoing_connections': []
+        }
+        for j in order[i:i + 2]:
+            arch['L{}'.format(j)]['@outgoing_connections'].append(
+                'S{}'.format(i))
+
+    hubs, layout = create_layout(instantiate_layers_from_architecture(arch))
+    for i in range(width - 1):
+        sources = [layout['L{}'.format(j)]['outputs']['default']['@slice']
+                   for j in order[i:i + 2]]
+        assert layout['S{}'.format(i)]['inputs']['default']['@slice'] == \
+            (min(sources)[0], max(sources)[1])
+
+
 def test_create_layout_stub(layers):
     layout = create_layout_stub(layers)
     assert layout == {
@@ -250,7 +326,8 @@ def test_create_layout_stub(layers):
                 '@type': 'BufferView',
                 '@index': 1,
                 'default': {'@type': 'array', '@index': 0,
-                            '@shape': ('T', 'B', 2)},
+                            '@shape': ('T', 'B', 2),
+                            '@is_full_precision': True},
             },
             'parameters': {'@type': 'BufferView', '@index': 2},
             'internals': {'@type': 'BufferView', '@index': 3},
@@ -535,7 +612,8 @@ def test_create_layout(layers):
                 '@index': 1,
                 'default': {'@type': 'array', '@index': 0,
                             '@shape': ('T', 'B', 2),
-                            '@hub': 1, '@slice': (0, 2)},
+                            '@hub': 1, '@slice': (0, 2),
+                            '@is_full_precision': True},
             },
             'parameters': {'@type': 'BufferView', '@index': 2},
             'internals': {'@type': 'BufferView', '@index': 3},
@@ -570,6 +648,7 @@ def test_create_layout(layers):
             'parameters': {
                 '@type': 'BufferView',
                 '@index': 2,
+                '@hub': 0, '@slice': (0, 9), '@shape': (9,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (3, 2),
                       '@hub': 0, '@slice': (0, 6)},
                 'bias': {'@type': 'array', '@index': 1, '@shape': (3,),
@@ -598,6 +677,7 @@ def test_create_layout(layers):
             'gradients': {
                 '@type': 'BufferView',
                 '@index': 6,
+                '@hub': 4, '@slice': (0, 9), '@shape': (9,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (3, 2),
                       '@hub': 4, '@slice': (0, 6),
                       '@is_backward_only': True},
@@ -626,6 +706,7 @@ def test_create_layout(layers):
             'parameters': {
                 '@type': 'BufferView',
                 '@index': 2,
+                '@hub': 0, '@slice': (9, 24), '@shape': (15,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (5, 2),
                       '@hub': 0, '@slice': (9, 19)},
                 'bias': {'@type': 'array', '@index': 1, '@shape': (5,),
@@ -654,6 +735,7 @@ def test_create_layout(layers):
             'gradients': {
                 '@type': 'BufferView',
                 '@index': 6,
+                '@hub': 4, '@slice': (9, 24), '@shape': (15,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (5, 2),
                       '@hub': 4, '@slice': (9, 19),
                       '@is_backward_only': True},
@@ -682,6 +764,7 @@ def test_create_layout(layers):
             'parameters': {
                 '@type': 'BufferView',
                 '@index': 2,
+                '@hub': 0, '@slice': (24, 87), '@shape': (63,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (7, 8),
                       '@hub': 0, '@slice': (24, 80)},
                 'bias': {'@type': 'array', '@index': 1, '@shape': (7,),
@@ -710,6 +793,7 @@ def test_create_layout(layers):
             'gradients': {
                 '@type': 'BufferView',
                 '@index': 6,
+                '@hub': 4, '@slice': (24, 87), '@shape': (63,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (7, 8),
                       '@hub': 4, '@slice': (24, 80),
                       '@is_backward_only': True},
@@ -738,6 +822,7 @@ def test_create_layout(layers):
             'parameters': {
                 '@type': 'BufferView',
                 '@index': 2,
+                '@hub': 0, '@slice': (87, 230), '@shape': (143,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (11, 12),
                       '@hub': 0, '@slice': (87, 219)},
                 'bias': {'@type': 'array', '@index': 1, '@shape': (11,),
@@ -766,6 +851,7 @@ def test_create_layout(layers):
             'gradients': {
                 '@type': 'BufferView',
                 '@index': 6,
+                '@hub': 4, '@slice': (87, 230), '@shape': (143,),
                 'W': {'@type': 'array', '@index': 0, '@shape': (11, 12),
                       '@hub': 4, '@slice': (87, 219),
                       '@is_backward_only': True},
@@ -774,3 +860,65 @@ def test_create_layout(layers):
                          '@is_backward_only': True}
             },
         }}
+
+
+@pytest.fixture
+def architecture():
+    return {
+        'Input': {
+            '@type': 'Input',
+            'out_shapes': {'default': ('T', 'B', 2)},
+            '@outgoing_connections': ['A']
+        },
+        'A': {
+            '@type': 'FullyConnected',
+            'size': 3,
+            '@outgoing_connections': []
+        }
+    }
+
+
+def test_architecture_hash_is_canonical(architecture):
+    reordered = {k: architecture[k] for k in reversed(sorted(architecture))}
+    assert get_architecture_hash(architecture) == \
+        get_architecture_hash(reordered)
+    assert get_architecture_hash(architecture) != \
+        get_architecture_hash(architecture, include_backward=False)
+    old_hash = get_architecture_hash(architecture)
+    architecture['A']['size'] = 4
+    assert get_architecture_hash(architecture) != old_hash
+
+
+def test_layout_cache_in_memory(architecture):
+    cache = LayoutCache(directory=False)
+    layers = instantiate_layers_from_architecture(architecture)
+    hubs, layout = cache.get(architecture, layers)
+    assert layout == create_layout(layers)[1]
+    assert [h.perm for h in hubs] == [h.perm for h in create_layout(layers)[0]]
+
+    # cached layouts are handed out as copies and don't need the layers
+    layout['A']['@index'] = 42
+    hubs2, layout2 = cache.get(architecture, None)
+    assert layout2 == create_layout(layers)[1]
+    assert hubs2[0] is not hubs[0]
+
+
+def test_layout_cache_on_disk(architecture, tmpdir):
+    layers = instantiate_layers_from_architecture(architecture)
+    LayoutCache(directory=str(tmpdir)).get(architecture, layers,
+                                           include_backward=False)
+    assert tmpdir.join(get_architecture_hash(
+        architecture, include_backward=False) + '.pickle').check()
+
+    hubs, layout = LayoutCache(directory=str(tmpdir)).get(
+        architecture, None, include_backward=False)
+    assert layout == create_layout(layers, include_backward=False)[1]
+
+
+def test_layout_cache_ignores_unreadable_files(architecture, tmpdir):
+    key = get_architecture_hash(architecture)
+    tmpdir.join(key + '.pickle').write('garbage')
+    layers = instantiate_layers_from_architecture(architecture)
+    with pytest.warns(UserWarning):
+        hubs, layout = LayoutCache(str(tmpdir)).get(architecture, layers)
+    assert layout == create_layout(layers)[1]
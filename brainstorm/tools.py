@@ -87,7 +87,8 @@ def extract_and_save(network, iter, buffer_names, file_name):
     In particular, this tool can be used to save the predictions of a
     network on a dataset.
     In general, any number of internal, input or output buffers of the network
-    can be extracted.
+    can be extracted. Only the layers needed for computing them are run, so
+    the data doesn't need to include e.g. the targets.
 
     Examples:
         >>> getter = Minibatches(100, default=x_test)
@@ -118,7 +119,7 @@ def extract_and_save(network, iter, buffer_names, file_name):
         f.attrs.create('format', b'Buffers file v1.0')
 
         for _ in run_network(network, iterator, all_inputs=False):
-            network.forward_pass()
+            network.forward_pass(outputs=buffer_names)
             first_pass = False if len(ds) > 0 else True
             for num, buffer_name in enumerate(buffer_names):
                 data = network.get(buffer_name)
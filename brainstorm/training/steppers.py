@@ -61,12 +61,14 @@ class SgdStepper(TrainingStepper):
     def run(self):
         self.net.forward_pass(training_pass=True)
         self.net.backward_pass()
-        self.net.handler.mult_st(-self.learning_rate,
-                                 self.net.buffer.gradients,
-                                 out=self.update)
-        self.net.handler.add_tt(self.update,
-                                self.net.buffer.parameters,
-                                out=self.net.buffer.parameters)
+        parameters = self.net.buffer.parameters
+        gradients = self.net.buffer.gradients
+        # frozen parameters are not updated
+        for s in self.net.get_trainable_slices():
+            self.net.handler.mult_st(-self.learning_rate, gradients[s],
+                                     out=self.update[s])
+            self.net.handler.add_tt(self.update[s], parameters[s],
+                                    out=parameters[s])
 
 
 class MomentumStepper(TrainingStepper):
@@ -103,15 +105,16 @@ class MomentumStepper(TrainingStepper):
         self.net.forward_pass(training_pass=True)
         self.net.backward_pass()
 
-        self.net.handler.mult_st(momentum,
-                                 self.velocity,
-                                 out=self.velocity)
-        self.net.handler.mult_add_st(-learning_rate,
-                                     self.net.buffer.gradients,
-                                     out=self.velocity)
-        self.net.handler.add_tt(self.velocity,
-                                self.net.buffer.parameters,
-                                out=self.net.buffer.parameters)
+        parameters = self.net.buffer.parameters
+        gradients = self.net.buffer.gradients
+        # frozen parameters are not updated
+        for s in self.net.get_trainable_slices():
+            velocity = self.velocity[s]
+            self.net.handler.mult_st(momentum, velocity, out=velocity)
+            self.net.handler.mult_add_st(-learning_rate, gradients[s],
+                                         out=velocity)
+            self.net.handler.add_tt(velocity, parameters[s],
+                                    out=parameters[s])
 
 
 class NesterovStepper(MomentumStepper):
@@ -128,18 +131,21 @@ class NesterovStepper(MomentumStepper):
         if self.scale_learning_rate:
             learning_rate *= (1 - momentum)
 
-        self.net.handler.mult_st(momentum,
-                                 self.velocity,
-                                 out=self.velocity)
-        self.net.handler.add_tt(self.velocity,
-                                self.net.buffer.parameters,
-                                out=self.net.buffer.parameters)
+        parameters = self.net.buffer.parameters
+        # frozen parameters are not updated
+        slices = self.net.get_trainable_slices()
+        for s in slices:
+            velocity = self.velocity[s]
+            self.net.handler.mult_st(momentum, velocity, out=velocity)
+            self.net.handler.add_tt(velocity, parameters[s],
+                                    out=parameters[s])
         self.net.forward_pass(training_pass=True)
         self.net.backward_pass()
 
-        self.net.handler.mult_add_st(-learning_rate,
-                                     self.net.buffer.gradients,
-                                     self.velocity)
-        self.net.handler.mult_add_st(-learning_rate,
-                                     self.net.buffer.gradients,
-                                     self.net.buffer.parameters)
+        parameters = self.net.buffer.parameters
+        gradients = self.net.buffer.gradients
+        for s in slices:
+            self.net.handler.mult_add_st(-learning_rate, gradients[s],
+                                         self.velocity[s])
+            self.net.handler.mult_add_st(-learning_rate, gradients[s],
+                                         parameters[s])
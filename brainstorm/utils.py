@@ -4,7 +4,9 @@
 from __future__ import division, print_function, unicode_literals
 
 import math
+import os
 import re
+import sys
 from datetime import datetime
 
 import numpy as np
@@ -166,6 +168,49 @@ def flatten_all_but_last(array):
     return array.reshape((int(np.product(array.shape[:-1])), array.shape[-1]))
 
 
+def get_time_segments(time_size, segment_size):
+    """
+    Split the time steps 0, ..., time_size - 1 into consecutive segments.
+
+    Example:
+        >>> get_time_segments(5, 2)
+        [(0, 2), (2, 4), (4, 5)]
+
+    Args:
+        time_size (int):
+            The number of time steps.
+        segment_size (int):
+            The maximum number of time steps per segment.
+    Returns:
+        list[tuple[int]]:
+            The start and stop index of every segment.
+    """
+    return [(start, min(start + segment_size, time_size))
+            for start in range(0, time_size, segment_size)]
+
+
+def get_checkpoint_interval(kwargs):
+    """
+    Get and validate the checkpoint_interval of a recurrent layer.
+
+    Args:
+        kwargs (dict):
+            The kwargs of the layer.
+    Returns:
+        int:
+            The checkpoint interval (0 if it was not given).
+    Raises:
+        LayerValidationError:
+            If the checkpoint interval is not a non-negative int.
+    """
+    checkpoint_interval = kwargs.get('checkpoint_interval', 0)
+    if not isinstance(checkpoint_interval, int) or checkpoint_interval < 0:
+        raise LayerValidationError(
+            'checkpoint_interval must be a non-negative int but was {}'
+            .format(checkpoint_interval))
+    return checkpoint_interval
+
+
 def flatten_keys(dictionary):
     """
     Flattens the keys for a nested dictionary using dot notation. This
@@ -213,6 +258,41 @@ def silence():
         yield ''
 
 
+def find_calling_layer_pass():
+    """Find the layer pass that is being executed by walking up the call
+    stack.
+
+    Returns:
+        tuple: The layer, the name of the pass ('forward' or 'backward'), the
+        buffers of the layer and the training_pass flag of forward passes
+        (None for backward passes), or (None, None, None, None) outside of
+        layers.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        name = frame.f_code.co_name
+        if name in ('forward_pass', 'backward_pass'):
+            caller = frame.f_locals.get('self')
+            # only layers have in_shapes, the network doesn't
+            if hasattr(caller, 'in_shapes'):
+                return (caller, name[:-5], frame.f_locals.get('buffers'),
+                        frame.f_locals.get('training_pass'))
+        frame = frame.f_back
+    return None, None, None, None
+
+
+def get_cache_dir():
+    """Return the directory in which brainstorm caches data between runs.
+
+    That is ``$BRAINSTORM_DATA_DIR/cache`` if the environment variable is
+    set and ``~/.brainstorm/cache`` otherwise. The directory is not created.
+    """
+    data_dir = os.environ.get('BRAINSTORM_DATA_DIR',
+                              os.path.join(os.path.expanduser('~'),
+                                           '.brainstorm'))
+    return os.path.join(data_dir, 'cache')
+
+
 def get_brainstorm_info():
     info = 'Created with brainstorm {}'.format(__version__)
     return info.encode()
@@ -48,18 +48,46 @@ class build_ext(_build_ext):
         except CompileError:
             warn('Failed to build optional extension modules')
 
+# The batch loops of the _cpuop kernels are parallelized with OpenMP
+if sys.platform == 'win32':
+    openmp_compile_args, openmp_link_args = ['/openmp'], []
+elif sys.platform == 'darwin':
+    # Apple's clang does not ship OpenMP, so the kernels run single-threaded
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+
+# The BLAS bindings of the NumpyHandler are optional and need scipy
+try:
+    import scipy.linalg.cython_blas
+except ImportError:
+    use_scipy_blas = False
+else:
+    use_scipy_blas = True
+
 # Cythonize pyx if possible, else compile C
 if use_cython:
     from Cython.Build import cythonize
-    extensions = cythonize([Extension("brainstorm.handlers._cpuop",
-                                     ["brainstorm/handlers/_cpuop.pyx"])])
+    pyx_extensions = [Extension("brainstorm.handlers._cpuop",
+                                ["brainstorm/handlers/_cpuop.pyx"],
+                                extra_compile_args=openmp_compile_args,
+                                extra_link_args=openmp_link_args)]
+    if use_scipy_blas:
+        pyx_extensions.append(Extension("brainstorm.handlers._blas",
+                                        ["brainstorm/handlers/_blas.pyx"]))
+    extensions = cythonize(pyx_extensions)
 
 else:
     extensions = [
         Extension(
             'brainstorm.handlers._cpuop', ['brainstorm/handlers/_cpuop.c'],
-            extra_compile_args=['-w', '-Ofast']),
+            extra_compile_args=['-w', '-Ofast'] + openmp_compile_args,
+            extra_link_args=openmp_link_args),
     ]
+    if use_scipy_blas and os.path.exists('brainstorm/handlers/_blas.c'):
+        extensions.append(Extension('brainstorm.handlers._blas',
+                                    ['brainstorm/handlers/_blas.c'],
+                                    extra_compile_args=['-w', '-Ofast']))
 
 
 # Setup testing
@@ -108,6 +136,7 @@ setup(
     install_requires=['cython', 'h5py', 'mock', 'numpy', 'six'],
     extras_require={
         'live_viz':  ['bokeh'],
+        'blas': ['scipy'],
         'draw_net': ['pygraphviz'],
         'test': tests_require
     },